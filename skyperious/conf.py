@@ -37,25 +37,32 @@ else:
 """Name of file where FileDirectives are kept."""
 ConfigFile = "%s.ini" % os.path.join(ApplicationDirectory, Title.lower())
 
+"""Name of file where database statistics are cached."""
+StatisticsCacheFile = "%s.stats" % os.path.join(ApplicationDirectory,
+                                                 Title.lower())
+
 """List of attribute names that can be saved to and loaded from ConfigFile."""
 FileDirectives = ["ConsoleHistoryCommands", "DBDoBackup",  "DBFiles",
     "ErrorsReportedOnDay", "ErrorReportsAutomatic", "ErrorReportHashes",
     "LastActivePage", "LastSearchResults", "LastSelectedFiles",
-    "LastUpdateCheck", "RecentFiles", "SearchHistory", "SearchInChatInfo",
-    "SearchInContacts", "SearchInMessages", "SearchUseNewTab",
-    "SearchInTables", "SQLWindowTexts", "TrayIconEnabled",
+    "LastUpdateCheck", "MergeUseSQLDiff", "RecentFiles", "SearchHistory",
+    "SearchInChatInfo", "SearchInContacts", "SearchInMessages",
+    "SearchUseNewTab", "SearchInTables", "SQLWindowTexts", "TrayIconEnabled",
     "UpdateCheckAutomatic", "WindowIconized", "WindowPosition", "WindowSize",
 ]
 """List of attributes saved if changed from default."""
-OptionalFileDirectives = ["EmoticonsPlotWidth", "ExportChatTemplate",
-    "ExportDbTemplate", "LogSQL", "MinWindowSize", "MaxConsoleHistory",
-    "MaxHistoryInitialMessages", "MaxRecentFiles", "MaxSearchHistory",
-    "MaxSearchMessages", "MaxSearchTableRows", "PlotDaysColour",
-    "PlotDaysUnitSize", "PlotHoursColour", "PlotHoursUnitSize",
-    "SearchContactsChunk", "SearchResultsChunk", "SharedImageAutoDownload",
-    "StatisticsPlotWidth", "StatusFlashLength", "UpdateCheckInterval",
-    "WordCloudLengthMin", "WordCloudCountMin", "WordCloudWordsMax",
-    "WordCloudWordsAuthorMax"
+OptionalFileDirectives = ["ChangeDetectionInterval", "EmoticonsPlotWidth",
+    "ExportChatTemplate", "ExportDbTemplate", "ExportProcesses", "LogSQL",
+    "MinWindowSize",
+    "MaxConsoleHistory", "MaxHistoryInitialMessages", "MaxRecentFiles",
+    "MaxSearchHistory", "MaxSearchMessages", "MaxSearchTableRows",
+    "MessageCacheSize", "PlotDaysColour", "PlotDaysUnitSize",
+    "PlotHoursColour", "PlotHoursUnitSize", "ReadOnlyCacheSize",
+    "ReadOnlyMmapSize", "ReadOnlyTempStore", "SearchContactsChunk",
+    "SearchResultsChunk", "SearchUseIndex", "SharedImageAutoDownload",
+    "StatisticsCacheEnabled", "StatisticsPlotWidth", "StatusFlashLength",
+    "UpdateCheckInterval", "WordCloudLengthMin", "WordCloudCountMin",
+    "WordCloudWordsMax", "WordCloudWordsAuthorMax"
 ]
 OptionalFileDirectiveDefaults = {}
 
@@ -88,6 +95,12 @@ LastSearchResults = {}
 """Files selected in the database lists on last run."""
 LastSelectedFiles = ["", ""]
 
+"""
+Whether merge compares messages in SQL first, by GUID, remote ID and
+timestamp, parsing only unmatched messages.
+"""
+MergeUseSQLDiff = False
+
 """Contents of Recent Files menu."""
 RecentFiles = []
 
@@ -121,6 +134,18 @@ ExportChatTemplate = u"Skype %(title_long_lc)s"
 """Database export filename template, format can use Skype.Accounts data."""
 ExportDbTemplate = u"Export from %(fullname)s"
 
+"""
+Number of parallel processes for exporting chats to separate files,
+0 for one per CPU core, 1 for exporting in the program process.
+"""
+ExportProcesses = 1
+
+"""
+Seconds between checking open databases for changes by other programs,
+like a running Skype, refreshing only changed data, 0 to disable.
+"""
+ChangeDetectionInterval = 10
+
 """Whether the program tray icon is used."""
 TrayIconEnabled = True
 
@@ -188,12 +213,45 @@ MaxSearchMessages = 500
 """Maximum number of table rows to show in search results."""
 MaxSearchTableRows = 500
 
+"""
+Memory budget for cached message lists and parsed message bodies, per
+database, in bytes. Least recently used chats are dropped when exceeded.
+"""
+MessageCacheSize = 256 * 1024 * 1024
+
+"""
+SQLite page cache size for databases opened read-only, as PRAGMA cache_size:
+number of pages if positive, kibibytes if negative.
+"""
+ReadOnlyCacheSize = -64 * 1024
+
+"""
+Maximum number of bytes of a database opened read-only to access via
+memory-mapped I/O, as PRAGMA mmap_size, 0 disables.
+"""
+ReadOnlyMmapSize = 1024 * 1024 * 1024
+
+"""
+Where SQLite keeps temporary tables and indexes for databases opened
+read-only, as PRAGMA temp_store: "DEFAULT", "FILE" or "MEMORY".
+"""
+ReadOnlyTempStore = "MEMORY"
+
 """Number of search results to yield in one chunk from search thread."""
 SearchResultsChunk = 50
 
 """Number of contact search results to yield in one chunk."""
 SearchContactsChunk = 10
 
+"""
+Whether message search uses a full-text index, kept in a separate file next
+to the database and updated with new messages before searching. Single words
+are then matched at the start of words only, not anywhere inside words:
+"ell" no longer finds "hello". Phrases and words with punctuation are
+matched as without index.
+"""
+SearchUseIndex = False
+
 """Name of font used in chat history."""
 HistoryFontName = "Tahoma"
 
@@ -325,6 +383,12 @@ Ask for Skype password and download shared images from Skype web for HTML export
 """
 SharedImageAutoDownload = True
 
+"""
+Whether chat statistics and table row counts are cached in
+StatisticsCacheFile, to speed up opening large databases.
+"""
+StatisticsCacheEnabled = True
+
 """Duration of "flashed" status message on StatusBar, in milliseconds."""
 StatusFlashLength = 30000
 
@@ -14,6 +14,7 @@ Released under the MIT License.
 import collections
 import csv
 import datetime
+import multiprocessing
 import os
 import re
 
@@ -63,23 +64,29 @@ QUERY_WILDCARD = ("HTML document (*.html)|*.html|"
                   "%sCSV spreadsheet (*.csv)|*.csv" % XLSX_WILDCARD)
 QUERY_EXTS = ["html", "xlsx", "csv"] if xlsxwriter else ["html", "csv"]
 
+"""Database and chats opened in a parallel export worker process."""
+PROCESS_STATE = {"db": None, "chats": {}}
 
-def export_chats(chats, path, format, db, messages=None, skip=True, progress=None):
+
+def export_chats(chats, path, format, db, messages=None, skip=True,
+                 progress=None, processes=1):
     """
     Exports the specified chats from the database under path.
 
-    @param   chats     list of chat dicts, as returned from SkypeDatabase
-    @param   path      full path of directory where to save
-    @param   format    export format (html|txt|xlsx|csv|filename.ext).
-                       If format is filename.ext, a single file is created:
-                       for single chat exports and multi chat XLSX exports
-                       (for multi-file exports, filenames are named by chats).
-    @param   db        SkypeDatabase instance
-    @param   messages  list messages to export if a single chat
-    @param   skip      whether to skip chats with no messages
-    @param   progress  function called before exporting each chat, with the
-                       number of messages exported so far
-    @return            (list of exported filenames, number of chats exported)
+    @param   chats      list of chat dicts, as returned from SkypeDatabase
+    @param   path       full path of directory where to save
+    @param   format     export format (html|txt|xlsx|csv|filename.ext).
+                        If format is filename.ext, a single file is created:
+                        for single chat exports and multi chat XLSX exports
+                        (for multi-file exports, filenames are named by chats).
+    @param   db         SkypeDatabase instance
+    @param   messages   list messages to export if a single chat
+    @param   skip       whether to skip chats with no messages
+    @param   progress   function called before exporting each chat, with the
+                        number of messages exported so far
+    @param   processes  number of parallel processes for multi-file exports,
+                        each opening its own database, 0 for one per CPU
+    @return             (list of exported filenames, number of chats exported)
     """
     files, count = [], 0
     def make_filename(chat):
@@ -103,9 +110,16 @@ def export_chats(chats, path, format, db, messages=None, skip=True, progress=Non
     else:
         if not os.path.exists(path):
             os.makedirs(path)
-        export_func = (export_chats_xlsx if format.lower().endswith("xlsx")
-                       else export_chat_csv if format.lower().endswith("csv")
-                       else export_chat_template)
+        processes = processes or multiprocessing.cpu_count()
+        # Snapshot and Skype web login are private to this process
+        if (processes > 1 and len(chats) > 1 and not messages
+        and not db.snapshot
+        and not skypedata.SharedImageDownload.has_login(db.id)):
+            files = export_chats_parallel(chats, format, db, make_filename,
+                                          skip, progress, processes)
+            return (files, len(files))
+
+        export_func = get_export_func(format)
         message_count = 0
         for chat in chats:
             if skip and not messages and not chat["message_count"]:
@@ -116,7 +130,8 @@ def export_chats(chats, path, format, db, messages=None, skip=True, progress=Non
             main.logstatus("Exporting %s.", chat["title_long_lc"])
             if progress: progress(message_count)
             filename = make_filename(chat)
-            msgs = messages or db.get_messages(chat, use_cache=False)
+            msgs = messages or db.get_messages(chat, use_cache=False,
+                                               projection="render")
             chatarg = [chat] if "xlsx" == format.lower() else chat
             export_func(chatarg, filename, db, msgs)
             message_count += chat["message_count"]
@@ -125,6 +140,99 @@ def export_chats(chats, path, format, db, messages=None, skip=True, progress=Non
     return (files, count)
 
 
+def export_chats_parallel(chats, format, db, make_filename, skip=True,
+                          progress=None, processes=2):
+    """
+    Exports the chats to separate files in a pool of worker processes, each
+    worker opening its own read-only instance of the database, with
+    configuration copied from this process. Filenames are assigned in chat
+    order before exporting, and progress is reported in chat order.
+
+    @param   chats          list of chat dicts, as returned from SkypeDatabase
+    @param   format         export format (html|txt|xlsx|csv)
+    @param   db             SkypeDatabase instance
+    @param   make_filename  function(chat) returning unique path for chat
+    @param   skip           whether to skip chats with no messages
+    @param   progress       function called after exporting each chat, with
+                            the number of messages exported so far
+    @param   processes      number of worker processes
+    @return                 list of exported filenames
+    """
+    files, tasks, message_count = [], [], 0
+    for chat in chats:
+        if skip and not chat["message_count"]:
+            main.log("Skipping exporting %s: no messages.",
+                     chat["title_long_lc"])
+            continue # continue for chat in chats
+        filename, counter = make_filename(chat), 2
+        base, ext = os.path.splitext(filename)
+        while filename in files: # Not on disk yet, unique_path cannot know
+            filename = util.unique_path("%s (%s)%s" % (base, counter, ext))
+            counter += 1
+        files.append(filename)
+        tasks.append((chat["id"], filename, format))
+    if not tasks: return files
+
+    processes = min(processes, len(tasks))
+    main.logstatus("Exporting %s in %s processes.",
+                   util.plural("chat", tasks), processes)
+    chatmap = dict((c["id"], c) for c in chats)
+    confvalues = dict((k, getattr(conf, k)) for k in
+                      conf.FileDirectives + conf.OptionalFileDirectives
+                      if hasattr(conf, k))
+    pool = multiprocessing.Pool(processes, init_export_process,
+                                [db.filename, db.immutable, confvalues])
+    try:
+        if progress: progress(message_count)
+        for chat_id, count in pool.imap(export_chat_process, tasks):
+            main.logstatus("Exported %s.", chatmap[chat_id]["title_long_lc"])
+            message_count += count
+            if progress: progress(message_count)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return files
+
+
+def init_export_process(filename, immutable=False, confvalues=None):
+    """
+    Opens the database read-only in a parallel export worker process,
+    after setting configuration values, as worker processes can start with
+    default configuration.
+
+    @param   confvalues  {name: value} to set in conf module
+    """
+    for name, value in (confvalues or {}).items():
+        setattr(conf, name, value)
+    db = skypedata.SkypeDatabase(filename, False, True, immutable)
+    chats = db.get_conversations()
+    PROCESS_STATE.update(db=db, chats=dict((c["id"], c) for c in chats))
+
+
+def export_chat_process(task):
+    """
+    Exports a single chat in a parallel export worker process.
+
+    @param   task  (chat ID, full path of resulting file, export format)
+    @return        (chat ID, number of messages exported)
+    """
+    chat_id, filename, format = task
+    db, chat = PROCESS_STATE["db"], PROCESS_STATE["chats"][chat_id]
+    db.get_conversations_stats([chat], log=False)
+    msgs = db.get_messages(chat, use_cache=False, projection="render")
+    chatarg = [chat] if "xlsx" == format.lower() else chat
+    get_export_func(format)(chatarg, filename, db, msgs)
+    return chat_id, chat["message_count"]
+
+
+def get_export_func(format):
+    """Returns the function for exporting a single chat in format."""
+    return (export_chats_xlsx if format.lower().endswith("xlsx")
+            else export_chat_csv if format.lower().endswith("csv")
+            else export_chat_template)
+
+
 def export_chats_xlsx(chats, filename, db, messages=None, skip=True, progress=None):
     """
     Exports the chats to a single XLSX file with chats on separate worksheets.
@@ -155,7 +263,8 @@ def export_chats_xlsx(chats, filename, db, messages=None, skip=True, progress=No
         writer.writerow(["Time", "Author", "Message", "Skype Name"],
                         {3: "boldhidden"})
         writer.set_header(False)
-        msgs = messages or db.get_messages(chat, use_cache=False)
+        msgs = messages or db.get_messages(chat, use_cache=False,
+                                           projection="render")
         for m in msgs:
             text = parser.parse(m, output={"format": "text"})
             try:
@@ -355,6 +464,45 @@ def export_grid(grid, filename, title, db, sql_query="", table=""):
 
 
 
+class text_measurer(object):
+    """
+    Measures text width in a font by summing per-character advance widths,
+    cached on first use. Ignores kerning, so results can differ by a pixel
+    or two from measuring the whole string.
+    """
+    _instances = {} # {font: text_measurer, }
+
+    def __init__(self, font):
+        self._font = font
+        self._widths = {} # {character: width in pixels, }
+
+
+    @classmethod
+    def get(cls, font):
+        """Returns measurer instance for font, shared across exports."""
+        if font not in cls._instances:
+            cls._instances[font] = cls(font)
+        return cls._instances[font]
+
+
+    def getwidth(self, text, maxwidth=None):
+        """
+        Returns the width of text in pixels.
+
+        @param   maxwidth  width in pixels after which to stop measuring,
+                           result being larger than maxwidth
+        """
+        result, widths = 0, self._widths
+        for char in text:
+            width = widths.get(char)
+            if width is None:
+                width = widths[char] = self._font.getsize(char)[0]
+            result += width
+            if maxwidth and result > maxwidth: break # break for char in text
+        return result
+
+
+
 class xlsx_writer(object):
     """Convenience wrapper for xslxwriter, with csv.Writer-like interface."""
     COL_MAXWIDTH   = 100 # In Excel units, 1 == width of "0" in standard font
@@ -370,19 +518,25 @@ class xlsx_writer(object):
                                           "align": "left",
                                           "num_format": "yyyy-mm-dd HH:MM", })
 
-    def __init__(self, filename, sheetname=None, autowrap=[]):
+    def __init__(self, filename, sheetname=None, autowrap=[], streaming=True):
         """
         @param   sheetname  title of the first sheet to create, if any
         @param   autowrap   a list of column indices that will get their width
                             set to COL_MAXWIDTH and their contents wrapped
+        @param   streaming  whether rows are flushed to disk as soon as written,
+                            keeping memory use constant (rows must be written
+                            in order, as writerow() does), or all cells kept
+                            in memory until close()
         """
         self._workbook = xlsxwriter.Workbook(filename,
-            {"constant_memory": True, "strings_to_formulas": False})
+            {"constant_memory": streaming, "strings_to_formulas": False})
+        self._streaming  = streaming
         self._sheet      = None # Current xlsxwriter.Worksheet, if any
         self._sheets     = {} # {lowercase sheet name: xlsxwriter.Worksheet, }
         self._sheetnames = {} # {xlsxwriter.Worksheet: original given name, }
         self._headers    = {} # {sheet name: [[values, style, merge_cols], ], }
         self._col_widths = {} # {sheet name: {col index: width in Excel units}}
+                              # Only maximum widths retained, not values
         self._autowrap   = [c for c in autowrap] # [column index to autowrap, ]
         self._format     = None
 
@@ -395,11 +549,12 @@ class xlsx_writer(object):
             self._formats[t] = self._workbook.add_format(f)
 
         # For calculating column widths
-        self._fonts = collections.defaultdict(lambda: FONT_XLSX)
-        self._fonts["bold"] = FONT_XLSX_BOLD
-        unit_width_default = self._fonts[None].getsize("0")[0]
+        measurer_default = text_measurer.get(FONT_XLSX)
+        self._measurers = collections.defaultdict(lambda: measurer_default)
+        self._measurers["bold"] = text_measurer.get(FONT_XLSX_BOLD)
+        unit_width_default = measurer_default.getwidth("0")
         self._unit_widths = collections.defaultdict(lambda: unit_width_default)
-        self._unit_widths["bold"] = self._fonts["bold"].getsize("0")[0]
+        self._unit_widths["bold"] = self._measurers["bold"].getwidth("0")
 
         if sheetname: # Create default sheet
             self.add_sheet(sheetname)
@@ -407,7 +562,7 @@ class xlsx_writer(object):
 
     def add_sheet(self, name=None):
         """Adds a new worksheet. Name will be changed if invalid/existing."""
-        if self._sheet and hasattr(self._sheet, "_opt_close"):
+        if self._streaming and self._sheet and hasattr(self._sheet, "_opt_close"):
             self._sheet._opt_close() # Close file handle to not hit ulimit
         safename = None
         if name:
@@ -470,13 +625,14 @@ class xlsx_writer(object):
             f = self._formats[self._format]
             self._sheet.merge_range(self._row, 0, self._row, merge_cols, "", f)
             values = values[0] if values else []
+        col_widths = self._col_widths[self._sheet.name]
         for c, v in enumerate(values):
             writefunc = self._writers[type(v)]
             fmt_name = style if isinstance(style, basestring) \
                        else style.get(c, self._format)
             writefunc(self._row, c, v, self._formats[fmt_name])
             if (merge_cols or not autowidth or "wrap" == fmt_name
-            or c in self._autowrap):
+            or c in self._autowrap or col_widths[c] >= self.COL_MAXWIDTH):
                 continue # continue for c, v in enumerate(Values)
 
             # Calculate and update maximum written column width
@@ -484,11 +640,13 @@ class xlsx_writer(object):
                       else v.strftime("%Y-%m-%d %H:%M") \
                       if isinstance(v, datetime.datetime) else 
                       v if isinstance(v, basestring) else str(v))
-            pixels = max(self._fonts[fmt_name].getsize(x)[0]
+            unit_width = self._unit_widths[fmt_name]
+            maxpixels = (self.COL_MAXWIDTH - 1) * unit_width
+            pixels = max(self._measurers[fmt_name].getwidth(x, maxpixels)
                          for x in strval.split("\n"))
-            width = float(pixels) / self._unit_widths[fmt_name] + 1
-            if not merge_cols and width > self._col_widths[self._sheet.name][c]:
-                self._col_widths[self._sheet.name][c] = width
+            width = float(pixels) / unit_width + 1
+            if width > col_widths[c]:
+                col_widths[c] = min(width, self.COL_MAXWIDTH)
         self._row += 1
 
 
@@ -499,7 +657,6 @@ class xlsx_writer(object):
         for sheet in self._workbook.worksheets():
             c = -1
             for c, w in sorted(self._col_widths[sheet.name].items()):
-                w = min(w, self.COL_MAXWIDTH)
                 sheet.set_column(c, c, w, self._formats[None])
             sheet.set_column(c + 1, 50, cell_format=self._formats[None])
         self._workbook.set_properties({"comments": "Exported with %s on %s." %
@@ -24,9 +24,11 @@ import glob
 import locale
 import io
 import itertools
+import multiprocessing
 import Queue
 import os
 import shutil
+import signal
 import sys
 import threading
 import time
@@ -87,6 +89,20 @@ ARGUMENTS = {
               "action": "store_true", "required": False,
               "help": "ask for Skype password on HTML export, "
                       "to download shared images"},
+             {"args": ["-j", "--processes"], "dest": "processes",
+              "type": int, "default": 1, "required": False,
+              "help": "number of parallel processes for exporting chats to "
+                      "separate files, 0 for one per CPU core (default 1)"},
+             {"args": ["--immutable"], "dest": "immutable",
+              "action": "store_true", "required": False,
+              "help": "open databases as immutable, skipping all locking: "
+                      "faster, but only safe for files that nothing else "
+                      "is changing, like archived copies"},
+             {"args": ["--snapshot"], "dest": "snapshot", "required": False,
+              "nargs": "?", "const": "memory", "choices": ["memory", "file"],
+              "help": "copy databases into memory (default) or a temporary "
+                      "file first, for a consistent view of a database "
+                      "in use by Skype and faster queries"},
              {"args": ["--verbose"], "action": "store_true",
               "help": "print detailed progress messages to stderr"}, ],
         }, 
@@ -107,6 +123,21 @@ ARGUMENTS = {
                       "at https://suurjaak.github.io/Skyperious/help.html. " },
              {"args": ["FILE"], "nargs": "+",
               "help": "Skype database file(s) to search", },
+             {"args": ["--index"], "dest": "index", "action": "store_true",
+              "required": False,
+              "help": "search messages using a full-text index kept next to "
+                      "the database file, creating or updating it first; "
+                      "single words then match only at the start of words"},
+             {"args": ["--immutable"], "dest": "immutable",
+              "action": "store_true", "required": False,
+              "help": "open databases as immutable, skipping all locking: "
+                      "faster, but only safe for files that nothing else "
+                      "is changing, like archived copies"},
+             {"args": ["--snapshot"], "dest": "snapshot", "required": False,
+              "nargs": "?", "const": "memory", "choices": ["memory", "file"],
+              "help": "copy databases into memory (default) or a temporary "
+                      "file first, for a consistent view of a database "
+                      "in use by Skype and faster queries"},
              {"args": ["--verbose"], "action": "store_true",
               "help": "print detailed progress messages to stderr"}, ],
         }, 
@@ -126,6 +157,10 @@ ARGUMENTS = {
               "help": "print detailed progress messages to stderr"},
              {"args": ["-o", "--output"], "dest": "output", "required": False,
               "help": "Final database filename, auto-generated by default"},
+             {"args": ["--sql"], "dest": "sql", "action": "store_true",
+              "required": False,
+              "help": "compare messages in SQL first, parsing only messages "
+                      "not matched by GUID, remote ID or timestamp"},
               ]
         }, 
         {"name": "diff", "help": "compare chat history in two Skype databases",
@@ -134,6 +169,39 @@ ARGUMENTS = {
          "arguments": [
              {"args": ["FILE1"], "help": "first Skype database", "nargs": 1},
              {"args": ["FILE2"], "help": "second Skype databases", "nargs": 1},
+             {"args": ["--sql"], "dest": "sql", "action": "store_true",
+              "required": False,
+              "help": "compare messages in SQL first, parsing only messages "
+                      "not matched by GUID, remote ID or timestamp"},
+             {"args": ["--immutable"], "dest": "immutable",
+              "action": "store_true", "required": False,
+              "help": "open databases as immutable, skipping all locking: "
+                      "faster, but only safe for files that nothing else "
+                      "is changing, like archived copies"},
+             {"args": ["--snapshot"], "dest": "snapshot", "required": False,
+              "nargs": "?", "const": "memory", "choices": ["memory", "file"],
+              "help": "copy databases into memory (default) or a temporary "
+                      "file first, for a consistent view of a database "
+                      "in use by Skype and faster queries"},
+             {"args": ["--verbose"], "action": "store_true",
+              "help": "print detailed progress messages to stderr"}, ],
+        }, 
+        {"name": "optimize",
+         "help": "add or remove indexes for faster reading of Skype databases",
+         "description": "Create additional indexes in a Skype database for "
+                        "faster reading, or drop them again before the "
+                        "database is used in Skype. Database is backed up "
+                        "before changing in place, if backups are enabled. "
+                        "Prints the query plans of affected queries.",
+         "arguments": [
+             {"args": ["FILE"], "nargs": "+",
+              "help": "Skype database file(s) to optimize", },
+             {"args": ["-o", "--output"], "dest": "output", "required": False,
+              "help": "working copy to create and optimize instead of "
+                      "changing the database in place (single database only)"},
+             {"args": ["--drop"], "dest": "drop", "action": "store_true",
+              "required": False,
+              "help": "drop indexes created earlier, restoring Skype schema"},
              {"args": ["--verbose"], "action": "store_true",
               "help": "print detailed progress messages to stderr"}, ],
         }, 
@@ -262,7 +330,50 @@ def process_deferreds():
             del deferred_status[:]
 
 
-def run_merge(filenames, output_filename=None):
+def get_result(queue):
+    """
+    Returns the next item from the worker results queue, waiting in a way
+    that can be interrupted with Ctrl-C.
+    """
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            pass
+
+
+def open_database(filename, immutable=False, snapshot=None, draw=True):
+    """
+    Opens the Skype database read-only, copying it into a snapshot first
+    if specified, with a progress bar if draw.
+
+    @param   snapshot  "memory" or "file" to read from a copy of the database
+    """
+    if not snapshot:
+        return skypedata.SkypeDatabase(filename, readonly=True,
+                                       immutable=immutable)
+    bar = progress = None
+    if draw:
+        bar = ProgressBar(afterword=" Copying %s.." % filename)
+        bar.start()
+        def progress(count, total):
+            bar.max = total
+            bar.update(count, draw=False)
+    try:
+        db = skypedata.SkypeDatabase(filename, readonly=True,
+                                     immutable=immutable, snapshot=snapshot,
+                                     progress=progress)
+        atexit.register(db.close) # Remove temporary file, if any
+        return db
+    finally:
+        if bar:
+            bar.stop()
+            bar.afterword = " Copied %s." % filename
+            bar.update(bar.max)
+            output()
+
+
+def run_merge(filenames, output_filename=None, sql_diff=False):
     """Merges all Skype databases to a new database."""
     dbs = [skypedata.SkypeDatabase(f) for f in filenames]
     db_base = dbs.pop()
@@ -281,7 +392,7 @@ def run_merge(filenames, output_filename=None):
     chats2 = db2.get_conversations()
     db2.get_conversations_stats(chats2)
 
-    args = {"db2": db2, "type": "diff_merge_left"}
+    args = {"db2": db2, "type": "diff_merge_left", "sql_diff": sql_diff}
     worker = workers.MergeThread(postbacks.put)
     try:
         for db1 in dbs:
@@ -290,16 +401,22 @@ def run_merge(filenames, output_filename=None):
             bar.afterword = " Processing %.*s.." % (30, db1)
             worker.work(dict(args, db1=db1, chats=chats))
             while True:
-                result = postbacks.get()
+                result = get_result(postbacks)
                 if "error" in result:
                     output("Error merging %s:\n\n%s" % (db1, result["error"]))
                     db1 = None # Signal for global break
                     break # break while True
                 if "done" in result:
+                    if result.get("memory"):
+                        log("Peak memory use %s.",
+                            util.format_bytes(result["memory"]))
                     break # break while True
                 if "diff" in result:
                     counts[db1]["chats"] += 1
                     counts[db1]["msgs"] += len(result["diff"]["messages"])
+                if result.get("rate"):
+                    bar.afterword = " Processing %.*s, %d messages/s.." % \
+                                    (30, db1, result["rate"])
                 if "index" in result:
                     bar.max = result["count"]
                     bar.update(result["index"])
@@ -326,18 +443,21 @@ def run_merge(filenames, output_filename=None):
         output("Merge into %s complete." % db2)
 
 
-def run_search(filenames, query):
+def run_search(filenames, query, use_index=False, immutable=False,
+               snapshot=None):
     """Searches the specified databases for specified query."""
-    dbs = [skypedata.SkypeDatabase(f) for f in filenames]
+    dbs = [open_database(f, immutable, snapshot, draw=False)
+           for f in filenames]
     postbacks = Queue.Queue()
-    args = {"text": query, "table": "messages", "output": "text"}
+    args = {"text": query, "table": "messages", "output": "text",
+            "index": use_index}
     worker = workers.SearchThread(postbacks.put)
     try:
         for db in dbs:
             log("Searching \"%s\" in %s." % (query, db))
             worker.work(dict(args, db=db))
             while True:
-                result = postbacks.get()
+                result = get_result(postbacks)
                 if "error" in result:
                     output("Error searching %s:\n\n%s" %
                           (db, result.get("error_short", result["error"])))
@@ -345,6 +465,9 @@ def run_search(filenames, query):
                 if "done" in result:
                     log("Finished searching for \"%s\" in %s.", query, db)
                     break # break while True
+                if "status" in result:
+                    log(result["status"])
+                    continue # continue while True
                 if result.get("count", 0) or is_verbose:
                     if len(dbs) > 1:
                         output("%s:" % db, end=" ")
@@ -353,9 +476,10 @@ def run_search(filenames, query):
         worker and (worker.stop(), worker.join())
 
 
-def run_export(filenames, format, chatnames, authornames, ask_password):
+def run_export(filenames, format, chatnames, authornames, ask_password,
+               processes=1, immutable=False, snapshot=None):
     """Exports the specified databases in specified format."""
-    dbs = [skypedata.SkypeDatabase(f) for f in filenames]
+    dbs = [open_database(f, immutable, snapshot) for f in filenames]
     is_xlsx_single = ("xlsx_single" == format)
 
     for db in dbs:
@@ -402,7 +526,8 @@ def run_export(filenames, format, chatnames, authornames, ask_password):
             bar = ProgressBar(max=bar_total, afterword=bartext)
             bar.start()
             result = export.export_chats(chats, export_dir, filename, db,
-                                         progress=bar.update)
+                                         progress=bar.update,
+                                         processes=processes)
             files, count = result
             bar.stop()
             if count:
@@ -420,12 +545,14 @@ def run_export(filenames, format, chatnames, authornames, ask_password):
                   (e, traceback.format_exc()))
 
 
-def run_diff(filename1, filename2):
+def run_diff(filename1, filename2, sql_diff=False, immutable=False,
+             snapshot=None):
     """Compares the first database for changes with the second."""
     if os.path.realpath(filename1) == os.path.realpath(filename2):
         output("Error: cannot compare %s with itself." % filename1)
         return
-    db1, db2 = map(skypedata.SkypeDatabase, [filename1, filename2])
+    db1, db2 = [open_database(f, immutable, snapshot)
+                for f in (filename1, filename2)]
     counts = collections.defaultdict(lambda: collections.defaultdict(int))
     postbacks = Queue.Queue()
 
@@ -435,17 +562,21 @@ def run_diff(filename1, filename2):
     chats1, chats2 = db1.get_conversations(), db2.get_conversations()
     db1.get_conversations_stats(chats1), db2.get_conversations_stats(chats2)
 
-    args = {"db1": db1, "db2": db2, "chats": chats1, "type": "diff_left"}
+    args = {"db1": db1, "db2": db2, "chats": chats1, "type": "diff_left",
+            "sql_diff": sql_diff}
     worker = workers.MergeThread(postbacks.put)
     try:
         worker.work(args)
         while True:
-            result = postbacks.get()
+            result = get_result(postbacks)
             if "error" in result:
                 output("Error scanning %s and %s:\n\n%s" %
                       (db1, db2, result["error"]))
                 break # break while True
             if "done" in result:
+                if result.get("memory"):
+                    log("Peak memory use %s.",
+                        util.format_bytes(result["memory"]))
                 break # break while True
             if "chats" in result and result["chats"]:
                 counts[db1]["chats"] += 1
@@ -471,6 +602,38 @@ def run_diff(filename1, filename2):
     output()
 
 
+def run_optimize(filenames, output_filename=None, drop=False):
+    """Creates or drops auxiliary indexes in the specified databases."""
+    if output_filename and len(filenames) > 1:
+        output("Error: working copy can be given for a single database only.")
+        return
+    for filename in filenames:
+        if output_filename:
+            if os.path.realpath(filename) == os.path.realpath(output_filename):
+                output("Error: cannot copy %s onto itself." % filename)
+                return
+            output("Copying %s to %s." % (filename, output_filename))
+            shutil.copyfile(filename, output_filename)
+            filename = output_filename
+        db = skypedata.SkypeDatabase(filename)
+        try:
+            names = db.drop_aux_indexes() if drop else db.create_aux_indexes()
+            if names:
+                output("%s indexes in %s: %s." % ("Dropped" if drop else
+                       "Created", db, ", ".join(names)))
+            else:
+                output("No indexes to %s in %s." % ("drop" if drop else
+                       "create", db))
+            for item in db.explain_aux_indexes():
+                output("\n%s (%s):" % (item["title"], "using index"
+                       if item["uses_index"] else "not using index"))
+                output("  %s" % item["query"])
+                for line in item["plan"]:
+                    output("    %s" % line)
+        finally:
+            db.close()
+
+
 def run_gui(filenames):
     """Main GUI program entrance."""
     global deferred_logs, deferred_status, window
@@ -560,16 +723,24 @@ def run(nogui=False):
         enc = sys.stdout.encoding or locale.getpreferredencoding() or "utf-8"
         sys.stdout = codecs.getwriter(enc)(sys.stdout, "xmlcharrefreplace")
         sys.stderr = codecs.getwriter(enc)(sys.stderr, "xmlcharrefreplace")
+        # Ctrl-C aborts the query running in main thread, if any
+        signal.signal(signal.SIGINT, skypedata.CancelToken.on_interrupt)
 
     if "diff" == arguments.command:
-        run_diff(*arguments.FILE)
+        run_diff(*arguments.FILE, sql_diff=arguments.sql,
+                 immutable=arguments.immutable, snapshot=arguments.snapshot)
     elif "merge" == arguments.command:
-        run_merge(arguments.FILE, arguments.output)
+        run_merge(arguments.FILE, arguments.output, arguments.sql)
     elif "export" == arguments.command:
         run_export(arguments.FILE, arguments.type, arguments.chat,
-                   arguments.author, arguments.ask_password)
+                   arguments.author, arguments.ask_password,
+                   arguments.processes, arguments.immutable,
+                   arguments.snapshot)
     elif "search" == arguments.command:
-        run_search(arguments.FILE, arguments.QUERY)
+        run_search(arguments.FILE, arguments.QUERY, arguments.index,
+                   arguments.immutable, arguments.snapshot)
+    elif "optimize" == arguments.command:
+        run_optimize(arguments.FILE, arguments.output, arguments.drop)
     elif "gui" == arguments.command:
         run_gui(arguments.FILE)
 
@@ -758,5 +929,6 @@ def output(*args, **kwargs):
 
 
 if "__main__" == __name__:
+    multiprocessing.freeze_support() # Parallel export in frozen executables
     try: run()
     except KeyboardInterrupt: sys.exit()
@@ -102,7 +102,7 @@ class SearchQueryParser(object):
             self._grammar = grammar
 
     
-    def Parse(self, query, table=None):
+    def Parse(self, query, table=None, index=None):
         """
         Parses the query string and returns (sql, sql params, words).
 
@@ -110,6 +110,8 @@ class SearchQueryParser(object):
                         specific table, ignoring all Skype-specific keywords,
                         only taking into account the table: keyword
                         {"name": "Table name": "columns[{"name", "pk_id", }, ]}
+        @param   index  name of full-text index table for message bodies,
+                        if any, words are matched in index instead of LIKE
         @return         (SQL string, SQL parameter dict, word and phrase list)
         """
         words = [] # All encountered text words and quoted phrases
@@ -134,7 +136,7 @@ class SearchQueryParser(object):
                 parse_results = split_words
 
         result = self._makeSQL(parse_results, words, keywords, sql_params,
-                              table=table)
+                              table=table, index=index)
         if table:
             skip_table = False
             for kw, values in keywords.items():
@@ -161,14 +163,22 @@ class SearchQueryParser(object):
 
 
     def _makeSQL(self, item, words, keywords, sql_params,
-                table=None, parent_name=None):
+                table=None, parent_name=None, index=None):
         """
         Returns the ParseResults item as an SQL string, appending
         words and phrases to words list, and keyword and sql parameter values
         to argument dictionaries.
         """
         result = ""
-        if isinstance(item, basestring):
+        match = isinstance(item, basestring) and not table and index \
+                and self._makeMatch(item)
+        if match:
+            words.append(item)
+            i = len(sql_params)
+            result = "m.id IN (SELECT docid FROM %s WHERE body MATCH " \
+                     ":body_match%s)" % (index, i)
+            sql_params["body_match%s" % i] = match
+        elif isinstance(item, basestring):
             words.append(item)
             safe = self._escape(item, ("*" if "QUOTES" != parent_name else ""))
             if not table:
@@ -205,7 +215,7 @@ class SearchQueryParser(object):
                 words_ptr = [] if negation else words # No words from negations
                 for i in elements:
                     sql = self._makeSQL(i, words_ptr, keywords, sql_params,
-                                       table, name)
+                                       table, name, index)
                     parsed_elements.append(sql)
                 or_names = ["OR_OPERAND", "OR_EXPRESSION"]
                 glue = " OR " if name in or_names else " AND "
@@ -295,6 +305,21 @@ class SearchQueryParser(object):
         return result
 
 
+    def _makeMatch(self, item):
+        """
+        Returns the word as a full-text MATCH prefix expression, or None
+        if item is not a single word that the index tokenizer would keep
+        whole, like phrases, words with punctuation or inner wildcards,
+        which are matched with LIKE instead. Unlike LIKE, MATCH finds the
+        word only at the start of a word in text: "ell" does not find
+        "hello".
+        """
+        result, word = None, item.rstrip("*")
+        if re.match("^[^\\W_]+$", word, re.U): # Quoted to not be an operator
+            result = "\"%s*\"" % word
+        return result
+
+
     def _flatten(self, items):
         """
         Flattens the list to a single level, if possible,
@@ -359,14 +384,16 @@ if "__main__" == __name__:
     loglines = [] # Cached trace lines
     def makeSQLLogger(func):
         level = [0] # List as workaround: enclosing scope cannot be reassigned
-        def inner(item, words, keywords, sql_params, table=None, parent_name=None):
+        def inner(item, words, keywords, sql_params, table=None,
+                  parent_name=None, index=None):
             txt = "%s_makeSQL(<%s> %s, parent_name=%s)" % \
                   ("  " * level[0], item.__class__.__name__, item, parent_name)
             if hasattr(item, "getName"):
                 txt += ", name=%s" % item.getName()
             loglines.append(txt)
             level[0] += 1
-            result = func(item, words, keywords, sql_params, table, parent_name)
+            result = func(item, words, keywords, sql_params, table,
+                          parent_name, index)
             level[0] -= 1
             loglines.append("%s = %s." % (txt, result))
             return result
@@ -18,15 +18,17 @@ import copy
 import cStringIO
 import csv
 import datetime
+import HTMLParser
 import json
 import math
 import os
 import re
 import sqlite3
-import shutil
 import string
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 import traceback
 import urllib
@@ -147,17 +149,112 @@ class SkypeDatabase(object):
       "voicemails": "CREATE TABLE Voicemails (id INTEGER NOT NULL PRIMARY KEY, is_permanent INTEGER, type INTEGER, partner_handle TEXT, partner_dispname TEXT, status INTEGER, failurereason INTEGER, subject TEXT, timestamp INTEGER, duration INTEGER, allowed_duration INTEGER, playback_progress INTEGER, convo_id INTEGER, chatmsg_guid BLOB, notification_id INTEGER, flags INTEGER, size INTEGER, path TEXT, failures INTEGER, vflags INTEGER, xmsg TEXT, extprop_hide_from_history INTEGER)",
     }
 
+    """Number of rows to insert in one executemany() call on merge."""
+    INSERT_BATCH = 1000
 
-    def __init__(self, filename, log_error=True):
+    """
+    Auxiliary indexes for speeding up reading, not in Skype's own schema,
+    with sample queries for reporting the query plan.
+    """
+    AUX_INDEXES = [
+        {"name": "skyperious_messages_convo_timestamp", "table": "messages",
+         "columns": ["convo_id", "timestamp", "id", "type"],
+         "title": "Chat messages in chat view, export and comparison",
+         "query": "SELECT * FROM messages WHERE convo_id = 1 AND type IN "
+                  "(61, 68) ORDER BY timestamp, id LIMIT 500"},
+        {"name": "skyperious_messages_timestamp", "table": "messages",
+         "columns": ["timestamp", "type"],
+         "title": "First and last message in general statistics",
+         "query": "SELECT * FROM messages WHERE type IN (61, 68) "
+                  "ORDER BY timestamp DESC LIMIT 1"},
+        {"name": "skyperious_transfers_chatmsg_guid", "table": "transfers",
+         "columns": ["chatmsg_guid"],
+         "title": "File transfers of a message",
+         "query": "SELECT * FROM transfers WHERE chatmsg_guid = X'00'"},
+        {"name": "skyperious_smses_chatmsg_id", "table": "smses",
+         "columns": ["chatmsg_id"],
+         "title": "SMS of a message",
+         "query": "SELECT * FROM smses WHERE chatmsg_id = 1"},
+    ]
+
+    """Leading whitespace and comments, skipped before checking statements."""
+    COMMENT_RGX = re.compile(r"^(\s+|--[^\n]*(\n|$)|/\*.*?(\*/|$))+", re.S)
+
+    """
+    Statements known to only read the database, executed in the thread's
+    read-only connection: WITH only if not containing any write keywords,
+    PRAGMA only for reading pragmas without a value and not depending on
+    connection state, statements naming an attached schema never.
+    """
+    READ_RGX = re.compile(r"^(SELECT|EXPLAIN|VALUES)\b", re.I)
+    READ_WITH_RGX = re.compile(r"^WITH\b", re.I)
+    WRITE_WORD_RGX = re.compile(r"\b(DELETE|INSERT|REPLACE|UPDATE)\b", re.I)
+    READ_PRAGMA_RGX = re.compile(r"^PRAGMA\s+(\w+\s*\.\s*)?(compile_options|"
+                                 r"data_version|encoding|"
+                                 r"foreign_key_list|freelist_count|"
+                                 r"index_info|index_list|index_xinfo|"
+                                 r"integrity_check|page_count|page_size|"
+                                 r"quick_check|schema_version|table_info|"
+                                 r"table_xinfo|user_version)\s*"
+                                 r"(\(\s*[\w\"'`\[\]]+\s*\))?\s*;?\s*$",
+                                 re.I)
+
+    """Statements attaching and detaching databases, with schema name."""
+    ATTACH_RGX = re.compile(r"^ATTACH\s+(DATABASE\s+)?.+\s+AS\s+"
+                            r"[\"'`\[]?(\w+)[\"'`\]]?\s*;?\s*$", re.I | re.S)
+    DETACH_RGX = re.compile(r"^DETACH\s+(DATABASE\s+)?"
+                            r"[\"'`\[]?(\w+)[\"'`\]]?\s*;?\s*$", re.I)
+
+    """Default number of messages in one get_message_page() page."""
+    MESSAGE_PAGE_SIZE = 500
+
+    """Maximum number of timestamps memoized in stamp_to_date()."""
+    STAMP_CACHE_SIZE = 100000
+
+    """Whether SQLite supports URI filenames, checked once in make_uri()."""
+    URI_SUPPORTED = None
+
+    """
+    Named column sets for get_messages(): "ids" for message ID and time,
+    "diff" for comparing messages, "render" for parsing and displaying.
+    """
+    MESSAGE_PROJECTIONS = {
+        "ids":    ["id", "timestamp"],
+        "diff":   ["id", "timestamp", "remote_id", "author", "type",
+                   "identities", "body_xml", "guid", "edited_timestamp"],
+        "render": ["id", "timestamp", "remote_id", "author", "type",
+                   "identities", "body_xml", "guid", "edited_timestamp",
+                   "from_dispname", "convo_id", "chatname"],
+    }
+
+
+    def __init__(self, filename, log_error=True, readonly=False,
+                 immutable=False, snapshot=None, progress=None):
         """
         Initializes a new Skype database object from the file.
 
         @param   log_error  if False, exceptions on opening the database
                             are not written to log (written by default)
+        @param   readonly   if True, all connections are opened read-only,
+                            with conf.ReadOnly* pragmas for faster reading
+        @param   immutable  if True, a read-only database is opened as
+                            immutable, skipping all locking and change
+                            detection: only safe for files that nothing
+                            else is changing, like archived copies
+        @param   snapshot   "memory" or "file" to copy the database into
+                            memory or a temporary file, serving all reads
+                            from the copy, see make_snapshot()
+        @param   progress   callback(count, total) for snapshot progress
         """
         self.filename = filename
+        self.readonly = readonly or immutable or bool(snapshot)
+        self.immutable = immutable
+        self.snapshot = snapshot    # "memory" or "file" if reading a copy
+        self.snapshot_path = None   # Snapshot filename or shared memory URI
         self.basefilename = os.path.basename(self.filename)
         self.backup_created = False
+        self.backup_thread = None   # Thread copying backup file, if any
+        self.backup_error = None    # Exception from last backup attempt
         self.consumers = set() # Registered objects using this database
         self.account = None    # Row from table Accounts
         self.id = None   # Accounts.skypename
@@ -165,12 +262,27 @@ class SkypeDatabase(object):
         self.tables_list = None # Ordered list of table items
         self.table_rows = {}    # {"tablename1": [..], }
         self.table_objects = {} # {"tablename1": {id1: {rowdata1}, }, }
+        self.table_indexes = {} # {"tablename1": {key1: [{rowdata1}, ], }, }
+        self.in_batch = False   # Whether inside begin_batch() transaction
+        self.batch_thread = None    # Ident of thread in begin_batch()
+        self.owner_thread = None    # Ident of thread that opened database
+        self.read_connections = {}  # {thread ident: (Thread, connection)}
+        self.attached = set()       # Schemas ATTACHed in writer connection
+        self.connection_lock = threading.Lock()
+        self.stats_cache = StatisticsCache(self)
+        self.change_state = None # Last state from get_change_state()
+        # {(action, table, ..): (SQL, converter)}, cleared on schema change
+        self.statements = {}
+        self.statement_hits = self.statement_misses = 0
+        self.stamp_cache = {}   # {timestamp: datetime}
+        # {("messages", convo_id): (projection, [messages]),
+        #  ("dom", message_id): message body DOM}
+        self.message_cache = util.LRUCache(conf.MessageCacheSize)
         self.update_fileinfo()
         try:
-            self.connection = sqlite3.connect(self.filename,
-                                              check_same_thread=False)
-            self.connection.row_factory = self.row_factory
-            self.connection.text_factory = str
+            self.owner_thread = threading.current_thread().ident
+            self.connection = self.make_snapshot(progress) if snapshot \
+                              else self.make_connection(self.readonly)
             rows = self.execute("SELECT name, sql FROM sqlite_master "
                                 "WHERE type = 'table'").fetchall()
             for row in rows:
@@ -243,11 +355,310 @@ class SkypeDatabase(object):
         return result
 
 
+    def get_aux_indexes(self):
+        """
+        Returns AUX_INDEXES applicable to this database, with "exists" set
+        in each if the index is present.
+        """
+        result = []
+        if self.is_open():
+            names = set(r["name"].lower() for r in self.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"))
+            for index in self.AUX_INDEXES:
+                if index["table"] in self.tables:
+                    result.append(dict(index, exists=index["name"] in names))
+        return result
+
+
+    def create_aux_indexes(self):
+        """
+        Creates the auxiliary indexes for faster reading, backing up
+        the database first if configured so. The indexes should be dropped
+        before the database is used in Skype again.
+
+        @return  names of created indexes
+        """
+        result = []
+        indexes = [x for x in self.get_aux_indexes() if not x["exists"]]
+        if indexes:
+            self.ensure_backup()
+        for index in indexes:
+            main.log("Creating index %s on %s in %s.", index["name"],
+                     self.tables[index["table"]]["name"], self.filename)
+            self.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" %
+                         (index["name"], index["table"],
+                          ", ".join(index["columns"])))
+            self.connection.commit()
+            result.append(index["name"])
+        if result:
+            self.last_modified = datetime.datetime.now()
+        return result
+
+
+    def drop_aux_indexes(self):
+        """
+        Drops the auxiliary indexes created in create_aux_indexes().
+
+        @return  names of dropped indexes
+        """
+        result = []
+        for index in (x for x in self.get_aux_indexes() if x["exists"]):
+            main.log("Dropping index %s in %s.", index["name"], self.filename)
+            self.execute("DROP INDEX IF EXISTS %s" % index["name"])
+            self.connection.commit()
+            result.append(index["name"])
+        if result:
+            self.last_modified = datetime.datetime.now()
+        return result
+
+
+    def explain_aux_indexes(self):
+        """
+        Returns the query plans for the sample queries of auxiliary indexes,
+        as [{"title", "query", "plan": [text, ], "uses_index": bool}, ].
+        """
+        result = []
+        for index in self.get_aux_indexes():
+            rows = self.execute("EXPLAIN QUERY PLAN %s" % index["query"],
+                                log=False).fetchall()
+            plan = [r["detail"] for r in rows]
+            result.append(dict(index, plan=plan,
+                uses_index=any(index["name"] in x.lower() for x in plan)))
+        return result
+
+
     def clear_cache(self):
         """Clears all the currently cached rows."""
         self.table_rows.clear()
+        self.message_cache.clear()
         self.table_objects.clear()
+        self.table_indexes.clear()
         self.get_tables(True)
+        if self.change_state: # Reloaded data is the new baseline, on next check
+            self.change_state = None
+
+
+    def get_change_state(self):
+        """
+        Returns current database state for detecting changes, as
+        {"version": PRAGMA data_version, "size": bytes, "mtime": float,
+         "tables": {"tablename": [maximum rowid, row count], },
+         "edited": maximum message edited_timestamp},
+        with "tables" and "edited" retrieved only if version, size or
+        modification time differ from last state. Messages are not counted,
+        as counting can take long for large tables; Skype edits and removes
+        messages in place, setting edited_timestamp. Can take long regardless:
+        meant to run in a background thread, in the thread's own connection.
+        """
+        version = self.execute("PRAGMA data_version", log=False).fetchone()
+        result = {"version": version.values()[0] if version else None,
+                  "size":    os.path.getsize(self.filename),
+                  "mtime":   os.path.getmtime(self.filename)}
+        last = self.change_state or {}
+        if all(last.get(k) == v for k, v in result.items()):
+            result.update(tables=last["tables"], edited=last["edited"])
+            return result
+        result.update(tables={}, edited=0)
+        sql_edited = ", MAX(edited_timestamp) AS edited" if "edited_timestamp" \
+                     in self.tables.get("messages", {}).get("sql", "") else ""
+        for table in self.execute("SELECT name FROM sqlite_master "
+                                  "WHERE type = 'table'", log=False).fetchall():
+            name = table["name"]
+            sql = "SELECT MAX(rowid) AS id%s FROM %s" % (sql_edited if
+                  "messages" == name.lower() else ", COUNT(*) AS count", name)
+            try: row = self.execute(sql, log=False).fetchone()
+            except sqlite3.DatabaseError: continue # for table, if no rowid
+            result["tables"][name.lower()] = [row["id"] or 0, row.get("count")]
+            if "messages" == name.lower():
+                result["edited"] = row.get("edited") or 0
+        return result
+
+
+    def detect_changes(self):
+        """
+        Returns what has changed in the database since last check, like
+        by a running Skype instance, comparing PRAGMA data_version, file size
+        and modification time, maximum rowid and row count per table,
+        and maximum message edited_timestamp for messages edited or removed
+        in place. The first call only stores current state as baseline.
+        Can take long for large tables: meant to run in a background thread,
+        with the result given to refresh_changes() in the main thread.
+
+        @return  {"added":   {"tablename": maximum rowid before new rows, },
+                  "changed": ["tablename" with rows updated or deleted, ],
+                  "edited":  {chat ID: [ID of message edited in place, ]},
+                  "schema":  whether tables were created or dropped},
+                 or None if nothing changed
+        """
+        if not self.is_open() or self.immutable or self.snapshot \
+        or self.in_batch:
+            return None
+        last, state = self.change_state, self.get_change_state()
+        self.change_state = state
+        if not last or last["tables"] is state["tables"]:
+            return None
+        result = {"added": {}, "changed": [], "edited": {}, "schema": False}
+        for name in set(last["tables"]) | set(state["tables"]):
+            if name not in last["tables"] or name not in state["tables"]:
+                result["changed"].append(name)
+                result["schema"] = True
+                continue # for name
+            (max1, count1), (max2, count2) = last["tables"][name], \
+                                             state["tables"][name]
+            if (max1, count1) == (max2, count2):
+                continue # for name
+            if max2 > max1:
+                added = None
+                if count2 is not None:
+                    added = self.execute("SELECT COUNT(*) AS count FROM %s "
+                                         "WHERE rowid > ?" % name, [max1],
+                                         log=False).fetchone()["count"]
+                if count2 is None or count2 - count1 == added:
+                    result["added"][name] = max1
+                    continue # for name
+            result["changed"].append(name)
+        if state["edited"] > last["edited"] and "messages" in last["tables"] \
+        and "messages" not in result["changed"]: # Only older rows are edited
+            for row in self.execute("SELECT id, convo_id FROM messages "
+                                    "WHERE id <= ? AND edited_timestamp > ?",
+                                    [last["tables"]["messages"][0],
+                                     last["edited"]], log=False):
+                ids = result["edited"].setdefault(row["convo_id"], [])
+                ids.append(row["id"])
+        if not result["added"] and not result["changed"] \
+        and not result["edited"]:
+            result = None
+        return result
+
+
+    def refresh_changes(self, changes=None):
+        """
+        Refreshes only the cached data affected by changes in the database:
+        new messages are appended to cached chat messages and added to chat
+        statistics, cached messages of chats with edited messages are
+        dropped, as are rows of other changed tables, to be reloaded on
+        next access. Registered consumers are notified with
+        consumer.on_database_changed(db, changes).
+
+        @param   changes  change set from detect_changes() if already
+                          detected, like in a background thread,
+                          detected here if not given
+        @return           change set from detect_changes(), with "reloaded"
+                          as ["tablename" dropped from cache, ] and "chats"
+                          as [ID of chat with new messages, ],
+                          or None if no changes
+        """
+        changes = self.detect_changes() if changes is None else changes
+        if not changes or not self.is_open() or not self.change_state:
+            return None
+        main.log("Detected changes in %s: %s.", self.filename, ", ".join(
+                 sorted(set(changes["added"]) | set(changes["changed"]) |
+                        set(["messages"] if changes["edited"] else []))))
+        if changes["schema"]:
+            self.tables.clear()
+            for row in self.execute("SELECT name, sql FROM sqlite_master "
+                                    "WHERE type = 'table'", log=False):
+                self.tables[row["name"].lower()] = row
+        reloaded = set(changes["added"]) | set(changes["changed"])
+        reloaded.discard("messages")
+        if reloaded & set(["contacts", "participants"]):
+            reloaded.add("conversations") # Chats include participants
+        if "messages" in changes["changed"]:
+            self.message_cache.clear()
+            reloaded.add("conversations") # Drop now invalid statistics
+        for convo_id, ids in changes["edited"].items():
+            self.message_cache.pop(("messages", convo_id))
+            for message_id in ids:
+                self.message_cache.pop(("dom", message_id))
+        for table in reloaded:
+            for cache in self.table_rows, self.table_objects, \
+                         self.table_indexes:
+                cache.pop(table, None)
+        changes["reloaded"] = sorted(reloaded)
+        changes["chats"] = []
+        if "messages" in changes["added"]:
+            changes["chats"] = self.update_new_messages(
+                changes["added"]["messages"],
+                self.change_state["tables"]["messages"][0])
+        if changes["schema"]:
+            self.get_tables(True)
+        for table in self.tables_list or []:
+            name = table["name"].lower()
+            if name not in changes["added"] and name not in changes["changed"]:
+                continue # for table
+            max_id, count = self.change_state["tables"].get(name, [0, 0])
+            if count is None and not table.get("rows_estimated") \
+            and name in changes["added"]: # Messages are not counted in state
+                count = table["rows"] + self.execute("SELECT COUNT(*) AS "
+                    "count FROM messages WHERE id > ? AND id <= ?",
+                    [changes["added"][name], max_id], log=False
+                ).fetchone()["count"]
+            if count is not None:
+                table["rows"], table["rows_estimated"] = count, False
+            else: # Rows deleted from uncounted table, count is now stale
+                table["rows_estimated"] = True
+        for consumer in list(self.consumers):
+            if hasattr(consumer, "on_database_changed"):
+                consumer.on_database_changed(self, changes)
+        return changes
+
+
+    def update_new_messages(self, from_id, to_id):
+        """
+        Appends new messages to cached chat messages, and updates statistics
+        of cached chats, and their activity timestamps.
+
+        @param   from_id  maximum message ID before new messages
+        @param   to_id    maximum message ID after new messages
+        @return           [ID of chat with new messages, ]
+        """
+        lazy = {"datetime": self.message_datetime}
+        rows = self.execute("SELECT m.*, NULL AS datetime FROM messages m "
+                            "WHERE m.id > ? AND m.id <= ? AND m.type IN (%s) "
+                            "ORDER BY m.timestamp" %
+                            ", ".join(map(str, MESSAGE_TYPES_MESSAGE)),
+                            [from_id, to_id],
+                            row_factory=MessageRow.factory(lazy)).fetchall()
+        messages = {} # {convo_id: [message, ]}
+        for m in rows:
+            messages.setdefault(m["convo_id"], []).append(m)
+        for convo_id, new in messages.items():
+            cachekey = ("messages", convo_id)
+            cached = cachekey in self.message_cache and \
+                     self.message_cache.pop(cachekey)
+            if cached: # Rows with all columns have any requested projection
+                projection, messages_all = cached[0], cached[1] + new
+                self.message_cache.set(cachekey, (projection, messages_all),
+                                       MessageRow.estimate_size(messages_all))
+
+        chats = dict((c["id"], c) for c in
+                     self.table_rows.get("conversations") or [])
+        ids = [x for x in messages if x in chats]
+        for i in range(0, len(ids), 999): # Max SQLite host parameters
+            chunk = ids[i:i + 999]
+            for row in self.execute("SELECT * FROM conversations WHERE id IN "
+                                    "(%s)" % ", ".join(["?"] * len(chunk)),
+                                    chunk, log=False):
+                chat = chats[row["id"]]
+                chat.update(row)
+                for k, v in [("creation_timestamp", "created_datetime"),
+                ("last_activity_timestamp", "last_activity_datetime")]:
+                    chat[v] = self.stamp_to_date(chat[k]) if chat[k] else None
+        for convo_id in ids:
+            chat = chats[convo_id]
+            if chat.get("message_count") is None:
+                continue # for convo_id, statistics not collected
+            stamps = [m["timestamp"] for m in messages[convo_id]
+                      if m["type"] in MESSAGE_TYPES_STATS]
+            if not stamps:
+                continue # for convo_id
+            chat["message_count"] += len(stamps)
+            for n, func in [("first_message", min), ("last_message", max)]:
+                value = func(filter(None, [chat[n + "_timestamp"]]) + stamps)
+                chat[n + "_timestamp"] = value
+                chat[n + "_datetime"] = self.stamp_to_date(value) \
+                                        if value else None
+        return sorted(messages)
 
 
     def update_accountinfo(self, log_error=True):
@@ -264,14 +675,30 @@ class SkypeDatabase(object):
 
 
     def stamp_to_date(self, timestamp):
-        """Converts the UNIX timestamp to datetime using localtime."""
-        return datetime.datetime.fromtimestamp(timestamp)
+        """
+        Converts the UNIX timestamp to datetime using localtime, memoizing
+        conversions as timestamps repeat heavily across chats and messages.
+        """
+        result = self.stamp_cache.get(timestamp)
+        if result is None:
+            if len(self.stamp_cache) >= self.STAMP_CACHE_SIZE:
+                self.stamp_cache.clear()
+            result = datetime.datetime.fromtimestamp(timestamp)
+            self.stamp_cache[timestamp] = result
+        return result
+
+
+    def message_datetime(self, message):
+        """Returns message timestamp as datetime, or None if no timestamp."""
+        timestamp = message["timestamp"]
+        return self.stamp_to_date(timestamp) if timestamp else None
 
 
     def register_consumer(self, consumer):
         """
-        Registers a consumer with the database, notified on clearing cache by
-        consumer.on_database_changed().
+        Registers a consumer with the database, notified on detected changes
+        by consumer.on_database_changed(db, changes), if implemented,
+        see refresh_changes().
         """
         self.consumers.add(consumer)
 
@@ -289,6 +716,14 @@ class SkypeDatabase(object):
 
     def close(self):
         """Closes the database and frees all allocated data."""
+        if getattr(self, "message_cache", None) is not None:
+            if self.message_cache.hits or self.message_cache.misses:
+                main.log("Message cache for %s: %s.", self.filename,
+                         self.message_cache)
+            self.message_cache.clear()
+        if conf.LogSQL and getattr(self, "statement_misses", None):
+            main.log("Statement cache for %s: %s hits, %s misses.",
+                     self.filename, self.statement_hits, self.statement_misses)
         if hasattr(self, "connection"):
             try:
                 self.connection.close()
@@ -296,35 +731,317 @@ class SkypeDatabase(object):
                 pass
             del self.connection
             self.connection = None
-        for attr in ["tables", "tables_list", "table_rows", "table_objects"]:
+        self.attached.clear()
+        with self.connection_lock:
+            for _, connection in self.read_connections.values():
+                try: connection.close()
+                except Exception: pass
+            self.read_connections.clear()
+        if "file" == self.snapshot and self.snapshot_path:
+            try: os.unlink(self.snapshot_path)
+            except Exception: pass
+            self.snapshot_path = None
+        for attr in ["tables", "tables_list", "table_rows", "table_objects",
+                     "table_indexes"]:
             if hasattr(self, attr):
                 delattr(self, attr)
                 setattr(self, attr, None if ("tables_list" == attr) else {})
 
 
-    def execute(self, sql, params=[], log=True):
-        """Shorthand for self.connection.execute()."""
+    def make_uri(self):
+        """
+        Returns a read-only URI filename for the database file, with
+        immutable=1 if database opened as immutable, or None if SQLite
+        does not support URI filenames.
+        """
+        if SkypeDatabase.URI_SUPPORTED is None:
+            connection = sqlite3.connect(":memory:")
+            options = connection.execute("PRAGMA compile_options").fetchall()
+            connection.close()
+            SkypeDatabase.URI_SUPPORTED = any("USE_URI" in x[0]
+                                              for x in options)
+        if not SkypeDatabase.URI_SUPPORTED:
+            return None
+        path = os.path.abspath(self.filename)
+        if isinstance(path, unicode): path = path.encode("utf-8")
+        return "file:%s?mode=ro%s" % (urllib.pathname2url(path),
+                                      "&immutable=1" if self.immutable else "")
+
+
+    def make_connection(self, readonly=False):
+        """
+        Returns a new connection to the database file, or to the snapshot
+        if any, usable from any thread.
+
+        @param   readonly  whether to open the file read-only, via URI
+                           mode=ro if SQLite supports URI filenames,
+                           or by setting the connection query-only otherwise;
+                           read-only connections get conf.ReadOnlyCacheSize,
+                           conf.ReadOnlyMmapSize and conf.ReadOnlyTempStore
+        """
+        filename, use_uri = self.snapshot_path or self.filename, False
+        if readonly and not self.snapshot_path:
+            uri = self.make_uri()
+            if uri: filename, use_uri = uri, True
+        result = sqlite3.connect(filename, check_same_thread=False)
+        result.set_progress_handler(CancelToken.on_progress,
+                                    CancelToken.PROGRESS_STEPS)
+        if readonly and not use_uri:
+            result.execute("PRAGMA query_only = ON")
+        if readonly:
+            for name, value in [("cache_size", conf.ReadOnlyCacheSize),
+                                ("mmap_size",  conf.ReadOnlyMmapSize),
+                                ("temp_store", conf.ReadOnlyTempStore)]:
+                if value is None: continue # for name, value
+                try: result.execute("PRAGMA %s = %s" % (name, value))
+                except Exception:
+                    main.log("Error setting PRAGMA %s = %s for %s.\n\n%s",
+                             name, value, self.filename,
+                             traceback.format_exc())
+        result.row_factory = self.row_factory
+        result.text_factory = str
+        return result
+
+
+    def make_snapshot(self, progress=None):
+        """
+        Copies the database into a private in-memory or temporary file
+        database, as set in self.snapshot, and returns a query-only
+        connection to the copy, which all further connections will use.
+
+        Everything is copied in a single read transaction, giving a
+        consistent view even if the file is being changed meanwhile, like
+        the main.db of a running Skype. Tables are copied in chunks of rows,
+        with original rowids. In-memory snapshot requires SQLite with URI
+        filename support, falling back to a temporary file otherwise.
+
+        @param   progress  callback(count, total) invoked after each chunk,
+                           with the number of rows copied and rows in total
+        @return            connection to the snapshot, keeping it alive
+        """
+        CHUNK = 10000
+        uri, start = self.make_uri(), time.time()
+        if "memory" == self.snapshot and uri:
+            self.snapshot_path = "file:skyperious-snapshot-%s?mode=memory&" \
+                                 "cache=shared" % id(self)
+        else:
+            self.snapshot = "file"
+            fh, self.snapshot_path = tempfile.mkstemp(".db", "skyperious-")
+            os.close(fh)
+        result = self.make_connection()
+        result.isolation_level = None # Transaction is handled explicitly
+        try:
+            result.execute("ATTACH DATABASE ? AS source",
+                           [uri or self.filename])
+            result.execute("BEGIN")
+            items = result.execute("SELECT type, name, sql FROM "
+                                   "source.sqlite_master WHERE sql NOT NULL "
+                                   "ORDER BY type != 'table', rowid"
+                                  ).fetchall()
+            tables = [x["name"] for x in items if "table" == x["type"]
+                      and not x["name"].startswith("sqlite_")]
+            total = sum(result.execute("SELECT COUNT(*) AS count FROM "
+                                       "source.%s" % t).fetchone()["count"]
+                        for t in tables)
+            count = 0
+            for item in items:
+                if "table" != item["type"] or item["name"] not in tables:
+                    continue # for item
+                result.execute(item["sql"])
+                rows = result.execute("PRAGMA source.table_info(%s)" %
+                                      item["name"]).fetchall()
+                cols = ", ".join(["rowid"] + [x["name"] for x in rows])
+                sql = "INSERT INTO main.%s (%s) SELECT %s FROM source.%s " \
+                      "WHERE rowid > ? ORDER BY rowid LIMIT %s" % \
+                      (item["name"], cols, cols, item["name"], CHUNK)
+                maxid = -sys.maxint
+                while True:
+                    cursor = result.execute(sql, [maxid])
+                    if cursor.rowcount <= 0:
+                        break # break while True
+                    count += cursor.rowcount
+                    maxid = result.execute("SELECT MAX(rowid) AS id FROM "
+                                           "main.%s" % item["name"]
+                                          ).fetchone()["id"]
+                    if progress: progress(count, total)
+            for item in items: # Indexes, views and triggers after data
+                if "table" != item["type"]:
+                    result.execute(item["sql"])
+            names = [x["name"] for x in items]
+            if "sqlite_sequence" in names:
+                result.execute("DELETE FROM main.sqlite_sequence")
+                result.execute("INSERT INTO main.sqlite_sequence "
+                               "SELECT * FROM source.sqlite_sequence")
+            if "sqlite_stat1" in names:
+                result.execute("ANALYZE main.sqlite_master") # Creates table
+                result.execute("DELETE FROM main.sqlite_stat1")
+                result.execute("INSERT INTO main.sqlite_stat1 "
+                               "SELECT * FROM source.sqlite_stat1")
+            result.execute("COMMIT")
+            result.execute("DETACH DATABASE source")
+            result.execute("PRAGMA query_only = ON")
+            result.isolation_level = ""
+        except Exception:
+            try: result.close()
+            except Exception: pass
+            if "file" == self.snapshot:
+                try: os.unlink(self.snapshot_path)
+                except Exception: pass
+            self.snapshot_path = None
+            raise
+        main.log("Copied %s from %s into %s snapshot in %.2f seconds.",
+                 util.plural("row", count), self.filename,
+                 "memory" if "memory" == self.snapshot else "temporary file",
+                 time.time() - start)
+        return result
+
+
+    def is_read_sql(self, sql):
+        """
+        Returns whether the SQL statement is known to only read the database,
+        ignoring leading comments, and can run in a separate connection.
+        Statements not recognized are not reads, nor are statements naming
+        a schema attached in the writer connection.
+        """
+        sql = self.COMMENT_RGX.sub("", sql or "")
+        if self.READ_WITH_RGX.match(sql):
+            result = not self.WRITE_WORD_RGX.search(sql)
+        else:
+            result = bool(self.READ_RGX.match(sql)
+                          or self.READ_PRAGMA_RGX.match(sql))
+        if result and self.attached:
+            rgx = r"\b(%s)\s*\." % "|".join(map(re.escape, self.attached))
+            result = not re.search(rgx, sql, re.I)
+        return result
+
+
+    def get_connection(self, sql=None, writer=False):
+        """
+        Returns the connection to use for the SQL statement in the current
+        thread: the thread's own read-only connection, created on first use
+        and kept until the database or thread is closed, for statements
+        known to only read the database, in threads other than the one that
+        opened the database or inside begin_batch(); otherwise the writer
+        connection.
+
+        @param   writer  if True, always returns the writer connection
+        """
+        ident = threading.current_thread().ident
+        if not self.connection or writer or ident in (self.owner_thread,
+                                                      self.batch_thread) \
+        or not self.is_read_sql(sql):
+            return self.connection
+        with self.connection_lock:
+            item = self.read_connections.get(ident)
+            if not item:
+                for k, (t, c) in self.read_connections.items():
+                    if not t.is_alive(): # Drop connections of ended threads
+                        try: c.close()
+                        except Exception: pass
+                        self.read_connections.pop(k)
+                item = (threading.current_thread(),
+                        self.make_connection(readonly=True))
+                self.read_connections[ident] = item
+        return item[1]
+
+
+    def execute(self, sql, params=[], log=True, row_factory=None,
+                writer=False):
+        """
+        Shorthand for connection.execute(), in the connection for current
+        thread from get_connection(). The statement can be aborted via
+        the CancelToken of current thread.
+
+        @param   row_factory  cursor row factory to use instead of the
+                              connection's, if any
+        @param   writer       if True, executes in the writer connection
+                              regardless of statement and thread
+        """
         result = None
-        if self.connection:
+        connection = self.get_connection(sql, writer)
+        if connection:
             if log and conf.LogSQL:
                 main.log("SQL: %s%s", sql,
                          ("\nParameters: %s" % params) if params else "")
-            result = self.connection.execute(sql, params)
+            token = CancelToken.current()
+            if token.interrupted:
+                raise KeyboardInterrupt()
+            token.begin(sql)
+            try:
+                if row_factory:
+                    result = connection.cursor()
+                    result.row_factory = row_factory
+                    result.execute(sql, params)
+                else:
+                    result = connection.execute(sql, params)
+            except sqlite3.OperationalError:
+                if token.interrupted:
+                    raise KeyboardInterrupt()
+                raise
+            if connection is self.connection:
+                self.track_attach(sql)
         return result
 
 
+    def track_attach(self, sql):
+        """
+        Registers the schema of an ATTACH or DETACH statement executed in the
+        writer connection, for routing statements naming the schema to the
+        writer connection.
+        """
+        sql = self.COMMENT_RGX.sub("", sql)
+        match = self.ATTACH_RGX.match(sql)
+        if match:
+            self.attached.add(match.group(2).lower())
+        match = not match and self.DETACH_RGX.match(sql)
+        if match:
+            self.attached.discard(match.group(2).lower())
+
+
     def execute_action(self, sql):
         """
-        Executes the specified SQL INSERT/UPDATE/DELETE statement and returns
-        the number of affected rows.
+        Executes the specified SQL INSERT/UPDATE/DELETE statement in the
+        writer connection and returns the number of affected rows.
         """
         self.ensure_backup()
-        res = self.execute(sql)
+        res = self.execute(sql, writer=True)
         affected_rows = res.rowcount
         self.connection.commit()
         return affected_rows
 
 
+    def begin_batch(self):
+        """
+        Starts a transaction spanning several insert calls, committed only
+        in end_batch(). Each insert_messages() call runs in its own savepoint
+        and is rolled back on error.
+        """
+        if self.is_open() and not self.in_batch:
+            self.connection.commit()
+            # Manual transaction control, as Python sqlite3 module would
+            # otherwise commit before SAVEPOINT and RELEASE statements.
+            self.connection.isolation_level = None
+            self.batch_thread = threading.current_thread().ident
+            self.execute("BEGIN")
+            self.in_batch = True
+
+
+    def end_batch(self):
+        """Commits the transaction started in begin_batch()."""
+        if self.is_open() and self.in_batch:
+            self.connection.commit()
+            self.connection.isolation_level = ""
+            self.in_batch = False
+            self.batch_thread = None
+            self.last_modified = datetime.datetime.now()
+
+
+    def commit(self):
+        """Commits pending changes, unless inside begin_batch() transaction."""
+        if not self.in_batch:
+            self.connection.commit()
+
+
     def check_future_dates(self):
         """
         Checks whether any messages in the database have a timestamp in the
@@ -375,13 +1092,17 @@ class SkypeDatabase(object):
     def get_tables(self, refresh=False, this_table=None):
         """
         Returns the names and rowcounts of all tables in the database, as
-        [{"name": "tablename", "rows": 0, "sql": CREATE SQL}, ].
+        [{"name": "tablename", "rows": 0, "rows_estimated": False,
+          "sql": CREATE SQL}, ].
         Uses already retrieved cached values if possible, unless refreshing.
+        Row counts not in statistics cache are not counted here: they are
+        estimated from sqlite_stat1 if available, or None if unknown, with
+        "rows_estimated" set, to be counted later with count_tables().
 
         @param   refresh     if True, information including rowcounts is
                              refreshed
         @param   this_table  if set, only information for this table is
-                             refreshed
+                             refreshed, counting its rows
         """
         if self.is_open() and (refresh or self.tables_list is None):
             sql = "SELECT name, sql FROM sqlite_master WHERE type = 'table' " \
@@ -391,12 +1112,38 @@ class SkypeDatabase(object):
             rows = self.execute(sql, params).fetchall()
             tables = {}
             tables_list = []
+            cached, from_id, state, estimates = None, None, None, {}
+            if conf.StatisticsCacheEnabled and not this_table:
+                state = self.stats_cache.get_file_state()
+                if not refresh:
+                    cached, from_id = self.stats_cache.lookup("tables", state)
+            if not this_table and any("sqlite_stat1" == x["name"]
+                                      for x in rows):
+                estimates = self.get_table_estimates()
             for row in rows:
                 table = row
+                name = table["name"].lower()
                 try:
-                    res = self.execute("SELECT COUNT(*) AS count FROM %s" %
-                                       table["name"], log=False)
-                    table["rows"] = res.fetchone()["count"]
+                    table["rows_estimated"] = False
+                    if cached and name in cached and (not from_id
+                    or "messages" == name):
+                        table["rows"] = cached[name]
+                        if from_id: # Only new messages have been added
+                            table["rows"] += self.execute("SELECT COUNT(*) "
+                                "AS count FROM messages WHERE id > ? AND "
+                                "id <= ?", [from_id, state["max_id"]],
+                                log=False).fetchone()["count"]
+                    elif not this_table:
+                        table["rows"] = estimates.get(name)
+                        table["rows_estimated"] = True
+                    else:
+                        sql, params = "SELECT COUNT(*) AS count FROM %s" % \
+                                      table["name"], []
+                        if state and "messages" == name: # Match cached state
+                            sql, params = sql + " WHERE id <= ?", \
+                                          [state["max_id"]]
+                        res = self.execute(sql, params, log=False)
+                        table["rows"] = res.fetchone()["count"]
                 except sqlite3.DatabaseError:
                     table["rows"] = 0
                     main.log("Error getting %s row count for %s.\n\n%s",
@@ -405,6 +1152,11 @@ class SkypeDatabase(object):
                 # lowercase when used as keys.
                 tables[table["name"].lower()] = table
                 tables_list.append(table)
+            if state and (cached is None or from_id) \
+            and not any(x["rows_estimated"] for x in tables_list):
+                self.stats_cache.store("tables", dict((k, v["rows"])
+                                       for k, v in tables.items()), state)
+            self.statements.clear() # Columns may have changed
             if this_table:
                 self.tables.update(tables)
                 for t in self.tables_list or []:
@@ -421,13 +1173,79 @@ class SkypeDatabase(object):
         return self.tables_list
 
 
-    def get_general_statistics(self, full=True):
+    def get_table_estimates(self):
+        """
+        Returns table row counts estimated from sqlite_stat1, as
+        {"tablename": count}, as of the last ANALYZE.
+        """
+        result = {}
+        try:
+            for row in self.execute("SELECT tbl, stat FROM sqlite_stat1",
+                                    log=False):
+                count = util.to_int((row["stat"] or "").split(" ")[0])
+                name = (row["tbl"] or "").lower()
+                if count is not None and count > result.get(name, -1):
+                    result[name] = count
+        except sqlite3.DatabaseError:
+            main.log("Error reading table statistics from %s.\n\n%s",
+                     self.filename, traceback.format_exc())
+        return result
+
+
+    def count_tables(self, callback=None):
         """
-        Get up-to-date general statistics raw from the database.
+        Counts exact rows for tables with estimated or unknown row counts,
+        updating tables metadata, and storing all row counts in statistics
+        cache if completed. Can take long for large tables: meant to run
+        in a background thread.
 
-        @param   full  whether to return full statistics, or only tables
-                       and last chat
+        @param   callback  function(table) invoked after each counted table,
+                           returning False stops counting
+        """
+        state = None
+        if conf.StatisticsCacheEnabled:
+            state = self.stats_cache.get_file_state()
+        for table in list(self.tables_list or []):
+            if not table.get("rows_estimated"):
+                continue # for table
+            sql, params = "SELECT COUNT(*) AS count FROM %s" % \
+                          table["name"], []
+            if state and "messages" == table["name"].lower(): # Match state
+                sql, params = sql + " WHERE id <= ?", [state["max_id"]]
+            try:
+                rows = self.execute(sql, params, log=False).fetchone()["count"]
+            except sqlite3.DatabaseError:
+                if CancelToken.current().cancelled:
+                    break # break for table
+                main.log("Error getting %s row count for %s.\n\n%s",
+                         table["name"], self.filename, traceback.format_exc())
+                continue # for table
+            table["rows"], table["rows_estimated"] = rows, False
+            if callback and callback(table) is False:
+                break # break for table
+        else:
+            tables = self.tables_list or []
+            if state and tables and not any(x.get("rows_estimated")
+                                            for x in tables):
+                self.stats_cache.store("tables", dict((x["name"].lower(),
+                                       x["rows"]) for x in tables), state)
+
+
+    def get_general_statistics(self):
+        """
+        Get up-to-date general statistics from the database, from cache
+        if database file has not changed since. Message counts, and first
+        and last message, are taken in a single pass over all messages.
         """
+        state = None
+        if conf.StatisticsCacheEnabled:
+            state = self.stats_cache.get_file_state()
+            cached, from_id = self.stats_cache.lookup("general", state)
+            if cached is not None and not from_id:
+                result = collections.defaultdict(str)
+                result.update(cached)
+                return result
+
         result = collections.defaultdict(str)
         if self.account:
             result.update({"name": self.account.get("name"),
@@ -437,54 +1255,51 @@ class SkypeDatabase(object):
             res = self.execute("SELECT COUNT(*) AS count FROM %s" % table)
             result[k] = next(res, {}).get("count")
 
+        # First and last message are found as MIN and MAX of timestamp and ID
+        # packed into one integer, giving the message ID in the same pass.
+        maxid = self.execute("SELECT MAX(id) AS id FROM Messages").fetchone()
+        bits = max(1, maxid["id"] or 0).bit_length()
         typestr = ", ".join(map(str, MESSAGE_TYPES_BASE))
-        res = self.execute("SELECT m.*, COALESCE(NULLIF(c.displayname, ''), "
-            "NULLIF(c.meta_topic, '')) AS chat_title, c.type AS chat_type "
-            "FROM Messages m LEFT JOIN Conversations c ON m.convo_id = c.id "
-            "WHERE m.type IN (%s) ORDER BY m.timestamp DESC LIMIT 1" % typestr)
-        msg_last = next(res, None)
-        if msg_last:
-            if msg_last.get("timestamp"):
-                dt = self.stamp_to_date(msg_last["timestamp"])
-                result["lastmessage_dt"] = dt.strftime("%Y-%m-%d %H:%M")
-            result["lastmessage_from"] = msg_last["from_dispname"]
-            result["lastmessage_skypename"] = msg_last["author"]
-            title = ('"%s"' if CHATS_TYPE_SINGLE != msg_last["chat_type"]
-                     else "chat with %s") % msg_last["chat_title"]
-            result["lastmessage_chat"] = title
-            result["lastmessage_chattype"] = msg_last["chat_type"]
-        if not full:
-            return result
-
-        res = self.execute("SELECT m.*, COALESCE(NULLIF(c.displayname, ''), "
-            "NULLIF(c.meta_topic, '')) AS chat_title, c.type AS chat_type "
-            "FROM Messages m LEFT JOIN Conversations c ON m.convo_id = c.id "
-            "WHERE m.type IN (%s) ORDER BY m.timestamp ASC LIMIT 1"
-            % typestr)
-        msg_first = next(res, None)
-        if msg_first:
-            if msg_first.get("timestamp"):
-                dt = self.stamp_to_date(msg_first["timestamp"])
-                result["firstmessage_dt"] = dt.strftime("%Y-%m-%d %H:%M")
-            result["firstmessage_from"] = msg_first["from_dispname"]
-            result["firstmessage_skypename"] = msg_first["author"]
-            title = ('"%s"' if CHATS_TYPE_SINGLE != msg_first["chat_type"]
-                     else "chat with %s") % msg_first["chat_title"]
-            result["firstmessage_chat"] = title
-            result["firstmessage_chattype"] = msg_first["chat_type"]
-
-        for i in range(2):
-            row = self.execute("SELECT COUNT(*) AS count FROM Messages "
-                "WHERE author %s= :skypename AND type IN (%s)"
-                % ("!="[i], typestr), result).fetchone()
-            result["messages_" + ("to", "from")[i]] = row["count"]
-
+        row = self.execute("SELECT "
+            "COALESCE(SUM(author = :skypename), 0) AS messages_from, "
+            "COALESCE(SUM(author != :skypename), 0) AS messages_to, "
+            "MIN((timestamp << %(bits)s) + id) AS first_key, "
+            "MAX((timestamp << %(bits)s) + id) AS last_key "
+            "FROM Messages WHERE type IN (%(types)s)"
+            % {"types": typestr, "bits": bits},
+            {"skypename": result["skypename"]}).fetchone()
+        result.update(messages_from=row["messages_from"],
+                      messages_to=row["messages_to"])
+
+        for n, key in [("first", row["first_key"]), ("last", row["last_key"])]:
+            if key is None:
+                continue # for n, key
+            msg = self.execute("SELECT m.*, COALESCE(NULLIF(c.displayname, "
+                "''), NULLIF(c.meta_topic, '')) AS chat_title, "
+                "c.type AS chat_type FROM Messages m "
+                "LEFT JOIN Conversations c ON m.convo_id = c.id "
+                "WHERE m.id = :id",
+                {"id": key & ((1 << bits) - 1)}).fetchone()
+            if not msg:
+                continue # for n, key
+            if msg.get("timestamp"):
+                dt = self.stamp_to_date(msg["timestamp"])
+                result[n + "message_dt"] = dt.strftime("%Y-%m-%d %H:%M")
+            result[n + "message_from"] = msg["from_dispname"]
+            result[n + "message_skypename"] = msg["author"]
+            title = ('"%s"' if CHATS_TYPE_SINGLE != msg["chat_type"]
+                     else "chat with %s") % msg["chat_title"]
+            result[n + "message_chat"] = title
+            result[n + "message_chattype"] = msg["chat_type"]
+
+        if state:
+            self.stats_cache.store("general", dict(result), state)
         return result
 
 
     def get_messages(self, chat=None, ascending=True,
                      additional_sql=None, additional_params=None,
-                     timestamp_from=None, use_cache=True):
+                     timestamp_from=None, use_cache=True, projection=None):
         """
         Yields all the messages (or messages for the specified chat), as
         {"datetime": datetime, ..}, ordered from earliest to latest.
@@ -499,13 +1314,29 @@ class SkypeDatabase(object):
         @param   timestamp_from     timestamp beyond which messages will start
         @param   use_cache          whether to use cached values if available.
                                     The LIKE keywords will be ignored if True.
+        @param   projection         name of column set in MESSAGE_PROJECTIONS
+                                    to retrieve, instead of all columns
         """
         if self.is_open() and "messages" in self.tables:
-            if "messages" not in self.table_rows:
-                self.table_rows["messages"] = {} # {convo_id: [{msg1},]}
-            if not use_cache \
-            or not (chat and chat["id"] in self.table_rows["messages"]):
-                sql, params = "SELECT m.* FROM messages m ", {}
+            cachekey, cached = ("messages", chat and chat["id"]), None
+            if chat and use_cache:
+                cached = self.message_cache.get(cachekey)
+            if cached: # Cached rows need to have all the requested columns
+                have = cached[0]
+                if have and not (projection and
+                set(self.MESSAGE_PROJECTIONS[projection]) <=
+                set(self.MESSAGE_PROJECTIONS[have])):
+                    cached = None
+            if not use_cache or not cached:
+                # Rows are MessageRow instances, with a placeholder column
+                # for datetime to avoid a separate dictionary for extra keys,
+                # computed from timestamp only if accessed.
+                columns = "m.*"
+                if projection:
+                    columns = ", ".join("m.%s" % x for x in
+                                        self.MESSAGE_PROJECTIONS[projection])
+                sql = "SELECT %s, NULL AS datetime FROM messages m " % columns
+                params = {}
                 if additional_sql and " c." in additional_sql:
                     sql += "LEFT JOIN conversations c ON m.convo_id = c.id "
                 # Take only known and supported types of messages.
@@ -522,24 +1353,27 @@ class SkypeDatabase(object):
                     params.update(additional_params or {})
                 sql += " ORDER BY m.timestamp %s" \
                     % ("ASC" if ascending else "DESC")
-                res = self.execute(sql, params)
+                lazy = {"datetime": self.message_datetime}
+                res = self.execute(sql, params,
+                                   row_factory=MessageRow.factory(lazy))
                 messages = []
                 message = res.fetchone()
                 while message:
-                    message["datetime"] = None
-                    if message["timestamp"]:
-                        message["datetime"] = self.stamp_to_date(
-                                              message["timestamp"])
                     if chat and use_cache and len(params) == 1:
                         messages.append(message)
                     yield message
                     message = res.fetchone()
                 if chat and use_cache and len(params) == 1:
                     # Only cache queries getting full range
-                    self.table_rows["messages"][chat["id"]] = messages
+                    size = MessageRow.estimate_size(messages)
+                    if self.message_cache.set(cachekey, (projection, messages),
+                                              size):
+                        main.log("Dropped least recently used chats from "
+                                 "message cache of %s: %s.", self.filename,
+                                 self.message_cache)
             else:
                 messages_sorted = sorted(
-                    self.table_rows["messages"][chat["id"]],
+                    cached[1],
                     key=lambda m: m["timestamp"], reverse=not ascending
                 )
                 if timestamp_from:
@@ -550,6 +1384,78 @@ class SkypeDatabase(object):
                     yield message
 
 
+    def get_message_page(self, chat, key=None, ascending=True,
+                         limit=MESSAGE_PAGE_SIZE, inclusive=False,
+                         projection=None):
+        """
+        Returns a page of chat messages following or preceding the key,
+        ordered from earliest to latest. Messages are keyed on (timestamp, id),
+        so any page is a direct seek instead of a scan from either end.
+
+        @param   chat        as returned by get_conversations()
+        @param   key         (timestamp, id) to start from, as from
+                             get_message_key(), or None to start from
+                             chat beginning or end
+        @param   ascending   whether to take messages after key (or from
+                             chat beginning) or before key (or from chat end)
+        @param   limit       maximum number of messages to return, if any
+        @param   inclusive   whether to include the message at key
+        @param   projection  name of column set in MESSAGE_PROJECTIONS
+                             to retrieve, instead of all columns
+        @return              [{"datetime": datetime, ..}, ]
+        """
+        result = []
+        if self.is_open() and "messages" in self.tables:
+            columns = "m.*"
+            if projection:
+                columns = ", ".join("m.%s" % x for x in
+                                    self.MESSAGE_PROJECTIONS[projection])
+            sql = ("SELECT %s, NULL AS datetime FROM messages m "
+                   "WHERE m.convo_id = :convo_id AND m.type IN (%s)" %
+                   (columns, ", ".join(map(str, MESSAGE_TYPES_MESSAGE))))
+            params = {"convo_id": chat["id"]}
+            if key:
+                op = "<>"[ascending]
+                sql += (" AND m.timestamp %s= :timestamp AND (m.timestamp %s "
+                        ":timestamp OR m.id %s%s :id)" %
+                        (op, op, op, "=" if inclusive else ""))
+                params.update(timestamp=key[0], id=key[1])
+            direction = "ASC" if ascending else "DESC"
+            sql += " ORDER BY m.timestamp %s, m.id %s" % (direction, direction)
+            if limit:
+                sql += " LIMIT %d" % limit
+            factory = MessageRow.factory({"datetime": self.message_datetime})
+            result = self.execute(sql, params, row_factory=factory).fetchall()
+            if not ascending:
+                result.reverse()
+        return result
+
+
+    def get_message_key(self, chat, message_id=None, date=None):
+        """
+        Returns the (timestamp, id) key for get_message_page(), for
+        the chat message with the specified ID, or for the position just before
+        the first message on or after the specified date.
+
+        @param   chat        as returned by get_conversations()
+        @param   message_id  ID of the message to seek to
+        @param   date        datetime.date to seek to
+        @return              (timestamp, id), or None if message not in chat
+        """
+        result = None
+        if message_id is not None:
+            row = self.execute("SELECT timestamp, id FROM messages "
+                               "WHERE id = :id AND convo_id = :convo_id",
+                               {"id": message_id, "convo_id": chat["id"]}
+                              ).fetchone()
+            if row:
+                result = (row["timestamp"], row["id"])
+        elif date:
+            # Keys compare by id on equal timestamps, message IDs start from 1
+            result = (int(time.mktime(date.timetuple())), 0)
+        return result
+
+
     def row_factory(self, cursor, row):
         """
         Creates dicts from resultset rows, with BLOB fields converted to
@@ -679,18 +1585,51 @@ class SkypeDatabase(object):
         stats = {}
         if self.is_open() and "messages" in self.tables:
             and_str, and_val = "", []
+            cached, from_id, state = None, None, None
             if chats and len(chats) == 1:
                 and_str = " AND convo_id in (%s)" % ", ".join(["?"]*len(chats))
                 and_val = [c["id"] for c in chats]
-            sql = ("SELECT convo_id AS id, COUNT(*) AS message_count, "
-                   "MIN(timestamp) AS first_message_timestamp, "
-                   "MAX(timestamp) AS last_message_timestamp, "
-                   "NULL AS first_message_datetime, "
-                   "NULL AS last_message_datetime "
-                   "FROM messages WHERE type IN (%s)%s GROUP BY convo_id" 
-                   % (", ".join(map(str, MESSAGE_TYPES_STATS)), and_str))
-            rows_stat = self.execute(sql, and_val).fetchall()
-            stats = dict((i["id"], i) for i in rows_stat)
+            elif conf.StatisticsCacheEnabled:
+                state = self.stats_cache.get_file_state()
+                cached, from_id = self.stats_cache.lookup("chats", state)
+                and_str, and_val = " AND id <= ?", [state["max_id"]]
+                if from_id: # Only new messages have been added
+                    and_str += " AND id > ?"
+                    and_val.append(from_id)
+            if cached is not None and not from_id:
+                rows_stat = []
+            else:
+                sql = ("SELECT convo_id AS id, COUNT(*) AS message_count, "
+                       "MIN(timestamp) AS first_message_timestamp, "
+                       "MAX(timestamp) AS last_message_timestamp "
+                       "FROM messages WHERE type IN (%s)%s GROUP BY convo_id"
+                       % (", ".join(map(str, MESSAGE_TYPES_STATS)), and_str))
+                rows_stat = self.execute(sql, and_val).fetchall()
+            if cached is not None: # Stored as {id: [count, first, last]}
+                stats = dict((int(k), dict(zip(["message_count",
+                    "first_message_timestamp", "last_message_timestamp"], v)))
+                    for k, v in cached.items())
+                main.log("Statistics %s from cache (%s).", "updated with "
+                         "messages after ID %s" % from_id if from_id
+                         else "loaded", self.filename)
+            for row in rows_stat:
+                data = stats.setdefault(row["id"], row)
+                if data is not row: # Merge new messages into cached values
+                    data["message_count"] += row["message_count"]
+                    data["first_message_timestamp"] = min(filter(None, [
+                        data["first_message_timestamp"],
+                        row["first_message_timestamp"]]) or [None])
+                    data["last_message_timestamp"] = max(
+                        data["last_message_timestamp"],
+                        row["last_message_timestamp"])
+            if state and (cached is None or from_id):
+                self.stats_cache.store("chats", dict((k, [
+                    v["message_count"], v["first_message_timestamp"],
+                    v["last_message_timestamp"]]) for k, v in stats.items()),
+                    state)
+            for data in stats.values():
+                data.update(first_message_datetime=None,
+                            last_message_datetime=None)
         for chat in chats:
             chat["message_count"] = 0
             if chat["id"] not in stats: continue # for chat in chats
@@ -798,6 +1737,7 @@ class SkypeDatabase(object):
         Returns all the SMSes in the database.
         Uses already retrieved cached values if possible.
         """
+        smses = []
         if self.is_open() and "smses" in self.tables:
             if "smses" not in self.table_rows:
                 rows = self.execute(
@@ -832,6 +1772,45 @@ class SkypeDatabase(object):
         return transfers
 
 
+    def get_smses_by_message_id(self, message_id):
+        """
+        Returns the SMSes linked to the specified chat message ID, using
+        an index built once over the cached SMSes rows.
+        """
+        if "smses" not in self.table_indexes:
+            self.table_indexes["smses"] = self.make_index(self.get_smses(),
+                                                          "chatmsg_id")
+        return self.table_indexes["smses"].get(message_id, [])
+
+
+    def get_transfers_by_guid(self, guid):
+        """
+        Returns the transfers linked to the specified chat message GUID,
+        using an index built once over the cached Transfers rows.
+        """
+        if "transfers" not in self.table_indexes:
+            self.table_indexes["transfers"] = self.make_index(
+                self.get_transfers(), "chatmsg_guid")
+        return self.table_indexes["transfers"].get(self.make_key(guid), [])
+
+
+    def make_index(self, rows, column):
+        """
+        Returns the rows grouped by the value in the specified column.
+
+        @return  {value: [row, ], }, with rows in original order
+        """
+        result = {}
+        for row in rows:
+            result.setdefault(self.make_key(row.get(column)), []).append(row)
+        return result
+
+
+    def make_key(self, value):
+        """Returns the value usable as a dictionary key, BLOBs as str."""
+        return str(value) if isinstance(value, buffer) else value
+
+
     def get_videos(self, chat=None):
         """
         Returns all valid video rows in the database (with a matching row in
@@ -982,41 +1961,202 @@ class SkypeDatabase(object):
 
 
     def ensure_backup(self):
-        """Creates a backup file if configured so, and not already created."""
-        if conf.DBDoBackup:
-            if (not self.backup_created
-            or not os.path.exists("%s.bak" % self.filename)):
-                shutil.copyfile(self.filename, "%s.bak" % self.filename)
-                self.backup_created = True
+        """
+        Creates a backup file if configured so, and not already created,
+        waiting for the backup to complete before returning.
+        """
+        if not conf.DBDoBackup:
+            return
+        self.start_backup()
+        thread = self.backup_thread
+        if thread:
+            if thread.is_alive():
+                main.status("Waiting for backup of %s to complete.", self)
+            thread.join()
+        if self.backup_error:
+            error, self.backup_error = self.backup_error, None
+            raise error
+
+
+    def start_backup(self):
+        """
+        Starts creating a backup file in a background thread, if configured
+        so, and not already created or in progress. Call before changes are
+        expected, e.g. when editing starts, to have the backup ready
+        by the time ensure_backup() is called.
+        """
+        if not conf.DBDoBackup or self.readonly:
+            return
+        with self.connection_lock:
+            if (self.backup_thread and self.backup_thread.is_alive()
+            or self.backup_created
+            and os.path.exists("%s.bak" % self.filename)):
+                return
+            self.backup_error = None
+            self.backup_thread = threading.Thread(target=self.copy_backup)
+            self.backup_thread.start()
 
 
-    def blobs_to_binary(self, values, list_columns, col_data):
+    def copy_backup(self):
         """
-        Converts blob columns in the list to sqlite3.Binary, suitable
-        for using as a query parameter.
+        Copies the database file to backup file, as a copy-on-write clone
+        if the filesystem supports it, otherwise in chunks with progress
+        shown in status bar. The copy is made inside a read transaction,
+        so that no changes can be committed to the file meanwhile, into
+        a temporary file renamed to backup filename once complete.
         """
-        result = []
-        is_dict = isinstance(values, dict)
-        list_values = [values[i] for i in list_columns] if is_dict else values
-        map_columns = dict([(i["name"], i) for i in col_data])
-        for i, val in enumerate(list_values):
-            if "blob" == map_columns[list_columns[i]]["type"].lower() and val:
-                if isinstance(val, unicode):
-                    val = val.encode("latin1")
-                val = sqlite3.Binary(val)
-            result.append(val)
-        if is_dict:
-            result = dict([(list_columns[i], x) for i, x in enumerate(result)])
+        CHUNK = 1024 * 1024
+        filename = "%s.bak" % self.filename
+        tempname = "%s.tmp" % filename
+        connection, start = None, time.time()
+        try:
+            connection = self.make_connection(readonly=True)
+            connection.isolation_level = None # Transaction is held explicitly
+            connection.execute("BEGIN")
+            connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+            cloned = util.clone_file(self.filename, tempname)
+            if not cloned:
+                total, count, last = os.path.getsize(self.filename), 0, 0
+                with open(self.filename, "rb") as f1:
+                    with open(tempname, "wb") as f2:
+                        for chunk in iter(lambda: f1.read(CHUNK), ""):
+                            f2.write(chunk)
+                            count += len(chunk)
+                            if time.time() - last > 1:
+                                main.status("Backing up %s, %d%% done.",
+                                            self, 100 * count / (total or 1))
+                                last = time.time()
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tempname, filename)
+            self.backup_created = True
+            main.logstatus("Created backup %s%s in %.2f seconds.", filename,
+                           " as copy-on-write clone" if cloned else "",
+                           time.time() - start)
+        except Exception as e:
+            self.backup_error = e
+            main.log("Error creating backup of %s.\n\n%s", self.filename,
+                     traceback.format_exc())
+            try: os.path.exists(tempname) and os.remove(tempname)
+            except Exception: pass
+        finally:
+            try: connection and connection.close() # Ends read transaction
+            except Exception: pass
+
+
+    def get_statement(self, key, build):
+        """
+        Returns statement data from statements cache, built with build()
+        and cached if not present. Cached statements keep the same SQL text
+        for the same table and columns, letting sqlite3 reuse its prepared
+        statements; the cache is cleared whenever tables are refreshed.
+
+        @param   key    cache key, like ("insert", "tablename", ..)
+        @param   build  function returning statement data
+        """
+        result = self.statements.get(key)
+        hit = result is not None
+        if hit:
+            self.statement_hits += 1
+        else:
+            result = self.statements[key] = build()
+            self.statement_misses += 1
+        if conf.LogSQL:
+            main.log("Statement cache %s for %s %s (%s hits, %s misses).",
+                     "hit" if hit else "miss", key[0], key[1],
+                     self.statement_hits, self.statement_misses)
         return result
 
 
-    def fill_missing_fields(self, data, fields):
-        """Creates a copy of the data and adds any missing fields."""
-        filled = data.copy()
-        for field in fields:
-            if field not in filled:
-                filled[field] = None
-        return filled
+    def make_row_converter(self, table, fields=None, default=None):
+        """
+        Returns INSERT SQL for the table and a function converting row data
+        to a parameter list for it, with column order and BLOB columns
+        resolved once instead of on every row. Cached in get_statement().
+
+        @param   fields   columns to insert, defaults to all except "id"
+        @param   default  value used for columns missing from row data
+        @return           ("INSERT INTO table ..", function(data, **overrides))
+        """
+        def build():
+            col_data = self.get_table_columns(table)
+            names = fields
+            if names is None:
+                names = [c["name"] for c in col_data if c["name"] != "id"]
+            blobs = set(c["name"] for c in col_data
+                        if "blob" == c["type"].lower())
+            blob_indexes = [i for i, f in enumerate(names) if f in blobs]
+            sql = "INSERT INTO %s (%s) VALUES (%s)" % \
+                  (table, ", ".join(names), ", ".join(["?"] * len(names)))
+
+            def convert(data, **overrides):
+                values = [overrides[f] if f in overrides
+                          else data.get(f, default) for f in names]
+                for i in blob_indexes:
+                    val = values[i]
+                    if val:
+                        if isinstance(val, unicode):
+                            val = val.encode("latin1")
+                        values[i] = sqlite3.Binary(val)
+                return values
+            return sql, convert
+
+        key = ("insert", table.lower(),
+               None if fields is None else tuple(fields), default)
+        return self.get_statement(key, build)
+
+
+    def make_key_converter(self, table, action, fields=None, rowid=False):
+        """
+        Returns UPDATE or DELETE SQL for one row in the table, identified by
+        its primary key, or by rowid, and a function converting row data to
+        a parameter list for it. Cached in get_statement().
+
+        @param   action  "update" or "delete"
+        @param   fields  columns to update, defaults to all
+        @param   rowid   whether row is identified by rowid, not primary key
+        @return          ("UPDATE table ..", function(data, key)), where key
+                         is rowid, or row data with original primary key
+                         values; SQL is None if table has no primary key
+                         and not using rowid
+        """
+        def build():
+            col_data = self.get_table_columns(table)
+            names = fields
+            if names is None:
+                names = [c["name"] for c in col_data]
+            pks = [] if rowid else [c["name"] for c in col_data if c["pk"]]
+            where = " AND ".join("%s IS ?" % x for x in pks)
+            if rowid:
+                where = "ROWID = ?"
+            if not where: # Sanity check: no primary key and no rowid
+                return None, None
+            if "update" == action:
+                sql = "UPDATE %s SET %s WHERE %s" % (table, ", ".join(
+                      "%s = ?" % x for x in names), where)
+            else:
+                sql, names = "DELETE FROM %s WHERE %s" % (table, where), []
+
+            def convert(data, key):
+                keys = [key] if rowid else [key[x] for x in pks]
+                return [data.get(x) for x in names] + keys
+            return sql, convert
+
+        key = (action, table.lower(),
+               None if fields is None else tuple(fields), rowid)
+        return self.get_statement(key, build)
+
+
+    def insert_batch(self, sql, rows, force=False):
+        """
+        Executes the INSERT for the accumulated rows and clears the list,
+        if it has reached INSERT_BATCH or force is set.
+        """
+        if rows and (force or len(rows) >= self.INSERT_BATCH):
+            if conf.LogSQL:
+                main.log("SQL: %s\nParameters: %s rows.", sql, len(rows))
+            self.connection.executemany(sql, rows)
+            del rows[:]
 
 
     def create_table(self, table, create_sql=None):
@@ -1024,11 +2164,12 @@ class SkypeDatabase(object):
         table = table.lower()
         if create_sql or (table in self.CREATE_STATEMENTS):
             self.execute(create_sql or self.CREATE_STATEMENTS[table])
-            self.connection.commit()
+            self.commit()
             row = self.execute("SELECT name, sql FROM sqlite_master "
                                 "WHERE type = 'table' "
                                 "AND LOWER(name) = ?", [table]).fetchone()
             self.tables[table] = row
+            self.statements.clear()
 
 
     def insert_chat(self, chat, source_db):
@@ -1039,16 +2180,9 @@ class SkypeDatabase(object):
             self.create_table("conversations")
         if self.is_open() and "conversations" in self.tables:
             self.ensure_backup()
-            col_data = self.get_table_columns("conversations")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            chat_filled = self.fill_missing_fields(chat, fields)
-            chat_filled = self.blobs_to_binary(chat_filled, fields, col_data)
-
-            cursor = self.execute("INSERT INTO conversations (%s) VALUES (%s)"
-                                  % (str_cols, str_vals), chat_filled)
-            self.connection.commit()
+            sql, make_row = self.make_row_converter("conversations")
+            cursor = self.execute(sql, make_row(chat))
+            self.commit()
             self.last_modified = datetime.datetime.now()
             return cursor.lastrowid
 
@@ -1062,6 +2196,8 @@ class SkypeDatabase(object):
 
         @param    messages   list of messages, or message IDs from source_db
         @param    heartbeat  function called after every @beatcount message
+                             and after all messages, with insert rate
+                             in messages per second
         @param    beatcount  number of messages after which to call heartbeat
         @return              a list of inserted message IDs
         """
@@ -1088,93 +2224,99 @@ class SkypeDatabase(object):
                                   [source_chat["id"]])])
             chatrows_present = dict([(i["name"], 1)
                 for i in self.execute("SELECT name FROM chats")])
-            col_data = self.get_table_columns("messages")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            transfer_col_data = self.get_table_columns("transfers")
-            transfer_fields = [col["name"] for col in transfer_col_data
-                               if col["name"] != "id"]
-            transfer_cols = ", ".join(transfer_fields)
-            transfer_vals = ", ".join(["?"] * len(transfer_fields))
-            sms_col_data = self.get_table_columns("smses")
-            sms_fields = [col["name"] for col in sms_col_data
-                          if col["name"] != "id"]
-            sms_cols = ", ".join(sms_fields)
-            sms_vals = ", ".join(["?"] * len(sms_fields))
-            chat_col_data = self.get_table_columns("chats")
-            chat_fields = [col["name"] for col in chat_col_data
-                           if col["name"] != "id"]
-            chat_cols = ", ".join(chat_fields)
-            chat_vals = ", ".join(["?"] * len(chat_fields))
+            # Message IDs are assigned here, as executemany() gives no lastrowid
+            fields = [c["name"] for c in self.get_table_columns("messages")]
+            message_sql, message_row = self.make_row_converter("messages",
+                                                               fields)
+            transfer_sql, transfer_row = self.make_row_converter(
+                "transfers", default="")
+            sms_sql, sms_row = self.make_row_converter("smses", default="")
+            chat_sql, chat_row = self.make_row_converter("chats", default="")
+            message_rows, transfer_rows, sms_rows = [], [], []
             timestamp_earliest = source_chat["creation_timestamp"] \
                                  or sys.maxsize
+            inserted_tables = set() # Cached tables to drop after inserting
+            m_id = self.execute("SELECT COALESCE(MAX(id), 0) AS id "
+                                "FROM messages").fetchone()["id"]
+            time_start = time.time()
 
-            for i, m in enumerate(source_db.message_iterator(messages)):
-                # Insert corresponding Chats entry, if not present
-                if (m["chatname"] not in chatrows_present
-                and m["chatname"] in chatrows_source):
-                    chatrowdata = chatrows_source[m["chatname"]]
-                    chatrow = [chatrowdata.get(col, "") for col in chat_fields]
-                    chatrow = self.blobs_to_binary(
-                        chatrow, chat_fields, chat_col_data)
-                    sql = "INSERT INTO chats (%s) VALUES (%s)" % \
-                          (chat_cols, chat_vals)
-                    self.execute(sql, chatrow)
-                    chatrows_present[m["chatname"]] = 1
-                m_filled = self.fill_missing_fields(m, fields)
-                m_filled["convo_id"] = chat["id"]
-                if m["author"] == source_db.id:  # Ensure correct author
-                    m_filled["author"] = self.id # if merge from other account
-                m_filled = self.blobs_to_binary(m_filled, fields, col_data)
-                cursor = self.execute("INSERT INTO messages (%s) VALUES (%s)"
-                                      % (str_cols, str_vals), m_filled)
-                m_id = cursor.lastrowid
-                if (MESSAGE_TYPE_FILE == m["type"]
-                and "transfers" in source_db.tables):
-                    transfers = [t for t in source_db.get_transfers()
-                                 if t.get("chatmsg_guid") == m["guid"]]
-                    if transfers:
-                        sql = "INSERT INTO transfers (%s) VALUES (%s)" % \
-                              (transfer_cols, transfer_vals)
-                        transfers.sort(key=lambda x: x.get("chatmsg_index"))
-                        for t in map(dict.copy, transfers):
+            if self.in_batch:
+                self.execute("SAVEPOINT insert_messages")
+            try:
+                for i, m in enumerate(source_db.message_iterator(messages)):
+                    # Insert corresponding Chats entry, if not present
+                    if (m["chatname"] not in chatrows_present
+                    and m["chatname"] in chatrows_source):
+                        chatrowdata = chatrows_source[m["chatname"]]
+                        self.execute(chat_sql, chat_row(chatrowdata))
+                        chatrows_present[m["chatname"]] = 1
+                    m_id += 1
+                    author = self.id if m["author"] == source_db.id \
+                             else m["author"] # Ensure correct author
+                    message_rows.append(message_row(m, id=m_id, author=author,
+                                                    convo_id=chat["id"]))
+                    if (MESSAGE_TYPE_FILE == m["type"]
+                    and "transfers" in source_db.tables):
+                        transfers = source_db.get_transfers_by_guid(m["guid"])
+                        transfers = sorted(transfers,
+                                           key=lambda x: x.get("chatmsg_index"))
+                        for t in transfers:
                             # pk_id and nodeid are troublesome, ditto in SMSes,
                             # because their meaning is unknown - will
                             # something go out of sync if their values differ?
-                            if t["partner_handle"] == source_db.id:
-                                t["partner_handle"] = self.id
-                            row = [t.get(col, "") if col != "convo_id" else chat["id"]
-                                   for col in transfer_fields]
-                            row = self.blobs_to_binary(row, transfer_fields,
-                                                       transfer_col_data)
-                            self.execute(sql, row)
-                if (MESSAGE_TYPE_SMS == m["type"]
-                and "smses" in source_db.tables):
-                    smses = [s for s in source_db.get_smses()
-                             if s.get("chatmsg_id") == m["id"]]
-                    if smses:
-                        sql = "INSERT INTO smses (%s) VALUES (%s)" % \
-                              (sms_cols, sms_vals)
-                        for sms in smses:
-                            t = [sms.get(col, "") if col != "chatmsg_id" else m_id
-                                 for col in sms_fields]
-                            t = self.blobs_to_binary(t, sms_fields, sms_col_data)
-                            self.execute(sql, t)
-                timestamp_earliest = min(timestamp_earliest, m["timestamp"])
-                result.append(m_id)
-                if heartbeat and beatcount and i and not i % beatcount:
-                    heartbeat()
-            if (timestamp_earliest
-            and chat["creation_timestamp"] > timestamp_earliest):
-                # Conversations.creation_timestamp must not be later than the
-                # oldest message, Skype will not show messages older than that.
-                chat["creation_timestamp"] = timestamp_earliest
-                chat["created_datetime"] = self.stamp_to_date(timestamp_earliest)
-                self.execute("UPDATE conversations SET creation_timestamp = "
-                             ":creation_timestamp WHERE id = :id", chat)
-            self.connection.commit()
+                            handle = self.id \
+                                if t["partner_handle"] == source_db.id \
+                                else t["partner_handle"]
+                            transfer_rows.append(transfer_row(t,
+                                partner_handle=handle, convo_id=chat["id"]))
+                            inserted_tables.add("transfers")
+                    if (MESSAGE_TYPE_SMS == m["type"]
+                    and "smses" in source_db.tables):
+                        for sms in source_db.get_smses_by_message_id(m["id"]):
+                            sms_rows.append(sms_row(sms, chatmsg_id=m_id))
+                            inserted_tables.add("smses")
+                    timestamp_earliest = min(timestamp_earliest,
+                                             m["timestamp"])
+                    result.append(m_id)
+                    self.insert_batch(message_sql, message_rows)
+                    self.insert_batch(transfer_sql, transfer_rows)
+                    self.insert_batch(sms_sql, sms_rows)
+                    if heartbeat and beatcount and i and not i % beatcount:
+                        heartbeat(i / max(time.time() - time_start, 0.001))
+                self.insert_batch(message_sql, message_rows, force=True)
+                self.insert_batch(transfer_sql, transfer_rows, force=True)
+                self.insert_batch(sms_sql, sms_rows, force=True)
+                if (timestamp_earliest
+                and chat["creation_timestamp"] > timestamp_earliest):
+                    # Conversations.creation_timestamp must not be later than
+                    # the oldest message, Skype will not show messages older
+                    # than that.
+                    chat["creation_timestamp"] = timestamp_earliest
+                    chat["created_datetime"] = \
+                        self.stamp_to_date(timestamp_earliest)
+                    self.execute("UPDATE conversations SET creation_timestamp "
+                                 "= :creation_timestamp WHERE id = :id", chat)
+            except Exception:
+                if self.in_batch:
+                    self.execute("ROLLBACK TO SAVEPOINT insert_messages")
+                    self.execute("RELEASE SAVEPOINT insert_messages")
+                else:
+                    self.connection.rollback()
+                raise
+            if self.in_batch:
+                self.execute("RELEASE SAVEPOINT insert_messages")
+            self.commit()
+            for table in inserted_tables:
+                self.table_rows.pop(table, None)
+                self.table_indexes.pop(table, None)
             self.last_modified = datetime.datetime.now()
+            duration = time.time() - time_start
+            rate = len(result) / duration if duration else len(result)
+            main.log("Inserted %s into %s in %.2f seconds (%d per second).",
+                     util.plural("message", result), self.filename, duration,
+                     rate)
+            if heartbeat:
+                heartbeat(rate)
         return result
 
 
@@ -1194,20 +2336,10 @@ class SkypeDatabase(object):
                 len(participants), chat["title_long_lc"], self.filename
             )
             self.ensure_backup()
-            col_data = self.get_table_columns("participants")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-
-            for p in participants:
-                p_filled = self.fill_missing_fields(p, fields)
-                p_filled = self.blobs_to_binary(p_filled, fields, col_data)
-                p_filled["convo_id"] = chat["id"]
-                self.execute("INSERT INTO participants (%s) VALUES (%s)" % (
-                    str_cols, str_vals
-                ), p_filled)
-
-            self.connection.commit()
+            sql, make_row = self.make_row_converter("participants")
+            rows = [make_row(p, convo_id=chat["id"]) for p in participants]
+            self.insert_batch(sql, rows, force=True)
+            self.commit()
             self.last_modified = datetime.datetime.now()
 
 
@@ -1224,21 +2356,15 @@ class SkypeDatabase(object):
                 account["skypename"], self.filename
             )
             self.ensure_backup()
-            col_data = self.get_table_columns("accounts")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-
-            a_filled = self.fill_missing_fields(account, fields)
-            del a_filled["id"]
-            a_filled = self.blobs_to_binary(a_filled, fields, col_data)
-            self.execute("INSERT INTO accounts (%s) VALUES (%s)" % (
-                str_cols, str_vals
-            ), a_filled)
-            self.connection.commit()
+            sql, make_row = self.make_row_converter("accounts")
+            values = make_row(account)
+            self.execute(sql, values)
+            self.commit()
             self.last_modified = datetime.datetime.now()
-            self.account = a_filled
-            self.id = a_filled["skypename"]
+            fields = [c["name"] for c in self.get_table_columns("accounts")
+                      if c["name"] != "id"]
+            self.account = dict(zip(fields, values))
+            self.id = self.account["skypename"]
 
 
     def insert_contacts(self, contacts, source_db):
@@ -1254,17 +2380,10 @@ class SkypeDatabase(object):
                 "Merging %d contacts into %s.", len(contacts), self.filename
             )
             self.ensure_backup()
-            col_data = self.get_table_columns("contacts")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            for c in contacts:
-                c_filled = self.fill_missing_fields(c, fields)
-                c_filled = self.blobs_to_binary(c_filled, fields, col_data)
-                self.execute("INSERT INTO contacts (%s) VALUES (%s)" % (
-                    str_cols, str_vals
-                ), c_filled)
-            self.connection.commit()
+            sql, make_row = self.make_row_converter("contacts")
+            rows = [make_row(c) for c in contacts]
+            self.insert_batch(sql, rows, force=True)
+            self.commit()
             self.last_modified = datetime.datetime.now()
 
 
@@ -1283,25 +2402,17 @@ class SkypeDatabase(object):
             self.ensure_backup()
 
             col_data = self.get_table_columns("contactgroups")
-            pk = [c["name"] for c in col_data if c["pk"]][0]
-            pk_key = "PK%s" % int(time.time())
             fields = [col["name"] for col in col_data if not col["pk"]]
-            str_fields = ", ".join(["%s = :%s" % (col, col) for col in fields])
+            update_sql, update_row = self.make_key_converter("contactgroups",
+                                                             "update", fields)
             existing = dict([(c["name"], c) for c in self.get_contactgroups()])
             for c in (x for x in groups if x["name"] in existing):
-                c_filled = self.fill_missing_fields(c, fields)
-                c_filled[pk_key] = existing[c["name"]][pk]
-                self.execute("UPDATE contactgroups SET %s WHERE %s = :%s" %
-                             (str_fields, pk, pk_key ), c_filled)
+                self.execute(update_sql, update_row(c, existing[c["name"]]))
 
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
+            sql, make_row = self.make_row_converter("contactgroups", fields)
             for c in (x for x in groups if x["name"] not in existing):
-                c_filled = self.fill_missing_fields(c, fields)
-                c_filled = self.blobs_to_binary(c_filled, fields, col_data)
-                self.execute("INSERT INTO contactgroups (%s) VALUES (%s)" %
-                             (str_cols, str_vals), c_filled)
-            self.connection.commit()
+                self.execute(sql, make_row(c))
+            self.commit()
             self.last_modified = datetime.datetime.now()
 
 
@@ -1312,7 +2423,7 @@ class SkypeDatabase(object):
         """
         if not lst:
             return
-        if isinstance(lst[0], dict):
+        if isinstance(lst[0], (dict, MessageRow)):
             for m in lst:
                 yield m
         else:
@@ -1333,27 +2444,20 @@ class SkypeDatabase(object):
         """
         if not self.is_open():
             return
-        table, where = table.lower(), ""
+        table = table.lower()
         main.log("Updating 1 row in table %s, %s.",
                  self.tables[table]["name"], self.filename)
         self.ensure_backup()
-        col_data = self.get_table_columns(table)
-        values, where = row.copy(), ""
-        setsql = ", ".join("%(name)s = :%(name)s" % x for x in col_data)
-        if rowid is not None:
-            pk_key = "PK%s" % int(time.time()) # Avoid existing field collision
-            where, values[pk_key] = "ROWID = :%s" % pk_key, rowid
-        else:
-            for pk in [c["name"] for c in col_data if c["pk"]]:
-                pk_key = "PK%s" % int(time.time())
-                values[pk_key] = original_row[pk]
-                where += (" AND " if where else "") + "%s IS :%s" % (pk, pk_key)
-        if not where:
+        sql, make_row = self.make_key_converter(table, "update",
+                                                rowid=rowid is not None)
+        if not sql:
             return False # Sanity check: no primary key and no rowid
-        self.execute("UPDATE %s SET %s WHERE %s" % (table, setsql, where),
-                     values)
-        self.connection.commit()
+        key = original_row if rowid is None else rowid
+        self.execute(sql, make_row(row, key))
+        self.commit()
         self.last_modified = datetime.datetime.now()
+        if "messages" == table:
+            self.uncache_messages([row, original_row])
 
 
     def insert_row(self, table, row):
@@ -1368,15 +2472,13 @@ class SkypeDatabase(object):
         main.log("Inserting 1 row into table %s, %s.",
                  self.tables[table]["name"], self.filename)
         self.ensure_backup()
-        col_data = self.get_table_columns(table)
-        fields = [col["name"] for col in col_data]
-        str_cols = ", ".join(fields)
-        str_vals = ":" + ", :".join(fields)
-        row = self.blobs_to_binary(row, fields, col_data)
-        cursor = self.execute("INSERT INTO %s (%s) VALUES (%s)" %
-                              (table, str_cols, str_vals), row)
-        self.connection.commit()
+        fields = [col["name"] for col in self.get_table_columns(table)]
+        sql, make_row = self.make_row_converter(table, fields)
+        cursor = self.execute(sql, make_row(row))
+        self.commit()
         self.last_modified = datetime.datetime.now()
+        if "messages" == table:
+            self.uncache_messages([row])
         return cursor.lastrowid
 
 
@@ -1389,28 +2491,669 @@ class SkypeDatabase(object):
         """
         if not self.is_open():
             return
-        table, where = table.lower(), ""
+        table = table.lower()
         main.log("Deleting 1 row from table %s, %s.",
                  self.tables[table]["name"], self.filename)
         self.ensure_backup()
-        col_data = self.get_table_columns(table)
-        values, where = row.copy(), ""
-        if rowid is not None:
-            pk_key = "PK%s" % int(time.time()) # Avoid existing field collision
-            where, values[pk_key] = "ROWID = :%s" % pk_key, rowid
-        else:
-            for pk in [c["name"] for c in col_data if c["pk"]]:
-                pk_key = "PK%s" % int(time.time())
-                values[pk_key] = original_row[pk]
-                where += (" AND " if where else "") + "%s IS :%s" % (pk, pk_key)
-        if not where:
+        sql, make_row = self.make_key_converter(table, "delete",
+                                                rowid=rowid is not None)
+        if not sql:
             return False # Sanity check: no primary key and no rowid
-        self.execute("DELETE FROM %s WHERE %s" % (table, where), values)
-        self.connection.commit()
+        self.execute(sql, make_row(row, row if rowid is None else rowid))
+        self.commit()
         self.last_modified = datetime.datetime.now()
+        if "messages" == table:
+            self.uncache_messages([row])
         return True
 
 
+    def uncache_messages(self, rows):
+        """
+        Drops cached chat messages and message body DOMs for the changed
+        message rows, to be reloaded on next access.
+        """
+        keys = set()
+        for row in rows:
+            keys.update([("messages", row.get("convo_id")),
+                         ("dom", row.get("id"))])
+        self.message_cache.discard(lambda key: key in keys)
+
+
+
+class MessageRow(object):
+    """
+    Compact dictionary-like row for the Messages table, values kept in a list
+    with column positions shared by all rows of a query. Text and BLOB
+    values are decoded on first access, as in SkypeDatabase.row_factory,
+    and lazy values computed on first access. Keys not in query columns,
+    or set to undecoded strings, are kept in a separate dictionary.
+    """
+    __slots__ = ("_index", "_values", "_extra")
+
+    """Placeholder for column values deleted or overridden in extra keys."""
+    DELETED = object()
+
+
+    class Lazy(object):
+        """Placeholder for a value computed from the row on first access."""
+        __slots__ = ("func", )
+
+        def __init__(self, func):
+            self.func = func
+
+
+    def __init__(self, index, values, extra=None):
+        """
+        @param   index   {column name: position in values}, shared by rows
+        @param   values  list of column values
+        @param   extra   {name: value} for keys not in columns, if any
+        """
+        self._index, self._values, self._extra = index, values, extra
+
+
+    @staticmethod
+    def factory(lazy=None):
+        """
+        Returns a new cursor row_factory producing MessageRow instances.
+
+        @param   lazy  {column name: function(row)} for values computed on
+                       first access, replacing placeholder columns in query
+        """
+        index, placeholders = {}, []
+        def make_row(cursor, row):
+            if not index:
+                index.update((c[0], i) for i, c in
+                             enumerate(cursor.description))
+                placeholders.extend((index[k], MessageRow.Lazy(f))
+                                    for k, f in (lazy or {}).items()
+                                    if k in index)
+            values = list(row)
+            for pos, value in placeholders:
+                values[pos] = value
+            return MessageRow(index, values)
+        return make_row
+
+
+    @staticmethod
+    def estimate_size(rows, samples=100):
+        """
+        Returns the estimated memory size of the list of rows, in bytes,
+        extrapolated from a sample of rows.
+        """
+        result = sys.getsizeof(rows)
+        if rows:
+            sampled = rows[::max(1, len(rows) / samples)]
+            size = sum(x.get_size() for x in sampled)
+            result += size * len(rows) / len(sampled)
+        return result
+
+
+    @staticmethod
+    def decode(value):
+        """Returns the raw string or buffer value as Unicode."""
+        if type(value) is buffer:
+            return str(value).decode("latin1")
+        try:
+            return value.decode("utf-8")
+        except Exception:
+            return value.decode("latin1")
+
+
+    def __getitem__(self, key):
+        pos = self._index.get(key)
+        if pos is not None:
+            value = self._values[pos]
+            if type(value) is str or type(value) is buffer:
+                value = self._values[pos] = self.decode(value)
+            elif type(value) is MessageRow.Lazy:
+                value = self._values[pos] = value.func(self)
+            if value is not self.DELETED:
+                return value
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+
+    def __setitem__(self, key, value):
+        pos = self._index.get(key)
+        if pos is not None and not isinstance(value, (str, buffer)):
+            self._values[pos] = value
+            if self._extra: self._extra.pop(key, None)
+            return
+        if pos is not None:
+            self._values[pos] = self.DELETED
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        pos = self._index.get(key)
+        if pos is not None:
+            self._values[pos] = self.DELETED
+        if self._extra: self._extra.pop(key, None)
+
+
+    def __contains__(self, key):
+        pos = self._index.get(key)
+        if pos is not None and self._values[pos] is not self.DELETED:
+            return True
+        return bool(self._extra) and key in self._extra
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __nonzero__(self):
+        return any(v is not self.DELETED for v in self._values) \
+               or bool(self._extra)
+
+
+    def __eq__(self, other):
+        if isinstance(other, MessageRow):
+            other = other.copy()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.copy() == other
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+
+    __hash__ = None # Mutable like dict
+
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+    def __reduce__(self): # Copied and pickled as plain dictionary
+        return (dict, (self.copy(), ))
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def has_key(self, key):
+        return key in self
+
+
+    def keys(self):
+        result = sorted((k for k, i in self._index.items()
+                         if self._values[i] is not self.DELETED),
+                        key=self._index.get)
+        return result + list(self._extra or ())
+
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+
+    def itervalues(self):
+        return iter(self.values())
+
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+    def copy(self):
+        """Returns a plain dictionary with all the row keys and values."""
+        return dict(self.items())
+
+
+    def get_size(self):
+        """Returns the estimated memory size of the row, in bytes."""
+        result = sys.getsizeof(self) + sys.getsizeof(self._values)
+        result += sum(map(sys.getsizeof, self._values))
+        if self._extra:
+            result += sys.getsizeof(self._extra)
+            result += sum(map(sys.getsizeof, self._extra.values()))
+        return result
+
+
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        value = self[key]
+        del self[key]
+        return value
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs, ):
+            pairs = ((k, other[k]) for k in other.keys()) \
+                    if hasattr(other, "keys") else other
+            for k, v in pairs:
+                self[k] = v
+
+
+
+class StatisticsCache(object):
+    """
+    Persistent cache of chat statistics and table row counts, stored in
+    conf.StatisticsCacheFile for all databases, keyed by database path.
+    Cached values are valid for the database file size, modification time
+    and maximum message ID they were stored with; if the file has changed
+    only by new messages, values can be updated from messages after the
+    stored maximum ID.
+    """
+
+    """Maximum number of databases to keep cached statistics for."""
+    MAX_ENTRIES = 50
+
+    _lock = threading.RLock() # Guards cache file, stored from several threads
+
+
+    def __init__(self, db):
+        """
+        @param   db  SkypeDatabase instance
+        """
+        self.db = db
+        self.key = self.make_key(db.filename)
+
+
+    @staticmethod
+    def make_key(filename):
+        """Returns cache key for the database file."""
+        path = os.path.normcase(os.path.realpath(filename))
+        return util.to_unicode(path) # JSON keys are Unicode
+
+
+    @staticmethod
+    def peek(filename, name):
+        """
+        Returns value cached for the database file without opening the
+        database, if file size and modification time are unchanged since.
+
+        @param   name  cached value name, like "general"
+        @return        cached value, or None if not available or not valid
+        """
+        entry = StatisticsCache.load().get(StatisticsCache.make_key(filename))
+        value, state = (entry or {}).get(name), (entry or {}).get("state")
+        if value is not None and state and os.path.exists(filename) \
+        and state["size"] == os.path.getsize(filename) \
+        and state["mtime"] == os.path.getmtime(filename):
+            return value
+
+
+    def get_file_state(self):
+        """
+        Returns current database state, as
+        {"size": bytes, "mtime": float, "max_id": maximum message ID}.
+        """
+        max_id = 0
+        if "messages" in self.db.tables:
+            max_id = self.db.execute("SELECT MAX(id) AS id FROM messages",
+                                     log=False).fetchone()["id"] or 0
+        return {"size":   os.path.getsize(self.db.filename),
+                "mtime":  os.path.getmtime(self.db.filename),
+                "max_id": max_id}
+
+
+    def lookup(self, name, state):
+        """
+        Returns cached value and maximum message ID to update value from.
+
+        @param   name   cached value name, like "chats" or "tables"
+        @param   state  current database state, from get_file_state()
+        @return         (value, None) if value is valid for state,
+                        (value, max ID) if only newer messages were added,
+                        (None, None) if value needs to be fully retrieved
+        """
+        entry = self.load().get(self.key) or {}
+        value, cached = entry.get(name), entry.get("state") or {}
+        if value is None or not cached:
+            return None, None
+        if cached == state:
+            return value, None
+        if 0 < cached["max_id"] < state["max_id"]:
+            return value, cached["max_id"]
+        return None, None
+
+
+    def store(self, name, value, state):
+        """
+        Stores value in cache, dropping other values if stored for another
+        database state, and saves cache file. The file is written to a
+        temporary file first and renamed over the cache file, so that
+        a concurrent or interrupted save cannot leave it half-written.
+        """
+        with self._lock:
+            data = self.load()
+            entry = data.get(self.key) or {}
+            if entry.get("state") != state:
+                entry = {"state": state}
+            entry.update({name: value, "used": time.time()})
+            data[self.key] = entry
+            keys = sorted(data, key=lambda k: -data[k].get("used", 0))
+            for key in keys[self.MAX_ENTRIES:]:
+                data.pop(key)
+            filename = conf.StatisticsCacheFile
+            tempname = "%s.%s.tmp" % (filename, os.getpid())
+            try:
+                with open(tempname, "wb") as f:
+                    json.dump(data, f)
+                if os.name == "nt" and os.path.exists(filename):
+                    os.remove(filename) # Windows cannot rename over a file
+                os.rename(tempname, filename)
+            except Exception:
+                main.log("Error saving statistics cache %s.\n\n%s",
+                         filename, traceback.format_exc())
+                if os.path.exists(tempname):
+                    try: os.unlink(tempname)
+                    except Exception: pass
+
+
+    @staticmethod
+    def load():
+        """Returns all cached data, as {database path: {entry}, }."""
+        result = {}
+        with StatisticsCache._lock:
+            if os.path.exists(conf.StatisticsCacheFile):
+                try:
+                    with open(conf.StatisticsCacheFile, "rb") as f:
+                        result = json.load(f)
+                except Exception:
+                    main.log("Error loading statistics cache %s.\n\n%s",
+                             conf.StatisticsCacheFile, traceback.format_exc())
+        return result
+
+
+
+class CancelToken(object):
+    """
+    Cancellation flag for SQLite statements running in a thread, checked
+    in the progress handler of SkypeDatabase connections every PROGRESS_STEPS
+    virtual machine instructions, aborting the statement if cancelled.
+    Each thread has its own token, also keeping statistics of the statement
+    last executed in the thread.
+    """
+
+    """Number of SQLite virtual machine instructions between progress calls."""
+    PROGRESS_STEPS = 1000
+
+    _local = threading.local() # Token bound to current thread
+
+
+    def __init__(self):
+        self.cancelled = False
+        self.interrupted = False # Whether cancelled by Ctrl-C
+        self.sql = None    # Statement last executed in token thread
+        self.start = None  # Start time of last statement
+        self.steps = 0     # Approximate VM instructions taken by statement
+
+
+    def bind(self):
+        """Sets this token for statements executed in the current thread."""
+        CancelToken._local.token = self
+        return self
+
+
+    def cancel(self):
+        """Cancels running and subsequent statements, until reset()."""
+        self.cancelled = True
+
+
+    def reset(self):
+        """Clears cancellation, allowing statements to run again."""
+        self.cancelled = self.interrupted = False
+
+
+    def begin(self, sql):
+        """Registers the start of a new statement in token thread."""
+        self.sql, self.steps = sql, 0
+        self.start = time.time()
+
+
+    @classmethod
+    def current(cls):
+        """Returns the token of current thread, binding a new one if none."""
+        return getattr(cls._local, "token", None) or cls().bind()
+
+
+    @classmethod
+    def on_progress(cls):
+        """
+        SQLite progress handler, returns whether to abort the statement,
+        logging aborted statements. Must not use the connection or run
+        the UI event loop, as SQLite forbids using the connection from
+        inside its progress handler.
+        """
+        self = cls.current()
+        self.steps += cls.PROGRESS_STEPS
+        if self.cancelled and self.sql:
+            main.log("Aborted query after %.3f seconds and ~%s VM steps: %s",
+                     time.time() - self.start, self.steps, self.sql)
+            self.sql = None # Log once per statement
+        return self.cancelled
+
+
+    @classmethod
+    def on_interrupt(cls, signum, frame):
+        """
+        SIGINT handler for command-line mode, cancelling the current thread
+        statement. Raises KeyboardInterrupt unless called from inside SQLite,
+        where it would be swallowed: SkypeDatabase.execute() will raise it.
+        """
+        self = cls.current()
+        self.cancelled = self.interrupted = True
+        code = cls.on_progress.__func__.func_code
+        while frame and frame.f_code is not code:
+            frame = frame.f_back
+        if not frame:
+            raise KeyboardInterrupt()
+
+
+
+class SearchIndex(object):
+    """
+    Full-text index of message bodies for fast searching, kept in a separate
+    SQLite file next to the Skype database, the database itself is never
+    modified. Index is brought up to date incrementally, indexing only
+    messages added or edited since last update.
+    """
+
+    """Suffix added to database filename for index filename."""
+    FILE_SUFFIX = ".index"
+
+    """Schema name the index is attached under in database connection."""
+    SCHEMA = "searchindex"
+
+    """Index structure version, index is rebuilt if stored version differs."""
+    VERSION = 1
+
+    """Number of messages to index in one transaction."""
+    CHUNK = 10000
+
+    """Regex for stripping XML tags from message body."""
+    TAG_RGX = re.compile("<[^>]*>")
+
+    """Parser for unescaping HTML entities in message body."""
+    HTML_PARSER = HTMLParser.HTMLParser()
+
+
+    def __init__(self, db):
+        """
+        @param   db  SkypeDatabase instance
+        """
+        self.db = db
+        self.filename = db.filename + self.FILE_SUFFIX
+        self.connection = None
+        self.meta = {} # {"version", "size", "mtime", "max_id", "max_edited"}
+
+
+    def open(self):
+        """Opens the index file, creating index structure if not present."""
+        if self.connection:
+            return
+        self.connection = sqlite3.connect(self.filename,
+                                          check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta "
+                                "(key TEXT NOT NULL PRIMARY KEY, value TEXT)")
+        self.meta = dict((k, float(v) if "mtime" == k else int(v)) for k, v
+                         in self.connection.execute("SELECT key, value "
+                                                    "FROM meta"))
+        if self.meta.get("version") != self.VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS messages")
+            self.connection.execute("DELETE FROM meta")
+            self.meta = {"version": self.VERSION}
+        for tokenizer in ["unicode61", "simple"]:
+            try:
+                self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                    "messages USING fts4(body, tokenize=%s)" % tokenizer)
+                break # break for tokenizer
+            except sqlite3.OperationalError:
+                if "simple" == tokenizer: raise
+        self.save_meta()
+
+
+    def close(self):
+        """Closes the index file."""
+        if self.connection:
+            try: self.connection.close()
+            except Exception: pass
+            self.connection = None
+
+
+    def save_meta(self, **kwargs):
+        """Updates and stores index metainformation, commits transaction."""
+        self.meta.update(kwargs)
+        values = [(k, repr(v) if isinstance(v, float) else str(v))
+                  for k, v in self.meta.items()] # repr keeps float precision
+        self.connection.executemany("INSERT OR REPLACE INTO meta "
+            "(key, value) VALUES (?, ?)", values)
+        self.connection.commit()
+
+
+    def get_file_state(self):
+        """
+        Returns database file state as {"size": bytes, "mtime": float},
+        with full modification time precision, as SQLite grows the file
+        by whole pages and in-place updates can leave size unchanged.
+        """
+        return {"size":  os.path.getsize(self.db.filename),
+                "mtime": os.path.getmtime(self.db.filename)}
+
+
+    def is_stale(self):
+        """Returns whether the index is missing or database has changed."""
+        if not os.path.exists(self.filename):
+            return True
+        self.open()
+        state = self.get_file_state()
+        return any(self.meta.get(k) != v for k, v in state.items())
+
+
+    def update(self, progress=None):
+        """
+        Indexes messages added or edited since last update.
+
+        @param   progress  function called with (indexed count, total count)
+                           after each chunk, returning False cancels update
+        @return            number of messages indexed
+        """
+        result = 0
+        if not self.is_stale() or "messages" not in self.db.tables:
+            return result
+        self.open()
+        state = self.get_file_state()
+        max_id, max_edited = (self.meta.get(k) or 0
+                              for k in ("max_id", "max_edited"))
+        new_max_edited = self.db.execute("SELECT MAX(edited_timestamp) AS max "
+                                         "FROM messages").fetchone()["max"]
+        edited = []
+        if max_id and new_max_edited > max_edited:
+            edited = [x["id"] for x in self.db.execute(
+                "SELECT id FROM messages WHERE id <= ? "
+                "AND edited_timestamp > ?", [max_id, max_edited])]
+        total = len(edited) + self.db.execute("SELECT COUNT(*) AS count "
+            "FROM messages WHERE id > ?", [max_id]).fetchone()["count"]
+        main.log("Updating search index %s with %s.", self.filename,
+                 util.plural("message", total))
+
+        chunks = [edited[i:i+999] for i in range(0, len(edited), 999)]
+        while True:
+            if chunks: # Re-index edited messages first, by their IDs
+                ids = chunks.pop(0)
+                sql = "SELECT id, body_xml FROM messages WHERE id IN (%s)" \
+                      % ", ".join(map(str, ids))
+                rows = self.db.execute(sql, log=False).fetchall()
+                self.connection.execute("DELETE FROM messages WHERE docid IN "
+                                        "(%s)" % ", ".join(map(str, ids)))
+            else:
+                rows = self.db.execute("SELECT id, body_xml FROM messages "
+                    "WHERE id > ? ORDER BY id LIMIT ?", [max_id, self.CHUNK],
+                    log=False).fetchall()
+                if not rows:
+                    break # break while True
+                max_id = rows[-1]["id"]
+            self.connection.executemany("INSERT INTO messages (docid, body) "
+                "VALUES (?, ?)", [(x["id"], self.strip(x["body_xml"]))
+                                  for x in rows])
+            self.save_meta(max_id=max_id) # Commits, interrupted work resumes
+            result += len(rows)
+            if progress and progress(result, total) is False:
+                break # break while True
+        if not chunks and result >= total:
+            self.save_meta(max_edited=new_max_edited or 0, **state)
+        main.log("Updated search index %s with %s.", self.filename,
+                 util.plural("message", result))
+        return result
+
+
+    def attach(self):
+        """
+        Attaches the index file to the database writer connection, if not
+        already attached. Statements naming the index table are executed
+        in the writer connection from any thread.
+
+        @return  name of the index table, usable in searchparser
+        """
+        self.open()
+        schemas = [x["name"] for x in self.db.execute("PRAGMA database_list",
+                                                      writer=True)]
+        if self.SCHEMA not in schemas:
+            self.db.execute("ATTACH DATABASE ? AS %s" % self.SCHEMA,
+                            [self.filename], writer=True)
+        return "%s.messages" % self.SCHEMA
+
+
+    def strip(self, body):
+        """Returns message body with XML tags and entities removed."""
+        text = self.TAG_RGX.sub(" ", body or "")
+        if "&" in text:
+            text = self.HTML_PARSER.unescape(text)
+        return text
+
+
 
 class MessageParser(object):
     """A Skype message parser, able to collect statistics from its input."""
@@ -1483,6 +3226,9 @@ class MessageParser(object):
     """Number of bins in statistics days histogram."""
     HISTOGRAM_DAY_BINS = 10
 
+    """Estimated memory size of a DOM element without text, in bytes."""
+    DOM_ELEMENT_SIZE = 100
+
     """Convenience class for earliest messages in histogram bins."""
     MessageStamp = collections.namedtuple("MessageStamp", "date id")
 
@@ -1548,13 +3294,16 @@ class MessageParser(object):
         output = output or {}
         is_html = "html" == output.get("format")
 
-        if "dom" in message:
-            dom = message["dom"] # Cached DOM already exists
+        cachekey = None if output.get("merge") else ("dom", message["id"])
+        if cachekey:
+            dom = self.db.message_cache.get(cachekey)
         if dom is None:
             dom = self.parse_message_dom(message, output)
-            if not (output.get("merge")
-            or message["id"] in self.stats.get("shared_images", {})):
-                message["dom"] = dom # Cache DOM if it was not mutated
+            if cachekey and dom is not None \
+            and message["id"] not in self.stats.get("shared_images", {}):
+                # Cache DOM if it was not mutated
+                self.db.message_cache.set(cachekey, dom,
+                                          self.get_dom_size(dom))
 
         if dom is not None:
             self.stats and self.collect_message_stats(message, dom)
@@ -1577,6 +3326,12 @@ class MessageParser(object):
         return result
 
 
+    def get_dom_size(self, dom):
+        """Returns the estimated memory size of the message DOM, in bytes."""
+        return sum(self.DOM_ELEMENT_SIZE + sys.getsizeof(x.text)
+                   + sys.getsizeof(x.tail) for x in dom.iter())
+
+
     def parse_message_dom(self, message, options):
         """
         Parses the body of the Skype message according to message type.
@@ -1640,9 +3395,8 @@ class MessageParser(object):
         elif MESSAGE_TYPE_FILE == message["type"] \
         or (MESSAGE_TYPE_INFO == message["type"]
         and "<files" in message["body_xml"]):
-            transfers = self.db.get_transfers()
-            files = dict((f["chatmsg_index"], f) for f in transfers
-                         if f["chatmsg_guid"] == message["guid"])
+            transfers = self.db.get_transfers_by_guid(message["guid"])
+            files = dict((f["chatmsg_index"], f) for f in transfers)
             if not files:
                 # No rows in Transfers, try to find data from message body
                 # and create replacements for Transfers fields
@@ -2094,10 +3848,9 @@ class MessageParser(object):
         elif MESSAGE_TYPE_FILE == message["type"]:
             files = message.get("__files")
             if files is None:
-                transfers = self.db.get_transfers()
-                filedict = dict((f["chatmsg_index"], f) for f in transfers
-                                if f["chatmsg_guid"] == message["guid"])
-                files = [f for i, f in sorted(filedict.items)]
+                transfers = self.db.get_transfers_by_guid(message["guid"])
+                filedict = dict((f["chatmsg_index"], f) for f in transfers)
+                files = [f for i, f in sorted(filedict.items())]
                 message["__files"] = files
             for f in files: f["__message_id"] = message["id"]
             self.stats["transfers"].extend(files)
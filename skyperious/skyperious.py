@@ -18,6 +18,7 @@ import copy
 import datetime
 import hashlib
 import inspect
+import itertools
 import math
 import os
 import re
@@ -73,6 +74,9 @@ import workers
 """Custom application events for worker results."""
 WorkerEvent, EVT_WORKER = wx.lib.newevent.NewEvent()
 ContactWorkerEvent, EVT_CONTACT_WORKER = wx.lib.newevent.NewEvent()
+CountWorkerEvent, EVT_COUNT_WORKER = wx.lib.newevent.NewEvent()
+ChangeWorkerEvent, EVT_CHANGE_WORKER = wx.lib.newevent.NewEvent()
+SQLWorkerEvent, EVT_SQL_WORKER = wx.lib.newevent.NewEvent()
 DetectionWorkerEvent, EVT_DETECTION_WORKER = wx.lib.newevent.NewEvent()
 OpenDatabaseEvent, EVT_OPEN_DATABASE = wx.lib.newevent.NewEvent()
 
@@ -1178,7 +1182,7 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                         db.get_conversations_stats(chats)
                     progressfunc = lambda *args: wx.SafeYield()
                     result = export.export_chats(chats, export_dir, format, db,
-                                                 progress=progressfunc)
+                        progress=progressfunc, processes=conf.ExportProcesses)
                     files, count = result
                 except Exception:
                     errormsg = "Error exporting chats:\n\n%s" % \
@@ -1402,10 +1406,17 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
 
 
     def update_database_stats(self, filename):
-        """Opens the database and updates main page UI with database info."""
-        db = None
+        """
+        Updates main page UI with database info, from statistics cache if
+        file is unchanged, opening the database otherwise.
+        """
+        db, stats = None, None
+        if conf.StatisticsCacheEnabled:
+            stats = skypedata.StatisticsCache.peek(filename, "general")
         try:
-            db = self.dbs.get(filename) or skypedata.SkypeDatabase(filename)
+            if not stats:
+                db = self.dbs.get(filename) \
+                     or skypedata.SkypeDatabase(filename)
         except Exception as e:
             self.label_account.Value = "(database not readable)"
             self.label_messages.Value = "Error text: %s" % util.format_exc(e)
@@ -1415,7 +1426,7 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                      traceback.format_exc())
             return
         try:
-            stats = db.get_general_statistics(full=False)
+            stats = stats or db.get_general_statistics()
             if "name" in stats and "skypename" in stats:
                 self.label_account.Value = "%(name)s (%(skypename)s)" % stats
             text = "%(chats)s" % stats
@@ -1534,6 +1545,9 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                 page.save_page_conf()
                 for worker in page.workers_search.values(): worker.stop()
                 page.worker_search_contacts.stop()
+                page.worker_count.stop()
+                page.worker_changes.stop()
+                page.worker_sql.stop()
             for page in self.merger_pages: page.worker_merge.stop()
             self.worker_detection.stop()
 
@@ -1601,6 +1615,9 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
 
             for worker in page.workers_search.values(): worker.stop()
             page.worker_search_contacts.stop()
+            page.worker_count.stop()
+            page.worker_changes.stop()
+            page.worker_sql.stop()
             page.save_page_conf()
 
             if page in self.db_pages:
@@ -1865,6 +1882,14 @@ class DatabasePage(wx.Panel):
         self.worker_search_contacts = \
             workers.ContactSearchThread(self.on_search_contacts_callback)
         self.search_data_contact = {"id": None} # Current contacts search data
+        self.Bind(EVT_COUNT_WORKER, self.on_count_result)
+        self.worker_count = workers.CountThread(self.on_count_callback)
+        self.Bind(EVT_CHANGE_WORKER, self.on_changes_result)
+        self.worker_changes = workers.ChangeThread(self.on_changes_callback)
+        self.Bind(EVT_SQL_WORKER, self.on_sql_result)
+        self.worker_sql = workers.SQLThread(self.on_sql_callback)
+        self.sql_dialog = None # Progress dialog for running SQL statement
+        self.sql_work_id = 0   # ID of last SQL statement sent to worker
 
         sizer = self.Sizer = wx.BoxSizer(wx.VERTICAL)
 
@@ -1960,6 +1985,8 @@ class DatabasePage(wx.Panel):
         and conf.LastActivePage[db.filename] != self.notebook.Selection:
             self.notebook.SetSelection(conf.LastActivePage[db.filename])
 
+        if conf.ChangeDetectionInterval: # Store state to detect changes from
+            self.worker_changes.work({"db": self.db})
         try:
             self.load_data()
         finally:
@@ -2640,11 +2667,11 @@ class DatabasePage(wx.Panel):
                  "edit_info_transfers", "edit_info_messages",
                  "edit_info_lastmessage", "edit_info_firstmessage", "",
                  "edit_info_path", "edit_info_size", "edit_info_modified",
-                 "edit_info_sha1", "edit_info_md5", ]
+                 "edit_info_sha1", "edit_info_md5", "edit_info_cache", ]
         labels = ["Conversations", "Contacts", "File transfers", "Messages",
                   "Last message", "First message", "", 
                   "Full path", "File size", "Last modified",
-                  "SHA-1 checksum", "MD5 checksum",  ]
+                  "SHA-1 checksum", "MD5 checksum", "Message cache", ]
         for name, label in zip(names, labels):
             if not name and not label:
                 sizer_file.AddSpacer(20), sizer_file.AddSpacer(20)
@@ -2665,13 +2692,24 @@ class DatabasePage(wx.Panel):
             wx.Button(parent=panel2, label="Check for corruption")
         button_refresh = self.button_refresh_fileinfo = \
             wx.Button(parent=panel2, label="Refresh")
+        button_optimize = self.button_optimize_indexes = \
+            wx.Button(parent=panel2, label="Optimize for reading")
         button_check.Enabled = button_refresh.Enabled = False
+        button_optimize.Enabled = False
         button_check.SetToolTipString("Check database integrity for "
                                       "corruption and recovery.")
-        sizer_file.Add(button_check)
+        button_optimize.SetToolTipString("Add or remove additional indexes "
+                                         "for faster reading. Remove them "
+                                         "before using the database in "
+                                         "Skype again.")
+        sizer_buttons = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_buttons.Add(button_check)
+        sizer_buttons.Add(button_optimize, border=5, flag=wx.LEFT)
+        sizer_file.Add(sizer_buttons)
         sizer_file.Add(button_refresh, border=15,
                        flag=wx.ALIGN_RIGHT | wx.RIGHT)
         self.Bind(wx.EVT_BUTTON, self.on_check_integrity, button_check)
+        self.Bind(wx.EVT_BUTTON, self.on_optimize_indexes, button_optimize)
         self.Bind(wx.EVT_BUTTON, lambda e: self.update_info_page(),
                   button_refresh)
 
@@ -2747,6 +2785,57 @@ class DatabasePage(wx.Panel):
                                       % self.db, conf.Title, wx.ICON_WARNING)
 
 
+    def on_optimize_indexes(self, event):
+        """
+        Handler for creating or dropping auxiliary indexes for faster reading,
+        after confirmation, shows the query plans of affected queries.
+        """
+        indexes = self.db.get_aux_indexes()
+        drop = any(x["exists"] for x in indexes)
+        if drop:
+            msg = ("Remove the additional reading indexes from %s?\n\n"
+                   "Indexes should be removed before using the database "
+                   "in Skype again." % self.db)
+        else:
+            msg = ("Create additional indexes in %s for faster reading?\n\n"
+                   "This modifies the database file%s. Indexes should be "
+                   "removed before using the database in Skype again." %
+                   (self.db, ", a backup is made first" if conf.DBDoBackup
+                    else ""))
+        if wx.YES != wx.MessageBox(msg, conf.Title,
+                                   wx.ICON_INFORMATION | wx.YES | wx.NO):
+            return
+        msg = "%s indexes in %s." % ("Dropping" if drop else "Creating",
+                                     self.db.filename)
+        main.logstatus_flash(msg)
+        busy = controls.BusyPanel(self, msg)
+        wx.YieldIfNeeded()
+        try:
+            names = self.db.drop_aux_indexes() if drop \
+                    else self.db.create_aux_indexes()
+            plans = self.db.explain_aux_indexes()
+        except Exception as e:
+            busy.Close()
+            errormsg = "Error %s indexes in %s:\n\n%s" % \
+                       ("dropping" if drop else "creating", self.db,
+                        traceback.format_exc())
+            main.logstatus_flash(errormsg)
+            wx.MessageBox(errormsg, conf.Title, wx.OK | wx.ICON_WARNING)
+            return
+        busy.Close()
+        main.status_flash("")
+        self.button_optimize_indexes.Label = "Optimize for reading" if drop \
+                                             else "Remove reading indexes"
+        lines = ["%s (%s):\n  %s" % (x["title"], "using index"
+                 if x["uses_index"] else "not using index", "\n  ".join(
+                 x["plan"])) for x in plans]
+        main.log("%s indexes in %s: %s.\n\n%s", "Dropped" if drop
+                 else "Created", self.db, ", ".join(names), "\n".join(lines))
+        wx.MessageBox("%s %s indexes in %s.\n\nQuery plans:\n\n%s" %
+                      ("Dropped" if drop else "Created", len(names), self.db,
+                       "\n".join(lines)), conf.Title, wx.ICON_INFORMATION)
+
+
     def update_accountinfo(self):
         """Updates the account information page, clearing its former data."""
         sizer, panel = self.sizer_accountinfo, self.panel_accountinfo
@@ -2860,8 +2949,10 @@ class DatabasePage(wx.Panel):
             self.db.update_accountinfo()
             self.update_accountinfo()
         for name in ["chats", "contacts", "messages", "transfers",
-        "lastmessage", "firstmessage", "size", "modified", "sha1", "md5"]:
+        "lastmessage", "firstmessage", "size", "modified", "sha1", "md5",
+        "cache"]:
             getattr(self, "edit_info_%s" % name).Value = ""
+        self.edit_info_cache.Value = str(self.db.message_cache)
         stats = {}
         try:
             stats = self.db.get_general_statistics()
@@ -2908,6 +2999,10 @@ class DatabasePage(wx.Panel):
             self.edit_info_sha1.Value = self.edit_info_md5.Value = util.format_exc(e)
         self.button_check_integrity.Enabled = True
         self.button_refresh_fileinfo.Enabled = True
+        indexes = self.db.get_aux_indexes()
+        self.button_optimize_indexes.Label = "Remove reading indexes" \
+            if any(x["exists"] for x in indexes) else "Optimize for reading"
+        self.button_optimize_indexes.Enabled = bool(indexes)
 
 
     def on_refresh_tables(self, event):
@@ -3378,7 +3473,8 @@ class DatabasePage(wx.Panel):
             try:
                 progressfunc = lambda *args: wx.SafeYield()
                 files, count = export.export_chats(chats, dirname, format,
-                    self.db, skip=do_all, progress=progressfunc)
+                    self.db, skip=do_all, progress=progressfunc,
+                    processes=conf.ExportProcesses)
             except Exception:
                 errormsg = "Error exporting chats:\n\n%s" % \
                            traceback.format_exc()
@@ -3847,7 +3943,9 @@ class DatabasePage(wx.Panel):
         result = event.result
         search_id, search_done = result.get("search", {}).get("id"), False
         tab_data = self.html_searchall.GetTabDataByID(search_id)
-        if tab_data:
+        if "status" in result:
+            main.status(result["status"])
+        elif tab_data:
             tab_data["info"]["map"].update(result.get("map", {}))
             tab_data["info"]["partial_html"] += result.get("output", "")
             html = tab_data["info"]["partial_html"]
@@ -3889,6 +3987,70 @@ class DatabasePage(wx.Panel):
             wx.PostEvent(self, ContactWorkerEvent(result=result))
 
 
+    def on_count_callback(self, result):
+        """Callback function for CountThread, posts the data to self."""
+        if self: # Check if instance is still valid (i.e. not destroyed by wx)
+            wx.PostEvent(self, CountWorkerEvent(result=result))
+
+
+    def on_count_result(self, event):
+        """
+        Handler for getting an exact table row count from CountThread,
+        updates the row count in table tree.
+        """
+        result = event.result
+        if "table" in result:
+            name = result["table"]["name"].lower()
+            item = self.tree_tables.GetNext(self.tree_tables.RootItem)
+            while item and item.IsOk():
+                table = self.tree_tables.GetItemPyData(item)
+                if table and table.lower() == name:
+                    self.tree_tables.SetItemText(item,
+                        self.format_table_rows(result["table"]), 1)
+                    break # break while item and item.IsOk()
+                item = self.tree_tables.GetNextSibling(item)
+        if "error" in result:
+            main.status_flash("Error counting table rows in %s.", self.db)
+        elif result["done"]:
+            main.status_flash("Counted table rows in %s.", self.db)
+
+
+    def on_changes_callback(self, result):
+        """Callback function for ChangeThread, posts the data to self."""
+        if self: # Check if instance is still valid (i.e. not destroyed by wx)
+            wx.PostEvent(self, ChangeWorkerEvent(result=result))
+
+
+    def on_changes_result(self, event):
+        """
+        Handler for database changes detected in ChangeThread, refreshes
+        changed data, and schedules next check after
+        conf.ChangeDetectionInterval.
+        """
+        if not self or not self.db.is_open():
+            return
+        if event.result["changes"]:
+            try:
+                self.db.refresh_changes(event.result["changes"])
+            except Exception:
+                main.log("Error refreshing changes in %s.\n\n%s",
+                         self.db, traceback.format_exc())
+        if conf.ChangeDetectionInterval:
+            wx.CallLater(conf.ChangeDetectionInterval * 1000,
+                         self.check_database_changes)
+
+
+    def format_table_rows(self, table):
+        """
+        Returns the row count text for table tree, like "5 rows", or "~5 rows"
+        if estimated, or "? rows" if not yet known.
+        """
+        rows = table["rows"]
+        if rows is None: return "? rows"
+        return "%s%d row%s" % ("~" if table.get("rows_estimated") else "",
+                               rows, "s" if rows != 1 else " ")
+
+
     def on_searchall(self, event):
         """
         Handler for clicking to global search the database.
@@ -3900,7 +4062,7 @@ class DatabasePage(wx.Panel):
             html = self.html_searchall
             data = {"id": wx.NewId(), "db": self.db, "text": text, "map": {},
                     "width": html.Size.width * 5/9, "table": "",
-                    "partial_html": ""}
+                    "partial_html": "", "index": conf.SearchUseIndex}
             fromtext = "" # "Searching for "text" in fromtext"
             if conf.SearchInMessages:
                 data["table"] = "messages"
@@ -4270,22 +4432,76 @@ class DatabasePage(wx.Panel):
 
 
     def execute_sql(self, sql):
-        """Executes the SQL query and populates the SQL grid with results."""
+        """
+        Starts executing the SQL statement in background, the SQL grid
+        is populated with results in on_sql_result(). Statements running
+        longer than a moment show a dialog for aborting.
+        """
+        self.sql_work_id += 1
+        self.worker_sql.work({"db": self.db, "sql": sql,
+                              "id": self.sql_work_id,
+                              "prefetch": SqliteGridBase.SEEK_CHUNK_LENGTH})
+        wx.CallLater(500, self.pulse_sql_dialog, self.sql_work_id)
+
+
+    def pulse_sql_dialog(self, work_id):
+        """
+        Shows or pulses the progress dialog for the running SQL statement,
+        if still running, stopping the statement if the dialog was aborted.
+        """
+        if not self or work_id != self.sql_work_id:
+            return
+        if not self.sql_dialog:
+            self.sql_dialog = wx.ProgressDialog(conf.Title,
+                "Executing SQL..", parent=self, style=wx.PD_CAN_ABORT
+                | wx.PD_APP_MODAL | wx.PD_ELAPSED_TIME)
+        if self.sql_dialog.Pulse()[0]:
+            wx.CallLater(500, self.pulse_sql_dialog, work_id)
+        else:
+            self.worker_sql.stop_work()
+
+
+    def on_sql_callback(self, result):
+        """Callback function for SQLThread, posts the data to self."""
+        if self: # Check if instance is still valid (i.e. not destroyed by wx)
+            wx.PostEvent(self, SQLWorkerEvent(result=result))
+
+
+    def on_sql_result(self, event):
+        """
+        Handler for SQL statement executed in SQLThread, populates the SQL
+        grid with query results or affected row count, or reports error.
+        """
+        result, sql = event.result, event.result["sql"]
+        if result["id"] != self.sql_work_id:
+            return # Superseded by a later statement
+        self.sql_work_id += 1 # Stops dialog pulsing
+        if self.sql_dialog:
+            self.sql_dialog.Destroy()
+            self.sql_dialog = None
+        if "error" in result:
+            if result["cancelled"]:
+                main.logstatus_flash("Aborted SQL \"%s\" (%s).", sql, self.db)
+            else:
+                main.logstatus_flash(result["error"])
+                wx.MessageBox(result["error"], conf.Title,
+                              wx.OK | wx.ICON_WARNING)
+            return
         try:
             grid_data = None
-            if sql.lower().startswith(("select", "pragma", "explain")):
+            if "cursor" in result:
                 # SELECT statement: populate grid with rows
-                grid_data = SqliteGridBase(self.db, sql=sql)
+                grid_data = SqliteGridBase(self.db, sql=sql,
+                    cursor=result["cursor"], rows=result["rows"])
                 self.grid_sql.SetTable(grid_data)
                 self.button_reset_grid_sql.Enabled = True
                 self.button_export_sql.Enabled = True
             else:
                 # Assume action query
-                affected_rows = self.db.execute_action(sql)
                 self.grid_sql.SetTable(None)
                 self.grid_sql.CreateGrid(1, 1)
                 self.grid_sql.SetColLabelValue(0, "Affected rows")
-                self.grid_sql.SetCellValue(0, 0, str(affected_rows))
+                self.grid_sql.SetCellValue(0, 0, str(result["affected_rows"]))
                 self.button_reset_grid_sql.Enabled = False
                 self.button_export_sql.Enabled = False
             main.logstatus_flash("Executed SQL \"%s\" (%s).", sql, self.db)
@@ -4337,6 +4553,8 @@ class DatabasePage(wx.Panel):
         table lists and database display.
         """
         grid_data = self.grid_table.Table
+        if grid_data.IsChanged(): # Have backup ready by the time of saving
+            self.db.start_backup()
         # Enable/disable commit and rollback icons
         self.tb_grid.EnableTool(wx.ID_SAVE, grid_data.IsChanged())
         self.tb_grid.EnableTool(wx.ID_UNDO, grid_data.IsChanged())
@@ -4379,14 +4597,13 @@ class DatabasePage(wx.Panel):
             while item and item.IsOk():
                 table = self.tree_tables.GetItemPyData(item)
                 if table:
-                    self.tree_tables.SetItemText(item, "%d row%s" % (
-                        tablemap[table]["rows"],
-                        "s" if tablemap[table]["rows"] != 1 else " "
-                    ), 1)
+                    self.tree_tables.SetItemText(item,
+                        self.format_table_rows(tablemap[table]), 1)
                     if table == self.grid_table.Table.table:
                         self.tree_tables.SetItemBold(item,
                         self.grid_table.Table.IsChanged())
                 item = self.tree_tables.GetNextSibling(item)
+            self.count_tables()
             # Refresh cell colours; without CallAfter wx 2.8 can crash
             wx.CallLater(0, self.grid_table.ForceRefresh)
 
@@ -4862,9 +5079,8 @@ class DatabasePage(wx.Panel):
             child = None
             for table in tables:
                 child = self.tree_tables.AppendItem(root, table["name"])
-                self.tree_tables.SetItemText(child, "%d row%s" % (
-                    table["rows"], "s" if table["rows"] != 1 else " "
-                ), 1)
+                self.tree_tables.SetItemText(child,
+                                             self.format_table_rows(table), 1)
                 self.tree_tables.SetItemPyData(child, table["name"])
 
                 for col in self.db.get_table_columns(table["name"]):
@@ -4885,6 +5101,7 @@ class DatabasePage(wx.Panel):
                 coldata = self.db.get_table_columns(t["name"])
                 fields = [c["name"] for c in coldata]
                 self.stc_sql.AutoCompAddSubWords(t["name"], fields)
+            self.count_tables()
         except Exception:
             if self:
                 errormsg = "Error loading table data from %s.\n\n%s" % \
@@ -4893,6 +5110,59 @@ class DatabasePage(wx.Panel):
                 wx.CallAfter(support.report_error, errormsg)
 
 
+    def count_tables(self):
+        """
+        Starts counting exact rows in background for tables with estimated
+        or unknown row counts, if any.
+        """
+        if any(t.get("rows_estimated") for t in self.db.get_tables()):
+            main.status_flash("Counting table rows in %s.", self.db)
+            self.worker_count.work({"db": self.db})
+
+
+    def check_database_changes(self):
+        """
+        Starts checking the database for changes by other programs
+        in background, see on_changes_result().
+        """
+        if self and self.db.is_open():
+            self.worker_changes.work({"db": self.db})
+
+
+    def on_database_changed(self, db, changes):
+        """
+        Handler for changes detected in the database, reloads chats list if
+        chats were reloaded, or refreshes chats with new messages, and
+        updates row counts in table tree.
+        """
+        if "conversations" in changes["reloaded"]:
+            self.chats = self.db.get_conversations()
+            for c in self.chats:
+                c["people"] = "" # Set empty data, stats will come later
+            self.list_chats.Populate(self.chats)
+            wx.CallLater(100, self.load_later_data)
+        elif changes["chats"]:
+            self.list_chats.RefreshRows()
+
+        names = set(changes["added"]) | set(changes["changed"])
+        tablemap = dict((t["name"].lower(), t) for t in self.db.get_tables())
+        if changes["schema"]:
+            self.load_tables_data()
+        else:
+            item = self.tree_tables.GetNext(self.tree_tables.RootItem)
+            while item and item.IsOk():
+                table = self.tree_tables.GetItemPyData(item)
+                if table and table.lower() in names:
+                    self.tree_tables.SetItemText(item,
+                        self.format_table_rows(tablemap[table.lower()]), 1)
+                item = self.tree_tables.GetNextSibling(item)
+        if changes["edited"]: # Messages edited in place, without new rows
+            names.add("messages")
+        main.status_flash("Refreshed changes in %s: %s.", self.db,
+                          ", ".join(tablemap[x]["name"] if x in tablemap
+                                    else x for x in sorted(names)))
+
+
     def update_tabheader(self):
         """Updates page tab header with option to close page."""
         if self:
@@ -5036,6 +5306,8 @@ class MergerPage(wx.Panel):
         button_merge = self.button_merge_all = controls.NoteButton(panel,
             label="&Merge to the right", note=self.MERGE_BUTTON_NOTE,
             bmp=images.ButtonMergeLeftMulti.Bitmap)
+        cb_sql = self.cb_sql_diff = wx.CheckBox(panel,
+            label="Compare messages in S&QL first")
         panel_gauge = self.panel_gauge = wx.Panel(panel)
         label_gauge = self.label_gauge = wx.StaticText(panel_gauge, label="")
         gauge = self.gauge_progress = wx.Gauge(panel_gauge, size=(400, 15),
@@ -5048,6 +5320,10 @@ class MergerPage(wx.Panel):
         gauge.ForegroundColour = conf.GaugeColour
         button_scan.Enabled = button_merge.Enabled = False
         button_scan.MinSize = button_merge.MinSize = (400, -1)
+        cb_sql.Value = conf.MergeUseSQLDiff
+        cb_sql.SetToolTipString("Match messages by GUID, remote ID and "
+                                "timestamp in SQL, parsing only the rest. "
+                                "Faster on large databases.")
         html.SetFonts(normal_face=self.Font.FaceName,
                       fixed_face=self.Font.FaceName, sizes=[8] * 7)
         html.BackgroundColour = conf.MergeHtmlBackgroundColour
@@ -5065,6 +5341,7 @@ class MergerPage(wx.Panel):
         sizer_top.Add(label2, pos=(0, 2))
         sizer_top.Add(button_scan, border=25, flag=wx.TOP | wx.GROW, pos=(1, 1), span=(1, 2))
         sizer_top.Add(button_merge, flag=wx.GROW, pos=(2, 1), span=(1, 2))
+        sizer_top.Add(cb_sql, border=5, flag=wx.LEFT, pos=(3, 1), span=(1, 2))
         panel_gauge.Sizer.Add(label_gauge, flag=wx.ALIGN_CENTER)
         panel_gauge.Sizer.Add(gauge, flag=wx.ALIGN_CENTER)
         sizer.Add(sizer_top, border=10, flag=wx.ALL | wx.ALIGN_CENTER)
@@ -5076,6 +5353,7 @@ class MergerPage(wx.Panel):
 
         button_scan.Bind(wx.EVT_BUTTON, self.on_scan_all)
         button_merge.Bind(wx.EVT_BUTTON, self.on_merge_all)
+        cb_sql.Bind(wx.EVT_CHECKBOX, self.on_toggle_sql_diff)
         html.Bind(wx.html.EVT_HTML_LINK_CLICKED, self.on_click_htmldiff)
 
 
@@ -5431,6 +5709,7 @@ class MergerPage(wx.Panel):
                     chats = list(filter(None, cc))
                 else:
                     type = "diff_merge_left"
+                sql_diff = conf.MergeUseSQLDiff
                 params = locals()
                 self.worker_merge.work(params)
                 self.is_merging = True
@@ -5623,6 +5902,12 @@ class MergerPage(wx.Panel):
                 self.db1, self.db2), conf.Title, wx.OK | wx.ICON_INFORMATION)
 
 
+    def on_toggle_sql_diff(self, event):
+        """Handler for toggling SQL comparison of messages, changes conf."""
+        conf.MergeUseSQLDiff = event.IsChecked()
+        conf.save()
+
+
     def on_scan_all(self, event):
         """
         Handler for clicking to scan for differences with the left database,
@@ -5643,7 +5928,8 @@ class MergerPage(wx.Panel):
                 (conf.MergeHtmlBackgroundColour, conf.FgColour))
         self.html_report.SetPage(html)
         self.update_gauge(self.gauge_progress, 0, "Scanning messages.")
-        params = {"db1": self.db1, "db2": self.db2, "type": "diff_left"}
+        params = {"db1": self.db1, "db2": self.db2, "type": "diff_left",
+                  "sql_diff": conf.MergeUseSQLDiff}
         self.worker_merge.work(params)
         self.is_scanning = True
 
@@ -5672,6 +5958,9 @@ class MergerPage(wx.Panel):
             self.is_scanned = True
             s1 = util.plural("differing chat", self.chats_diffdata)
             main.logstatus_flash("Found %s in %s.", s1, self.db1)
+            if result.get("memory"):
+                main.log("Peak memory use during scan %s.",
+                         util.format_bytes(result["memory"]))
             self.button_swap.Enabled = True
             self.button_merge_chats.Enabled = True
             if self.chats_diffdata:
@@ -5717,6 +6006,7 @@ class MergerPage(wx.Panel):
             message = ("Scan and merge chat differences\n\nfrom %s\n\ninto %s?"
                        % (db1, db2))
             type = "diff_merge_left"
+        sql_diff = conf.MergeUseSQLDiff
         response = wx.MessageBox(message, conf.Title,
                                  wx.OK | wx.CANCEL | wx.ICON_INFORMATION)
         if wx.OK == response:
@@ -5749,8 +6039,10 @@ class MergerPage(wx.Panel):
             mindex, mcount = result["index"], result["count"]
             cindex, ccount = result["chatindex"], result["chatcount"]
             percent = min(100, math.ceil(100 * util.safedivf(mindex, mcount)))
-            msg = "%s %d%% complete (%s of %s)." % (action, percent,
-                  cindex+1, util.plural("conversation", ccount))
+            msg = "%s %d%% complete (%s of %s%s)." % (action, percent,
+                  cindex+1, util.plural("conversation", ccount),
+                  ", %d messages per second" % result["rate"]
+                  if result.get("rate") else "")
             self.update_gauge(self.gauge_progress, percent, msg)
             for chat in result.get("chats", []):
                 if chat["identity"] in self.chats_diffdata:
@@ -6346,47 +6638,86 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
         self._auto_retrieve = retrieve
 
 
+    def IterMessages(self, key=None, ascending=True, inclusive=False):
+        """
+        Yields chat messages from the database page by page, starting from
+        the (timestamp, id) key, earliest to latest or latest to earliest.
+        """
+        while True:
+            page = self._db.get_message_page(self._chat, key, ascending,
+                                             inclusive=inclusive,
+                                             projection="render")
+            for m in page if ascending else reversed(page):
+                yield m
+            if len(page) < self._db.MESSAGE_PAGE_SIZE:
+                break # break while True
+            m = page[-1] if ascending else page[0]
+            key, inclusive = (m["timestamp"], m["id"]), False
+
+
+    def GetMessagesAround(self, message_id):
+        """
+        Returns (messages, index) for the range of messages centered around
+        the specified message, or (None, -1) if message not in chat.
+        """
+        key = self._db.get_message_key(self._chat, message_id=message_id)
+        if not key:
+            return None, -1
+        limit = conf.MaxHistoryInitialMessages
+        before = self._db.get_message_page(self._chat, key, ascending=False,
+                                           limit=limit / 2,
+                                           projection="render")
+        after = self._db.get_message_page(self._chat, key, ascending=True,
+                                          limit=limit - len(before),
+                                          inclusive=True, projection="render")
+        return collections.deque(before + after), len(before)
+
+
     def RetrieveMessagesIfNeeded(self):
         """
         Retrieves more messages if needed, for example if current filter
         specifies a larger date range than currently available.
         """
+        date_from, date_to = self._filter.get("daterange") or (None, None)
+        date_first = self._messages and self._messages[0]["datetime"]
+        date_last = self._messages and self._messages[-1]["datetime"]
+        if not self._messages_current and date_from and date_to \
+        and date_first and date_last and (date_to < date_first.date()
+                                          or date_from > date_last.date()):
+            # Date filter was just applied, with no overlap with retrieved
+            # messages: seek directly to range start instead of reading
+            # all the messages in between.
+            key = self._db.get_message_key(self._chat, date=date_from)
+            self._messages = collections.deque()
+            for m in self.IterMessages(key):
+                if m["datetime"] and m["datetime"].date() > date_to:
+                    break # break for m in self.IterMessages(..)
+                self._messages.append(m)
+            return
 
-        if not self._messages_current and "daterange" in self._filter \
-        and self._filter["daterange"][0]:
+        if not self._messages_current and date_from and self._messages:
             # If date filtering was just applied, check if we need to
             # retrieve more messages from earlier (messages are retrieved
             # starting from latest).
-            if not self._messages[0]["datetime"] \
-            or self._messages[0]["datetime"].date() \
-            >= self._filter["daterange"][0]:
-                m_iter = self._db.get_messages(self._chat,
-                    ascending=False,
-                    timestamp_from=self._messages[0]["timestamp"]
-                )
-                while m_iter:
-                    try:
-                        m = m_iter.next()
-                        self._messages.appendleft(m)
-                        if m["datetime"].date() < self._filter["daterange"][0]:
-                            m_iter = None
-                    except StopIteration:
-                        m_iter = None
+            if not date_first or date_first.date() >= date_from:
+                m = self._messages[0]
+                key = (m["timestamp"], m["id"])
+                for m in self.IterMessages(key, ascending=False):
+                    self._messages.appendleft(m)
+                    if m["datetime"].date() < date_from:
+                        break # break for m in self.IterMessages(..)
         last_dt = self._chat.get("last_message_datetime")
         if self._messages and last_dt \
         and self._messages[-1]["datetime"] < last_dt:
             # Last message timestamp is earlier than chat's last message
-            # timestamp: new messages have arrived
-            m_iter = self._db.get_messages(self._chat,
-                ascending=True, use_cache=False,
-                timestamp_from=self._messages[-1]["timestamp"]
-            )
-            while m_iter:
-                try:
-                    m = m_iter.next()
-                    self._messages.append(m)
-                except StopIteration:
-                    m_iter = None
+            # timestamp: more messages exist, or new messages have arrived.
+            # Messages past the current filter would not be shown.
+            m = self._messages[-1]
+            for m in self.IterMessages((m["timestamp"], m["id"])):
+                if date_to and m["datetime"] \
+                and m["datetime"].date() > date_to:
+                    break # break for m in self.IterMessages(..)
+                self._messages.append(m)
 
 
     def RefreshMessages(self, center_message_id=None):
@@ -6686,35 +7017,19 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
             if from_index is not None:
                 messages_current = collections.deque(messages[from_index:])
         else:
-            m_iter = db.get_messages(chat, ascending=False)
-
-            i = 0
-            message_show_limit = conf.MaxHistoryInitialMessages
-            messages_current = collections.deque()
-            try:
-                iterate = (i < message_show_limit)
-                while iterate:
-                    m = m_iter.next()
-                    if m:
-                        i += 1
-                        messages_current.appendleft(m)
-                        if m["id"] == center_message_id:
-                            self._center_message_index = len(messages_current)
-                            self._center_message_id = center_message_id
-                    else:
-                        break # break while iterate
-                    if center_message_id:
-                        c = self._center_message_index + message_show_limit / 2
-                        iterate = ((self._center_message_index < 0) or
-                                   (len(messages_current) < c))
-                    else:
-                        iterate = (i < message_show_limit)
-            except StopIteration:
-                m_iter = None
+            self._chat, self._db = chat, db
+            messages_current = None
+            if center_message_id:
+                messages_current, index = \
+                    self.GetMessagesAround(center_message_id)
+                if messages_current is not None:
+                    self._center_message_index = index
+                    self._center_message_id = center_message_id
+            if messages_current is None:
+                messages_current = collections.deque(db.get_message_page(
+                    chat, ascending=False,
+                    limit=conf.MaxHistoryInitialMessages, projection="render"))
             message_range = copy.copy(messages_current)
-            if self._center_message_index >= 0:
-                self._center_message_index = \
-                    len(messages_current) - self._center_message_index
 
         self._chat = chat
         self._db = db
@@ -6878,7 +7193,11 @@ class SqliteGridBase(wx.grid.PyGridTableBase):
     SEEK_CHUNK_LENGTH = 100
 
 
-    def __init__(self, db, table="", sql=""):
+    def __init__(self, db, table="", sql="", cursor=None, rows=()):
+        """
+        @param   cursor  cursor already executed for the query, if any
+        @param   rows    rows already fetched from the cursor, if any
+        """
         super(SqliteGridBase, self).__init__()
         self.is_query = bool(sql)
         self.db = db
@@ -6903,10 +7222,13 @@ class SqliteGridBase(wx.grid.PyGridTableBase):
 
         if not self.is_query:
             self.sql = "SELECT rowid AS %s, * FROM %s" % (self.rowid_name, table)
-        self.row_iterator = db.execute(self.sql)
+        self.row_iterator = cursor if cursor is not None \
+                            else db.execute(self.sql)
         if self.is_query:
             self.columns = [{"name": c[0], "type": "TEXT"}
                             for c in self.row_iterator.description or ()]
+            if rows: # Continue from rows already fetched
+                self.row_iterator = itertools.chain(rows, self.row_iterator)
             # Doing some trickery here: we can only know the row count when we have
             # retrieved all the rows, which is preferrable not to do at first,
             # since there is no telling how much time it can take. Instead, we
@@ -33,7 +33,8 @@ import re
 
 class Template(object):
 
-    COMPILED_TEMPLATES = {} # {(template string, compile options): code object}
+    # {(template string, compile options): (code string, compiled code object)}
+    COMPILED_TEMPLATES = {}
     # Regex for stripping all leading, trailing and interleaving whitespace.
     RE_STRIP = re.compile("(^[ \t]+|[ \t]+$|(?<=[ \t])[ \t]+|\A[\r\n]+|[ \t\r\n]+\Z)", re.M)
 
@@ -46,19 +47,20 @@ class Template(object):
                          "setopt": lambda k, v: self.options.update({k: v}), }
         cache_key = (template, bool(escape))
         if cache_key in Template.COMPILED_TEMPLATES:
-            self.code = Template.COMPILED_TEMPLATES[cache_key]
+            self.code, self.compiled = Template.COMPILED_TEMPLATES[cache_key]
         else:
             self.code = self._process(self._preprocess(self.template))
-            Template.COMPILED_TEMPLATES[cache_key] = self.code
+            self.compiled = compile(self.code, "<string>", "exec")
+            Template.COMPILED_TEMPLATES[cache_key] = self.code, self.compiled
 
     def expand(self, namespace={}, **kw):
         """Return the expanded template string"""
         output = []
         namespace.update(kw, **self.builtins)
-        namespace["echo"]  = lambda s: output.append(s)
+        namespace["echo"]  = output.append
         namespace["isdef"] = lambda v: v in namespace
 
-        eval(compile(self.code, "<string>", "exec"), namespace)
+        eval(self.compiled, namespace)
         return self._postprocess("".join(map(to_unicode, output)))
 
     def stream(self, buffer, namespace={}, encoding="utf-8", **kw):
@@ -78,7 +80,7 @@ class Template(object):
         if self.options["strip"]:
             postprocess = lambda s: Template.RE_STRIP.sub("", s).encode(encoding)
 
-        eval(compile(self.code, "<string>", "exec"), namespace)
+        eval(self.compiled, namespace)
         write_buffer("", flush=True) # Flush any last cached bytes
 
     def _preprocess(self, template):
@@ -11,6 +11,7 @@ Released under the MIT License.
 @modified    08.07.2015
 ------------------------------------------------------------------------------
 """
+import collections
 import ctypes
 import io
 import locale
@@ -19,6 +20,7 @@ import os
 import re
 import subprocess
 import sys
+import threading
 import time
 import urllib
 import warnings
@@ -220,6 +222,61 @@ def is_os_64bit():
             or os.environ['PROCESSOR_ARCHITECTURE'].endswith('64'))
 
 
+def get_memory_peak():
+    """
+    Returns the peak memory use of the current process in bytes,
+    or None if not available.
+    """
+    result = None
+    try:
+        if "nt" == os.name:
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [("cb", ctypes.c_ulong),
+                            ("PageFaultCount", ctypes.c_ulong),
+                            ("PeakWorkingSetSize", ctypes.c_size_t),
+                            ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t),
+                            ("PeakPagefileUsage", ctypes.c_size_t)]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(
+                process, ctypes.byref(counters), counters.cb):
+                result = counters.PeakWorkingSetSize
+        else:
+            import resource
+            result = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if "darwin" != sys.platform:
+                result *= 1024 # Linux reports kilobytes, Mac bytes
+    except Exception: pass
+    return result
+
+
+def clone_file(src, dst):
+    """
+    Creates dst as a copy-on-write clone of src, sharing data blocks until
+    either is changed, if the filesystem supports it (Linux Btrfs, XFS etc).
+
+    @return  whether clone was created
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    FICLONE = 0x40049409
+    try:
+        import fcntl
+        with open(src, "rb") as f1, open(dst, "wb") as f2:
+            fcntl.ioctl(f2.fileno(), FICLONE, f1.fileno())
+        return True
+    except Exception:
+        try: os.remove(dst)
+        except Exception: pass
+    return False
+
+
 def round_float(value, precision=1):
     """
     Returns the float as a string, rounded to the specified precision and
@@ -415,3 +472,98 @@ def longpath(path):
                 result = os.path.join(buf.value, tail)
     except Exception: pass
     return result
+
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache limited by the total estimated size of its
+    values, counting hits, misses and evictions. Thread-safe.
+    """
+
+    def __init__(self, budget):
+        """
+        @param   budget  maximum total size of cached values, in bytes
+        """
+        self.budget = budget
+        self.size = 0 # Total estimated size of current values
+        self.hits = self.misses = self.evictions = 0
+        self._items = collections.OrderedDict() # {key: (value, size)}
+        self._lock = threading.RLock()
+
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if not cached,
+        marking the value as most recently used.
+        """
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items[key] = item = self._items.pop(key)
+            return item[0]
+
+
+    def set(self, key, value, size):
+        """
+        Stores the value in cache, evicting least recently used values
+        until the total size is within budget. Values larger than
+        the budget are not cached.
+
+        @param   size  estimated size of value, in bytes
+        @return        number of values evicted
+        """
+        evicted = 0
+        with self._lock:
+            self.pop(key)
+            if size > self.budget:
+                return evicted
+            while self._items and self.size + size > self.budget:
+                _, (_, oldsize) = self._items.popitem(last=False)
+                self.size -= oldsize
+                evicted += 1
+            self._items[key] = (value, size)
+            self.size += size
+            self.evictions += evicted
+        return evicted
+
+
+    def pop(self, key, default=None):
+        """Removes the value from cache and returns it, or default."""
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, size = self._items.pop(key)
+            self.size -= size
+            return value
+
+
+    def discard(self, match):
+        """Removes all values with keys for which match(key) is true."""
+        with self._lock:
+            for key in [k for k in self._items if match(k)]:
+                self.pop(key)
+
+
+    def clear(self):
+        """Removes all values from cache, leaving counters as is."""
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def __str__(self):
+        return "%s of %s in %s, %s hits, %s misses, %s" % (
+            format_bytes(self.size), format_bytes(self.budget),
+            plural("item", len(self._items)), self.hits, self.misses,
+            plural("eviction", self.evictions))
@@ -12,9 +12,13 @@ Released under the MIT License.
 @modified    03.04.2015
 ------------------------------------------------------------------------------
 """
+import array
+import bisect
 import datetime
+import hashlib
 import Queue
 import re
+import struct
 import threading
 import traceback
 
@@ -43,6 +47,8 @@ class WorkerThread(threading.Thread):
         threading.Thread.__init__(self)
         self._callback = callback
         self._is_running = False
+        # Aborts database queries running in thread when work is stopped
+        self._cancel = skypedata.CancelToken()
         self._stop_work = False   # Flag to stop the current work
         self._drop_results = False # Flag to not post back obtained results
         self._queue = Queue.Queue()
@@ -77,6 +83,14 @@ class WorkerThread(threading.Thread):
         self._drop_results = drop_results
 
 
+    def _get_stop_work(self):
+        return self._cancel.cancelled
+    def _set_stop_work(self, value):
+        self._cancel.cancelled = value
+    _stop_work = property(_get_stop_work, _set_stop_work, doc=
+        """Flag to stop the current work, also aborting running queries.""")
+
+
     def postback(self, data):
         # Check whether callback is still bound to a valid object instance
         if getattr(self._callback, "__self__", True):
@@ -104,8 +118,35 @@ class SearchThread(WorkerThread):
         return result
 
 
+    def prepare_index(self, search):
+        """
+        Brings the database full-text search index up to date, posting
+        progress back as status, and attaches it to the database.
+
+        @return  index table name for searchparser, or None if unavailable
+        """
+        result = None
+        index = skypedata.SearchIndex(search["db"])
+        def progress(count, total):
+            if not self._drop_results:
+                percent = int(100 * util.safedivf(count, total))
+                self.postback({"search": search, "status": "Indexing "
+                               "messages for search, %s%% done." % percent})
+            return not self._stop_work
+        try:
+            index.update(progress)
+            result = index.attach()
+        except Exception:
+            main.log("Error using search index for %s.\n\n%s",
+                     search["db"], traceback.format_exc())
+        finally:
+            index.close()
+        return result
+
+
     def run(self):
         self._is_running = True
+        self._cancel.bind()
         # For identifying "chat:xxx" and "from:xxx" keywords
         query_parser = searchparser.SearchQueryParser()
         result = None
@@ -154,7 +195,11 @@ class SearchThread(WorkerThread):
                 result_type, result_count, count = None, 0, 0
                 result = {"output": "", "map": {},
                           "search": search, "count": 0}
-                sql, params, match_words = query_parser.Parse(search["text"])
+                index = None # Full-text index table name, if any
+                if search.get("index") and "messages" == search["table"]:
+                    index = self.prepare_index(search)
+                sql, params, match_words = query_parser.Parse(search["text"],
+                                                              index=index)
 
                 # Turn wildcard characters * into regex-compatible .*
                 match_words_re = [".*".join(map(re.escape, w.split("*")))
@@ -256,7 +301,7 @@ class SearchThread(WorkerThread):
                     chat_order = []    # [chat id, ]
                     messages = search["db"].get_messages(
                         additional_sql=sql, additional_params=params,
-                        ascending=False, use_cache=False)
+                        ascending=False, use_cache=False, projection="render")
                     for m in messages:
                         chat = chat_map.get(m["convo_id"])
                         body = parser.parse(m, pattern_replace if match_words 
@@ -363,8 +408,10 @@ class SearchThread(WorkerThread):
             except Exception as e:
                 if not result:
                     result = {}
-                result["done"], result["error"] = True, traceback.format_exc()
-                result["error_short"] = repr(e)
+                result["done"] = True
+                if not self._stop_work: # Stopping aborts running queries
+                    result["error"] = traceback.format_exc()
+                    result["error_short"] = repr(e)
                 self.postback(result)
 
 
@@ -385,20 +432,48 @@ class MergeThread(WorkerThread):
     REFRESH_COUNT = 20000
     # Number of iterations between performing an intermediary postback
     POSTBACK_COUNT = 5000
+    # Schema name the right database is attached under for SQL comparison
+    DIFF_SCHEMA = "diffright"
+    # Seconds within which messages without remote_id are compared by time
+    DIFF_TIME_WINDOW = 24 * 3600 + 180
+    # Bytes in message difftext digest compared instead of full difftext
+    DIGEST_SIZE = 16
 
 
     def run(self):
         self._is_running = True
+        self._cancel.bind()
         while self._is_running:
             params = self._queue.get()
             self._stop_work = False
             self._drop_results = False
-            if params and "diff_left" == params.get("type"):
-                self.work_diff_left(params)
-            elif params and "diff_merge_left" == params.get("type"):
-                self.work_diff_merge_left(params)
-            elif params and "merge_left" == params.get("type"):
-                self.work_merge_left(params)
+            if params and params.get("sql_diff") \
+            and "merge_left" != params.get("type"):
+                if not self.attach_right(params["db1"], params["db2"]):
+                    params = dict(params, sql_diff=False)
+            try:
+                if params and "diff_left" == params.get("type"):
+                    self.work_diff_left(params)
+                elif params and "diff_merge_left" == params.get("type"):
+                    self.work_diff_merge_left(params)
+                elif params and "merge_left" == params.get("type"):
+                    self.work_merge_left(params)
+            except Exception as e:
+                if self._stop_work: # Stopping aborts running queries
+                    main.log("Stopped %s work.\n\n%s", params.get("type"),
+                             traceback.format_exc())
+                else:
+                    main.log("Error in %s work.\n\n%s", params.get("type"),
+                             traceback.format_exc())
+                if not self._drop_results:
+                    self.postback({"type": params.get("type"), "done": True,
+                                   "output": "", "chats": [],
+                                   "params": params, "error_short": repr(e),
+                                   "error": traceback.format_exc()})
+            finally:
+                if params and params.get("sql_diff") \
+                and "merge_left" != params.get("type"):
+                    self.detach_right(params["db1"])
 
 
     def work_diff_left(self, params):
@@ -433,7 +508,8 @@ class MergeThread(WorkerThread):
             result["chatindex"] = index
             postback = dict((k, v) for k, v in result.items()
                             if k not in ["output", "chats", "params"])
-            diff = self.get_chat_diff_left(chat, db1, db2, postback)
+            diff = self.get_chat_diff_left(chat, db1, db2, postback,
+                                           params.get("sql_diff"))
             if self._stop_work:
                 break # break for index, chat in enumerate(compared)
             if diff["messages"] \
@@ -455,6 +531,7 @@ class MergeThread(WorkerThread):
                 result["output"] += info
                 result["chats"].append({"chat": chat, "diff": diff})
             result["index"] = postback["index"]
+            result["memory"] = util.get_memory_peak()
             if not self._drop_results:
                 if index < len(compared) - 1:
                     result["status"] = ("Scanning %s." % 
@@ -463,6 +540,7 @@ class MergeThread(WorkerThread):
                 result = dict(result, output="", chats=[])
         if not self._drop_results:
             result["done"] = True
+            result["memory"] = util.get_memory_peak()
             self.postback(result)
 
 
@@ -494,12 +572,14 @@ class MergeThread(WorkerThread):
             compared.sort(key=lambda x: x["title"].lower())
             count_messages = 0
             count_participants = 0
+            db2.begin_batch()
 
             for index, chat in enumerate(compared):
                 result["chatindex"] = index
                 postback = dict((k, v) for k, v in result.items()
                                 if k not in ["output", "chats", "params"])
-                diff = self.get_chat_diff_left(chat, db1, db2, postback)
+                diff = self.get_chat_diff_left(chat, db1, db2, postback,
+                                               params.get("sql_diff"))
                 if self._stop_work:
                     break # break for index, chat in enumerate(compared)
                 if diff["messages"] \
@@ -517,7 +597,8 @@ class MergeThread(WorkerThread):
                         count_participants += len(diff["participants"])
                     if diff["messages"]:
                         db2.insert_messages(chat2, diff["messages"], db1, chat1,
-                                            self.yield_ui, self.REFRESH_COUNT)
+                                            self.make_heartbeat(result),
+                                            self.REFRESH_COUNT)
                         count_messages += len(diff["messages"])
 
                     newstr = "" if new_chat else "new "
@@ -532,6 +613,7 @@ class MergeThread(WorkerThread):
                     result["output"] = info + "."
                     result["diff"] = diff
                 result["index"] = postback["index"]
+                result["memory"] = util.get_memory_peak()
                 result["chats"].append(chat)
                 if not self._drop_results:
                     if index < len(compared) - 1:
@@ -542,6 +624,7 @@ class MergeThread(WorkerThread):
         except Exception as e:
             error = traceback.format_exc()
         finally:
+            db2.end_batch()
             if not self._drop_results:
                 if compared:
                     info = "Merged %s" % util.plural("new message",
@@ -553,7 +636,8 @@ class MergeThread(WorkerThread):
                 else:
                     info = "Nothing new to merge from %s to %s." % (db1, db2)
                 result = {"type": "diff_merge_left", "done": True,
-                          "output": info, "params": params, "chats": [] }
+                          "output": info, "params": params, "chats": [],
+                          "memory": util.get_memory_peak()}
                 if error:
                     result["error"] = error
                     if e: result["error_short"] = repr(e)
@@ -576,6 +660,7 @@ class MergeThread(WorkerThread):
                   "type": "merge_left", "output": "", "chats": [],
                   "params": params}
         try:
+            db2.begin_batch()
             for index, chat_data in enumerate(chats):
                 if self._stop_work:
                     break # break for i, chat_data in enumerate(chats)
@@ -601,7 +686,8 @@ class MergeThread(WorkerThread):
                     count_participants += len(participants)
                 if messages:
                     db2.insert_messages(chat2, messages, db1, chat1,
-                                        self.yield_ui, self.REFRESH_COUNT)
+                                        self.make_heartbeat(result),
+                                        self.REFRESH_COUNT)
                     count_messages += len(messages)
                 if not self._drop_results:
                     result.update(output=html, chatindex=index,
@@ -615,6 +701,7 @@ class MergeThread(WorkerThread):
         except Exception as e:
             error = traceback.format_exc()
         finally:
+            db2.end_batch()
             html = "Nothing to merge."
             if chats:
                 html = "Merged %s" % util.plural("new message",
@@ -632,7 +719,23 @@ class MergeThread(WorkerThread):
                 self.postback(result)
 
 
-    def get_chat_diff_left(self, chat, db1, db2, postback=None):
+    def make_heartbeat(self, result):
+        """
+        Returns a heartbeat function for SkypeDatabase.insert_messages(),
+        setting the insert rate in messages per second into result as
+        "rate", posting back progress with the rate, and yielding UI.
+        """
+        def heartbeat(rate):
+            result["rate"] = rate
+            if not self._drop_results:
+                self.postback(dict((k, v) for k, v in result.items()
+                                   if k not in ("output", "chats", "diff",
+                                                "status")))
+            self.yield_ui()
+        return heartbeat
+
+
+    def get_chat_diff_left(self, chat, db1, db2, postback=None, sql=False):
         """
         Compares the chat in the two databases and returns the differences from
         the left as {"messages": [message IDs different in db1],
@@ -640,6 +743,8 @@ class MergeThread(WorkerThread):
 
         @param   postback  if {"count": .., "index": ..}, updates index
                            and posts the result at POSTBACK_COUNT intervals
+        @param   sql       whether to compare messages in SQL first, with db2
+                           attached to db1 via attach_right()
         """
         c = chat
         participants1 = c["c1"]["participants"] if c["c1"] else []
@@ -652,78 +757,84 @@ class MergeThread(WorkerThread):
             messages1, messages2 = [], [] # Left side empty, skip all messages
         elif not c["messages2"]:
             messages1, messages2 = [], [] # Right side empty, take whole left
-            messages_all = db1.get_messages(c["c1"], use_cache=False)
+            messages_all = db1.get_messages(c["c1"], use_cache=False,
+                                            projection="ids")
             c1m_diff = [(m["id"], m["datetime"]) for m in messages_all]
+        elif sql:
+            c1m_diff = self.get_message_diff_sql(c, db1, db2)
+            if postback:
+                postback["index"] += c["messages1"] + c["messages2"]
+                self.postback(postback)
         else:
-            messages1 = db1.get_messages(c["c1"], use_cache=False)
-            messages2 = db2.get_messages(c["c2"], use_cache=False)
+            messages1 = db1.get_messages(c["c1"], use_cache=False,
+                                         projection="diff")
+            messages2 = db2.get_messages(c["c2"], use_cache=False,
+                                         projection="diff")
             parser1 = skypedata.MessageParser(db1)
             parser2 = skypedata.MessageParser(db2)
-            parse_options = {"format": "text", "merge": True}
-
-            m1map = {} # {remote_id: [(id, datetime), ], }
-            m2map = {} # {remote_id: [(id, datetime), ], }
-            m1_no_remote_ids = [] # [(id, datetime), ] with a NULL remote_id
-            m2_no_remote_ids = [] # [(id, datetime), ] with a NULL remote_id
-            m1bodymap = {} # {author+type+body: [(id, datetime), ], }
-            m2bodymap = {} # {author+type+body: [(id, datetime), ], }
-            difftexts = {} # {(id, datetime): text, }
-
-            # Assemble maps by remote_id and create diff texts. remote_id is
-            # not unique and can easily have duplicates.
-            things = [(messages1, m1map, m1_no_remote_ids, m1bodymap, parser1),
-                      (messages2, m2map, m2_no_remote_ids, m2bodymap, parser2)]
-            for messages, idmap, noidmap, bodymap, parser in things:
+
+            # Avoid keeping whole messages or texts in memory, can run out:
+            # messages are kept as indexes into compact arrays of ID,
+            # timestamp and fixed-width difftext digest.
+            ids1 = array.array("l")       # [message ID, ] in left chat
+            stamps1 = array.array("d")    # [timestamp, ] in left chat
+            stamps2 = array.array("d")    # [timestamp, ] in right chat
+            digests1 = bytearray()        # DIGEST_SIZE bytes per left message
+            digests2 = bytearray()        # DIGEST_SIZE bytes per right message
+            m1map = {} # {remote_id: [index, ], }
+            m2map = {} # {remote_id: [index, ], }
+            m1_no_remote_ids = array.array("l") # [index, ] with NULL remote_id
+            m2bodymap = {} # {difftext digest: [index, ], }
+
+            # Assemble maps by remote_id and create diff digests. remote_id
+            # is not unique and can easily have duplicates.
+            things = [(messages1, m1map, parser1, stamps1, digests1),
+                      (messages2, m2map, parser2, stamps2, digests2)]
+            for side, (messages, idmap, parser, stamps, digests) \
+            in enumerate(things):
                 for i, m in enumerate(messages):
-                    # Avoid keeping whole messages in memory, can run out.
-                    m_cache = (m["id"], m.get("datetime"))
+                    stamps.append(m["timestamp"] or 0)
                     if m["remote_id"]:
-                        if m["remote_id"] not in idmap:
-                            idmap[m["remote_id"]] = []
-                        idmap[m["remote_id"]].append(m_cache)
-                    else:
-                        noidmap.append(m_cache)
-                    # In these messages, parsed body can differ even though
-                    # message is the same: contact names are taken from current
-                    # database values. Using raw values instead.
-                    if m["type"] in self.MESSAGE_TYPES_IGNORE_BODY:
-                        t = m["identities"] or ""
-                        if skypedata.MESSAGE_TYPE_LEAVE == m["type"]:
-                            t = m["author"]
+                        idmap.setdefault(m["remote_id"], []).append(i)
+                    elif not side:
+                        m1_no_remote_ids.append(i)
+                    digest = self.get_digest(self.get_difftext(m, parser))
+                    digests.extend(digest)
+                    if side:
+                        m2bodymap.setdefault(digest, []).append(i)
                     else:
-                        t = parser.parse(m, output=parse_options)
-                    t = t if isinstance(t, str) else t.encode("utf-8")
-                    author = (m["author"] or "").encode("utf-8")
-                    difftext = "%s-%s-%s" % (author, m["type"], t)
-                    difftexts[m_cache]  = difftext
-                    if difftext not in bodymap: bodymap[difftext] = []
-                    bodymap[difftext].append(m_cache)
+                        ids1.append(m["id"])
                     if i and not i % self.REFRESH_COUNT:
                         self.yield_ui()
                     if postback: postback["index"] += 1
                     if postback and i and not i % self.POSTBACK_COUNT:
+                        postback["memory"] = util.get_memory_peak()
                         self.postback(postback)
+            D = self.DIGEST_SIZE
+            dt1 = lambda i: db1.stamp_to_date(stamps1[i]) if stamps1[i] \
+                            else None
+            dt2 = lambda i: db2.stamp_to_date(stamps2[i]) if stamps2[i] \
+                            else None
 
             # Compare assembled remote_id maps between databases and see if
             # there are no messages with matching body in the other database.
             remote_id_messages = [(r, j) for r, i in m1map.items() for j in i]
             for i, (remote_id, m) in enumerate(remote_id_messages):
-                if remote_id in m2map:
-                    is_match = lambda x: (difftexts[m] == difftexts[x])
-                    if not any(filter(is_match, m2map[remote_id])):
-                        c1m_diff.append(m) # Nothing with same remote_id+body
-                else:
-                    c1m_diff.append(m)
+                digest = digests1[m * D:(m + 1) * D]
+                is_match = lambda x: digests2[x * D:(x + 1) * D] == digest
+                if not any(map(is_match, m2map.get(remote_id, []))):
+                    c1m_diff.append((ids1[m], dt1(m))) # No remote_id+body
                 if i and not i % self.REFRESH_COUNT:
                     self.yield_ui()
 
             # For messages with no remote_id-s, compare by author-type-body key
             # and see if there are no matching messages close in time.
             for i, m in enumerate(m1_no_remote_ids):
-                potential_matches = m2bodymap.get(difftexts[m], [])
+                digest = str(digests1[m * D:(m + 1) * D])
+                potential_matches = m2bodymap.get(digest, [])
                 if not [m2 for m2 in potential_matches
-                        if self.match_time(m[1], m2[1], 180)]:
-                    c1m_diff.append(m)
+                        if self.match_time(dt1(m), dt2(m2), 180)]:
+                    c1m_diff.append((ids1[m], dt1(m)))
                 if i and not i % self.REFRESH_COUNT:
                     self.yield_ui()
 
@@ -732,6 +843,159 @@ class MergeThread(WorkerThread):
         return result
 
 
+    def get_message_diff_sql(self, chat, db1, db2):
+        """
+        Returns messages in the left chat not present in the right chat, as
+        [(id, datetime), ]. Messages are first matched in SQL by identical
+        author, type and raw content, plus same GUID, or same remote_id, or
+        no remote_id and timestamp close enough. Only the unmatched remainder
+        is compared by parsed body, against candidate messages on the right.
+        """
+        c, matched = chat, set() # set(matched message IDs in db1)
+        types = ", ".join(map(str, skypedata.MESSAGE_TYPES_MESSAGE))
+        params = {"c1": c["c1"]["id"], "c2": c["c2"]["id"],
+                  "window": self.DIFF_TIME_WINDOW}
+        sql = ("SELECT m1.id AS id1, m1.timestamp AS ts1, m2.timestamp AS ts2 "
+               "FROM messages m1 JOIN %s.messages m2 ON %%s "
+               "WHERE m1.convo_id = :c1 AND m2.convo_id = :c2 "
+               "AND m1.type IN (%s) AND m2.type = m1.type "
+               "AND m2.author IS m1.author AND m2.body_xml IS m1.body_xml "
+               "AND m2.identities IS m1.identities" % (self.DIFF_SCHEMA, types))
+        joins = ["m2.guid = m1.guid",
+                 "m2.remote_id = m1.remote_id AND m1.remote_id != 0",
+                 "COALESCE(m1.remote_id, 0) = 0 AND m2.timestamp BETWEEN "
+                 "m1.timestamp - :window AND m1.timestamp + :window"]
+        for i, join in enumerate(joins):
+            rows = db1.execute(sql % join, params, writer=True)
+            for j, row in enumerate(rows):
+                if row["id1"] in matched:
+                    continue # continue for j, row in enumerate(..)
+                if i < len(joins) - 1 or self.match_time(
+                    db1.stamp_to_date(row["ts1"]),
+                    db2.stamp_to_date(row["ts2"]), 180):
+                    matched.add(row["id1"])
+                if j and not j % self.REFRESH_COUNT:
+                    self.yield_ui()
+                if self._stop_work:
+                    return []
+
+        sql = ("SELECT id, remote_id, author, type, timestamp FROM %s "
+               "WHERE convo_id = :%s AND type IN (%s)")
+        rest = [x for x in db1.execute(sql % ("messages", "c1", types), params)
+                if x["id"] not in matched]
+        main.log("Matched %s of %s in SQL (%s), comparing remaining %s.",
+                 len(matched), util.plural("message", len(matched) + len(rest)),
+                 c["title_long_lc"], len(rest))
+        if not rest:
+            return []
+
+        # Candidates on the right: same author and type, and same remote_id,
+        # or no remote_id and within time window.
+        ids2 = set()
+        remote_ids2 = {} # {(author, type, remote_id): [id, ]}
+        stamps2 = {}     # {(author, type): [(timestamp, id), ]}
+        table2 = "%s.messages" % self.DIFF_SCHEMA
+        for x in db1.execute(sql % (table2, "c2", types), params,
+                             writer=True):
+            key = (x["author"], x["type"])
+            if x["remote_id"]:
+                remote_ids2.setdefault(key + (x["remote_id"], ), []).append(
+                    x["id"])
+            stamps2.setdefault(key, []).append((x["timestamp"] or 0, x["id"]))
+        for v in stamps2.values(): v.sort()
+        for x in rest:
+            key = (x["author"], x["type"])
+            if x["remote_id"]:
+                ids2.update(remote_ids2.get(key + (x["remote_id"], ), []))
+                continue # continue for x in rest
+            stamps, stamp = stamps2.get(key, []), x["timestamp"] or 0
+            i = bisect.bisect_left(stamps, (stamp - self.DIFF_TIME_WINDOW, ))
+            while i < len(stamps) and \
+            stamps[i][0] <= stamp + self.DIFF_TIME_WINDOW:
+                ids2.add(stamps[i][1])
+                i += 1
+        rest = [x["id"] for x in rest]
+
+        result = []
+        m2map = {} # {remote_id: [difftext digest, ], }
+        m2bodymap = {} # {difftext digest: [datetime, ], }
+        parser1 = skypedata.MessageParser(db1)
+        parser2 = skypedata.MessageParser(db2)
+        for i, m in enumerate(db2.message_iterator(list(ids2))):
+            digest = self.get_digest(self.get_difftext(m, parser2))
+            if m["remote_id"]:
+                m2map.setdefault(m["remote_id"], []).append(digest)
+            m2bodymap.setdefault(digest, []).append(m["datetime"])
+            if i and not i % self.REFRESH_COUNT:
+                self.yield_ui()
+        for i, m in enumerate(db1.message_iterator(rest)):
+            digest = self.get_digest(self.get_difftext(m, parser1))
+            if m["remote_id"]:
+                is_match = digest in m2map.get(m["remote_id"], [])
+            else:
+                is_match = any(self.match_time(m["datetime"], x, 180)
+                               for x in m2bodymap.get(digest, []))
+            if not is_match:
+                result.append((m["id"], m["datetime"]))
+            if i and not i % self.REFRESH_COUNT:
+                self.yield_ui()
+        return result
+
+
+    def get_difftext(self, message, parser):
+        """Returns message author, type and parsed body as comparable text."""
+        m = message
+        # In these messages, parsed body can differ even though
+        # message is the same: contact names are taken from current
+        # database values. Using raw values instead.
+        if m["type"] in self.MESSAGE_TYPES_IGNORE_BODY:
+            t = m["identities"] or ""
+            if skypedata.MESSAGE_TYPE_LEAVE == m["type"]:
+                t = m["author"]
+        else:
+            t = parser.parse(m, output={"format": "text", "merge": True})
+        t = t if isinstance(t, str) else t.encode("utf-8")
+        author = (m["author"] or "").encode("utf-8")
+        return "%s-%s-%s" % (author, m["type"], t)
+
+
+    def get_digest(self, difftext):
+        """
+        Returns fixed-width digest of message difftext, as DIGEST_SIZE bytes:
+        MD5 of text, with its last 4 bytes replaced by text length.
+        """
+        digest = hashlib.md5(difftext).digest()
+        return digest[:-4] + struct.pack(">I", len(difftext) & 0xFFFFFFFF)
+
+
+    def attach_right(self, db1, db2):
+        """
+        ATTACHes the second database to the first database writer connection
+        under DIFF_SCHEMA, for comparing chats in SQL. Returns success.
+        Statements using DIFF_SCHEMA need to run in the writer connection.
+        """
+        try:
+            names = [x["name"] for x in db1.execute("PRAGMA database_list",
+                                                    writer=True)]
+            if self.DIFF_SCHEMA not in names:
+                db1.execute("ATTACH DATABASE ? AS %s" % self.DIFF_SCHEMA,
+                            [db2.filename], writer=True)
+            return True
+        except Exception:
+            main.log("Error attaching %s to %s for comparison.\n\n%s",
+                     db2, db1, traceback.format_exc())
+            return False
+
+
+    def detach_right(self, db1):
+        """DETACHes the database attached in attach_right(), if any."""
+        try:
+            db1.execute("DETACH DATABASE %s" % self.DIFF_SCHEMA, writer=True)
+        except Exception:
+            main.log("Error detaching comparison database from %s.\n\n%s",
+                     db1, traceback.format_exc())
+
+
     def match_time(self, d1, d2, leeway_seconds=0):
         """Whether datetimes might be same but from different timezones."""
         result = False
@@ -757,6 +1021,7 @@ class ContactSearchThread(WorkerThread):
 
     def run(self):
         self._is_running = True
+        self._cancel.bind()
         while self._is_running:
             search = self._queue.get()
             self._stop_work = False
@@ -798,6 +1063,103 @@ class ContactSearchThread(WorkerThread):
 
 
 
+class CountThread(WorkerThread):
+    """
+    Table row count background thread, counts exact rows for database tables
+    with estimated or unknown counts, yielding tables back to main thread
+    one by one.
+    """
+
+    def run(self):
+        self._is_running = True
+        self._cancel.bind()
+        while self._is_running:
+            data = self._queue.get()
+            if not data: continue # while self._is_running
+            self._stop_work = self._drop_results = False
+            result = {"db": data["db"], "done": False}
+            def callback(table):
+                if not self._drop_results:
+                    self.postback(dict(result, table=table))
+                return not self._stop_work
+            try:
+                data["db"].count_tables(callback)
+            except Exception:
+                if not self._stop_work:
+                    main.log("Error counting table rows in %s.\n\n%s",
+                             data["db"], traceback.format_exc())
+                    result["error"] = traceback.format_exc()
+            if not self._drop_results:
+                result["done"] = True
+                self.postback(result)
+
+
+
+class SQLThread(WorkerThread):
+    """
+    SQL statement background thread, executes a statement from the SQL page,
+    yielding back the cursor with the first rows fetched for queries,
+    or the number of affected rows for action statements. Statements run
+    in the database writer connection, same as other SQL page statements,
+    and are told apart as queries by having result columns.
+    """
+
+    def run(self):
+        self._is_running = True
+        self._cancel.bind()
+        while self._is_running:
+            data = self._queue.get()
+            if not data: continue # while self._is_running
+            self._stop_work = self._drop_results = False
+            db, sql = data["db"], data["sql"]
+            result = dict(data)
+            try:
+                if not db.is_read_sql(sql):
+                    db.ensure_backup()
+                cursor = db.execute(sql, writer=True)
+                if cursor.description is not None:
+                    result["cursor"], result["rows"] = cursor, []
+                    for row in cursor:
+                        result["rows"].append(row)
+                        if len(result["rows"]) >= data["prefetch"]:
+                            break # break for row
+                else:
+                    result["affected_rows"] = cursor.rowcount
+                    db.connection.commit()
+            except Exception as e:
+                result["error"] = util.format_exc(e)
+                result["cancelled"] = self._stop_work
+            if not self._drop_results:
+                self.postback(result)
+
+
+
+class ChangeThread(WorkerThread):
+    """
+    Database change detection background thread, checks the database for
+    changes by other programs, yielding the change set back to main thread.
+    """
+
+    def run(self):
+        self._is_running = True
+        self._cancel.bind()
+        while self._is_running:
+            data = self._queue.get()
+            if not data: continue # while self._is_running
+            self._stop_work = self._drop_results = False
+            result = {"db": data["db"], "changes": None}
+            try:
+                result["changes"] = data["db"].detect_changes()
+            except Exception:
+                if not self._stop_work:
+                    main.log("Error checking %s for changes.\n\n%s",
+                             data["db"], traceback.format_exc())
+                    result["error"] = traceback.format_exc()
+            if not self._drop_results:
+                self.postback(result)
+
+
+
 class DetectDatabaseThread(WorkerThread):
     """
     Skype database detection background thread, goes through potential
@@ -806,6 +1168,7 @@ class DetectDatabaseThread(WorkerThread):
 
     def run(self):
         self._is_running = True
+        self._cancel.bind()
         while self._is_running:
             search = self._queue.get()
             self._stop_work = self._drop_results = False